@@ -0,0 +1,81 @@
+# Microbenchmark of the answer evaluation for multiple choice questions.
+# Run from the MatrixChatbotGenerator directory:
+# python -m benchmarks.bench_answer_matching
+import re
+import timeit
+
+from structures.answer import Answer
+from structures.answer_matcher import AnswerMatcher
+
+ANSWERS = [
+    Answer('A', '1variable', False),
+    Answer('B', 'variable1', True),
+    Answer('C', 'variable-1', False),
+    Answer('D', 'variable@1', True),
+]
+# Input and the expected result, texts that only differ in punctuation have to be typed exactly
+CASES = [
+    ('b', 'Partly Correct'),
+    ('B and D', 'Correct'),
+    ('variable1', 'Partly Correct'),
+    ('a, c', 'Incorrect'),
+    ('I think it is b and d', 'Correct'),
+    ('bandana and d', 'Partly Correct'),
+    ('1variable', 'Incorrect'),
+    ('variable-1', 'Incorrect'),
+    ('variable@1', 'Partly Correct'),
+    ('Variable1 and variable@1', 'Correct'),
+]
+INPUTS = [user_input for user_input, _ in CASES]
+
+
+def legacy_create_answers_map(answers):
+    answer_map = {}
+    for answer in answers:
+        answer_map[answer.text.lower()] = answer.identifier.lower()
+    return answer_map
+
+
+def legacy_evaluate(user_input, answers):
+    # The evaluation before the AnswerMatcher, answer maps built per call and uncompiled regexes
+    legacy_create_answers_map(answers)
+    correct_answers = {answer.identifier.lower() for answer in answers if answer.correct}
+    user_input = re.sub(r'[^\w\s]', '', user_input.lower())
+    tokens = re.split(r'\s+|and', user_input)
+    answer_map = legacy_create_answers_map(answers)
+    user_answers = set()
+    for token in tokens:
+        token = token.strip()
+        if token in answer_map:
+            user_answers.add(answer_map[token])
+        elif token in answer_map.values():
+            user_answers.add(token)
+    if user_answers == correct_answers:
+        return 'Correct'
+    elif user_answers & correct_answers:
+        return 'Partly Correct'
+    return 'Incorrect'
+
+
+def main(number=20000):
+    matcher = AnswerMatcher(ANSWERS)
+    mismatches = 0
+    for user_input, expected in CASES:
+        result = matcher.evaluate(user_input)
+        mismatches += result != expected
+        print(f'{user_input!r:28} legacy: {legacy_evaluate(user_input, ANSWERS):15} '
+              f'matcher: {result:15} {"ok" if result == expected else "expected " + expected}')
+
+    legacy = timeit.timeit(lambda: [legacy_evaluate(user_input, ANSWERS) for user_input in INPUTS], number=number)
+    compiled = timeit.timeit(lambda: [matcher.evaluate(user_input) for user_input in INPUTS], number=number)
+    build = timeit.timeit(lambda: AnswerMatcher(ANSWERS), number=number)
+    evaluations = number * len(INPUTS)
+    print(f'legacy:  {legacy / evaluations * 1e6:.2f} us per answer')
+    print(f'matcher: {compiled / evaluations * 1e6:.2f} us per answer '
+          f'(built once in {build / number * 1e6:.2f} us per question)')
+    if mismatches:
+        raise SystemExit(f'{mismatches} answers were not evaluated as expected')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+# Overhead of end-to-end encryption per message. A bot client and one user client per room run against the fake
+# homeserver, every message of a user is echoed by the bot. The round trip is measured in plain and in encrypted
+# rooms, the encryption and decryption of a single message is measured separately on the established sessions.
+# Needs the encryption dependencies of matrix-nio[e2e].
+# Run from the MatrixChatbotGenerator directory:
+# python -m benchmarks.bench_e2ee [--rooms 10] [--messages 50] [--operations 2000]
+import argparse
+import asyncio
+import json
+import tempfile
+import time
+
+from nio import AsyncClient, AsyncClientConfig, MegolmEvent, RoomMessageText
+from nio.crypto import ENCRYPTION_ENABLED
+
+from benchmarks.fake_homeserver import FakeHomeserver
+from util.utility_functions import percentile
+
+BOT = '@quizbot:localhost'
+
+
+async def connect(url, user_id, store_path):
+    client = AsyncClient(url, user_id, store_path=store_path,
+                         config=AsyncClientConfig(store_sync_tokens=False, encryption_enabled=True))
+    await client.login('password', device_name='bench')
+    client.sync_task = asyncio.ensure_future(client.sync_forever(timeout=30000))
+    return client
+
+
+def summary(values):
+    return {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 50) * 1000, 3),
+        'p99_ms': round(percentile(values, 99) * 1000, 3),
+    }
+
+
+class EchoBenchmark:
+    def __init__(self, bot, users):
+        self.bot = bot
+        self.users = users  # room_id -> client of the user in the room
+        self.waiting = {}  # (room_id, body) -> future resolved when the echo arrives
+        bot.add_event_callback(self.echo, RoomMessageText)
+        bot.add_event_callback(self.undecrypted, MegolmEvent)
+        for client in set(users.values()):
+            client.add_event_callback(self.received, RoomMessageText)
+        self.undecrypted_messages = 0
+
+    async def echo(self, room, event):
+        if event.sender != self.bot.user_id:
+            await self.bot.room_send(room.room_id, 'm.room.message', {'msgtype': 'm.text', 'body': event.body},
+                                     ignore_unverified_devices=True)
+
+    async def undecrypted(self, room, event):
+        self.undecrypted_messages += 1
+
+    async def received(self, room, event):
+        if event.sender != self.bot.user_id:
+            return
+        future = self.waiting.pop((room.room_id, event.body), None)
+        if future and not future.done():
+            future.set_result(time.monotonic())
+
+    async def round_trip(self, room_id, body, timeout=30):
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[(room_id, body)] = future
+        started = time.monotonic()
+        await self.users[room_id].room_send(room_id, 'm.room.message', {'msgtype': 'm.text', 'body': body},
+                                            ignore_unverified_devices=True)
+        return await asyncio.wait_for(future, timeout) - started
+
+    async def run_room(self, room_id, messages):
+        return [await self.round_trip(room_id, f'message {index} in {room_id}') for index in range(messages)]
+
+    async def run(self, room_ids, messages):
+        results = await asyncio.gather(*[self.run_room(room_id, messages) for room_id in room_ids])
+        return [latency for latencies in results for latency in latencies]
+
+
+async def encryption_costs(bot, user, room_id, operations):
+    content = {'msgtype': 'm.text', 'body': 'Which character should object names on an i-series system not start with?'}
+    for client in (bot, user):
+        # Group sessions are rotated after 100 messages, the benchmark encrypts more with one session
+        if client.olm.should_share_group_session(room_id):
+            await client.share_group_session(room_id, ignore_unverified_devices=True)
+        client.olm.outbound_group_sessions[room_id].max_messages += operations
+    started = time.perf_counter()
+    for _ in range(operations):
+        bot.encrypt(room_id, 'm.room.message', content)
+    encrypt = (time.perf_counter() - started) / operations
+
+    events = []
+    for index in range(operations):
+        _, encrypted = user.encrypt(room_id, 'm.room.message', content)
+        events.append(MegolmEvent.from_dict({
+            'type': 'm.room.encrypted', 'sender': user.user_id, 'content': encrypted, 'room_id': room_id,
+            'event_id': f'$bench{index}', 'origin_server_ts': int(time.time() * 1000)}))
+    # Waits until the bot received the group session of the user
+    for _ in range(100):
+        if not isinstance(bot.decrypt_event(events[0]), MegolmEvent):
+            break
+        await asyncio.sleep(0.05)
+    started = time.perf_counter()
+    for event in events:
+        bot.decrypt_event(event)
+    decrypt = (time.perf_counter() - started) / operations
+    return {'encrypt_us': round(encrypt * 1e6, 2), 'decrypt_us': round(decrypt * 1e6, 2)}
+
+
+async def benchmark(args):
+    server = FakeHomeserver(bot=BOT, noise=False)
+    url = await server.start()
+    plain_rooms = [f'!plain{index}:localhost' for index in range(args.rooms)]
+    encrypted_rooms = [f'!encrypted{index}:localhost' for index in range(args.rooms)]
+    for index in range(args.rooms):
+        user_id = f'@user{index}:localhost'
+        server.add_room(plain_rooms[index], [user_id])
+        server.add_room(encrypted_rooms[index], [user_id], encrypted=True)
+
+    store_path = tempfile.mkdtemp(prefix='quizbot-e2ee-')
+    bot = await connect(url, BOT, store_path)
+    users = {}
+    for index in range(args.rooms):
+        client = await connect(url, f'@user{index}:localhost', store_path)
+        users[plain_rooms[index]] = users[encrypted_rooms[index]] = client
+    # Wait until every client did its first sync and uploaded its keys
+    clients = [bot] + list(dict.fromkeys(users.values()))
+    for client in clients:
+        while not client.rooms or client.should_upload_keys:
+            await asyncio.sleep(0.05)
+
+    echo = EchoBenchmark(bot, users)
+    # The first message of a room shares the group sessions and is not measured
+    started = time.monotonic()
+    await echo.run(encrypted_rooms, 1)
+    key_sharing = time.monotonic() - started
+    await echo.run(plain_rooms, 1)
+
+    plain = await echo.run(plain_rooms, args.messages)
+    encrypted = await echo.run(encrypted_rooms, args.messages)
+    report = {
+        'rooms': args.rooms,
+        'messages_per_room': args.messages,
+        'key_sharing_seconds': round(key_sharing, 3),
+        'plain_round_trip': summary(plain),
+        'encrypted_round_trip': summary(encrypted),
+        'per_message': await encryption_costs(bot, users[encrypted_rooms[0]], encrypted_rooms[0], args.operations),
+        'undecrypted_messages': echo.undecrypted_messages,
+    }
+
+    for client in clients:
+        client.sync_task.cancel()
+        await asyncio.gather(client.sync_task, return_exceptions=True)
+        await client.close()
+    await server.stop()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--messages', type=int, default=50)
+    parser.add_argument('--operations', type=int, default=2000)
+    args = parser.parse_args()
+    if not ENCRYPTION_ENABLED:
+        print('The encryption dependencies are not installed, install matrix-nio[e2e] to run this benchmark.')
+        return
+    print(json.dumps(asyncio.run(benchmark(args)), indent=2))
+
+
+if __name__ == '__main__':
+    main()
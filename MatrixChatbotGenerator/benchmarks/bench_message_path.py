@@ -0,0 +1,196 @@
+# Load harness for the message path of the Quizbot. A fake homeserver runs in the same process as the bot,
+# simulated users send commands and answers in their rooms and every reply of the bot is matched to the
+# message it answers. Each room has one message in flight, the users of a room take turns.
+# Everything runs offline against a freshly seeded SQLite database in a temporary directory.
+# Run from the MatrixChatbotGenerator directory:
+# python -m benchmarks.bench_message_path [--users 200] [--rooms 50] [--messages 2000] [--output report.json]
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+from benchmarks.fake_homeserver import FakeHomeserver
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+QUIZ_FILE = os.path.join(PROJECT_DIR, 'data', 'lt_testquiz.xml')
+BOT = '@quizbot:localhost'
+ANSWERS = ['a', 'b', 'b and d', 'I think it is c', 'variable1', 'A function returns a value']
+COMMANDS = ['nextquestion 1'] * 4 + ['subscribed', 'help', 'hello', 'quizzes']
+
+
+class SimulatedUser:
+    def __init__(self, user_id, room_id, rng):
+        self.user_id = user_id
+        self.room_id = room_id
+        self.rng = rng
+        self.planned = ['subscribe 1']
+        self.asked = False  # True if the last reply was a question
+
+    def next_message(self):
+        if self.planned:
+            return 'subscribe' if self.planned[0].startswith('subscribe') else 'reset', self.planned.pop(0)
+        if self.asked:
+            return 'answer', self.rng.choice(ANSWERS)
+        message = self.rng.choice(COMMANDS)
+        return message.split()[0], message
+
+    def observe(self, kind, reply):
+        self.asked = kind == 'nextquestion' and not reply.startswith(('You ', 'This Quiz', 'There '))
+        if 'no question left' in reply:
+            self.planned = ['reset 1', 'subscribe 1']
+
+
+class LoadHarness:
+    def __init__(self, server, users, rooms, messages, seed):
+        rng = random.Random(seed)
+        self.server = server
+        self.messages = messages
+        self.rooms = {f'!room{index}:localhost': [] for index in range(rooms)}
+        for index in range(users):
+            room_id = f'!room{index % rooms}:localhost'
+            self.rooms[room_id].append(SimulatedUser(f'@user{index}:localhost', room_id, rng))
+        self.rooms = {room_id: members for room_id, members in self.rooms.items() if members}
+        for room_id, members in self.rooms.items():
+            server.add_room(room_id, [user.user_id for user in members])
+        self.turns = {room_id: 0 for room_id in self.rooms}
+        self.in_flight = {}  # room_id -> (user, kind, injected timestamp)
+        self.sent = 0
+        self.latencies = {}  # kind -> latencies in seconds
+        self.unsolicited = 0
+        self.done = asyncio.Event()
+        server.on_send = self.on_send
+
+    def send_next(self, room_id):
+        if self.sent >= self.messages:
+            if not self.in_flight:
+                self.done.set()
+            return
+        members = self.rooms[room_id]
+        user = members[self.turns[room_id] % len(members)]
+        self.turns[room_id] += 1
+        kind, message = user.next_message()
+        self.sent += 1
+        self.in_flight[room_id] = (user, kind, time.monotonic())
+        self.server.inject(room_id, user.user_id, message)
+
+    def on_send(self, room_id, content):
+        if room_id not in self.in_flight:
+            self.unsolicited += 1
+            return
+        user, kind, injected = self.in_flight.pop(room_id)
+        self.latencies.setdefault(kind, []).append(time.monotonic() - injected)
+        user.observe(kind, content.get('body', ''))
+        self.send_next(room_id)
+
+    async def run(self, timeout):
+        started = time.monotonic()
+        for room_id in self.rooms:
+            self.send_next(room_id)
+        try:
+            await asyncio.wait_for(self.done.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return time.monotonic() - started
+
+    def report(self, seconds, percentile):
+        def summary(values):
+            return {
+                'count': len(values),
+                'p50_ms': round(percentile(values, 50) * 1000, 2),
+                'p99_ms': round(percentile(values, 99) * 1000, 2),
+                'max_ms': round(max(values) * 1000, 2),
+            }
+
+        latencies = [latency for values in self.latencies.values() for latency in values]
+        return {
+            'users': sum(len(members) for members in self.rooms.values()),
+            'rooms': len(self.rooms),
+            'messages': self.sent,
+            'replies': len(latencies),
+            'unanswered': len(self.in_flight),
+            'unsolicited': self.unsolicited,
+            'seconds': round(seconds, 3),
+            'throughput': round(len(latencies) / seconds, 1) if seconds else 0,
+            'latency': summary(latencies) if latencies else {},
+            'commands': {kind: summary(values) for kind, values in sorted(self.latencies.items())},
+        }
+
+
+def seed_database():
+    from classes.QTIParser import QTIParser
+    from store.db_operations import add_custom_question_to_db, add_quiz_to_db
+    from store.models import ensure_schema
+
+    ensure_schema()
+    quiz = QTIParser(QUIZ_FILE).quiz
+    add_quiz_to_db(quiz)
+    for question in quiz.questions:
+        add_custom_question_to_db(question, quiz.identifier)
+
+
+async def benchmark(args):
+    server = FakeHomeserver(bot=BOT, noise=False)
+    url = await server.start()
+    os.environ.update({
+        'MATRIX_HOST': url,
+        'MATRIX_USER': BOT,
+        'MATRIX_PASSWORD': 'password',
+        'QUIZBOT_DB_URI': f'sqlite:///{os.path.join(os.getcwd(), "quizbot.db")}',
+        'METRICS_PORT': '0',
+        # The simulated users send as fast as the bot answers, the flood control would drop most of it
+        'FLOOD_USER_RATE': '0',
+        'FLOOD_ROOM_RATE': '0',
+    })
+    # Imported here, the bot reads its configuration and opens the database on import
+    seed_database()
+    from classes.QuizBot import Quizbot
+    from util.utility_functions import percentile
+
+    bot = Quizbot()
+
+    async def no_scheduler():
+        # Scheduled questions would be unsolicited replies, only the message path is measured
+        pass
+
+    bot.start_scheduler = no_scheduler
+    bot_task = asyncio.ensure_future(bot.run())
+    while server.batch == 0:
+        await asyncio.sleep(0.05)
+
+    harness = LoadHarness(server, args.users, args.rooms, args.messages, args.seed)
+    seconds = await harness.run(args.timeout)
+    report = harness.report(seconds, percentile)
+
+    bot_task.cancel()
+    await bot.close()
+    await server.stop()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--rooms', type=int, default=50)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--timeout', type=float, default=300, help='seconds until unanswered messages are given up')
+    parser.add_argument('--output', help='file the JSON report is written to, stdout if not given')
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    sys.path.insert(0, PROJECT_DIR)
+    # The bot writes its logs, sync token and database to the working directory
+    os.chdir(tempfile.mkdtemp(prefix='quizbot-bench-'))
+    report = asyncio.run(benchmark(args))
+    if output:
+        with open(output, 'w') as file:
+            json.dump(report, file, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,157 @@
+# Query plans and timings of the hot lookups before and after the index migration. A database without the
+# indexes of the association tables is filled with synthetic users, quizzes and answers (including duplicate
+# rows as they could be written before the unique indexes existed), then the migration is run in place.
+# Run from the MatrixChatbotGenerator directory:
+# python -m benchmarks.bench_query_plans [--users 5000] [--quizzes 20] [--questions 50] [--output report.json]
+import argparse
+import json
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# The lookups of db_operations, the parameters are filled in from the synthetic data
+QUERIES = {
+    'is_user_subscribed': (
+        'SELECT * FROM user_subscribed_to_quiz WHERE user_id = :user_id AND quiz_id = :quiz_id'),
+    'has_open_question': (
+        'SELECT * FROM last_question WHERE user_id = :user_id AND answered = 0 AND room_id = :room_id'),
+    'update_user_asked_question': (
+        'SELECT COUNT(*) FROM user_asked_question WHERE user_id = :user_id AND question_id = :question_id'),
+    'get_feedback': (
+        "SELECT * FROM feedback WHERE question_id = :question_id AND identifier = 'Correct' LIMIT 1"),
+    'asked_today': (
+        'SELECT question.quiz_id, COUNT(user_asked_question.question_id) FROM user_asked_question '
+        'JOIN question ON question.id = user_asked_question.question_id '
+        'WHERE user_asked_question.user_id = :user_id AND user_asked_question.ts >= :day_start '
+        'AND user_asked_question.ts < :day_end GROUP BY question.quiz_id'),
+    'count_subscribers': (
+        'SELECT COUNT(*) FROM user_subscribed_to_quiz WHERE quiz_id = :quiz_id'),
+    'get_all_answers_for_question': (
+        'SELECT * FROM answer WHERE question_id = :question_id'),
+}
+
+INDEXES = ['ux_user_subscribed_to_quiz_user_quiz', 'ix_user_subscribed_to_quiz_quiz',
+           'ux_user_asked_question_user_question', 'ix_user_asked_question_ts', 'ix_answer_question_id',
+           'ix_feedback_question_identifier', 'ix_last_question_user_answered_room']
+
+
+def fill(path, args):
+    rng = random.Random(args.seed)
+    now = datetime.now()
+    connection = sqlite3.connect(path)
+    # Back to the tables of an existing quizbot.db
+    for index in INDEXES:
+        connection.execute(f'DROP INDEX IF EXISTS {index}')
+    quizzes = [f'quiz{index}' for index in range(args.quizzes)]
+    questions = {quiz_id: [f'{quiz_id}-q{index}' for index in range(args.questions)] for quiz_id in quizzes}
+    connection.executemany('INSERT INTO quiz (id, name, messages_per_day, short_id) VALUES (?, ?, 3, ?)',
+                           [(quiz_id, quiz_id, index + 1) for index, quiz_id in enumerate(quizzes)])
+    connection.executemany('INSERT INTO question (id, text, is_essay, is_multiple_choice, quiz_id, position) '
+                           'VALUES (?, ?, 0, 1, ?, ?)',
+                           [(question_id, question_id, quiz_id, position) for quiz_id in quizzes
+                            for position, question_id in enumerate(questions[quiz_id])])
+    connection.executemany('INSERT INTO answer (id, identifier, text, is_correct, question_id) VALUES (?, ?, ?, ?, ?)',
+                           [(f'{question_id}-{identifier}', identifier, identifier, identifier == 'a', question_id)
+                            for quiz_id in quizzes for question_id in questions[quiz_id] for identifier in 'abcd'])
+    connection.executemany('INSERT INTO feedback (id, identifier, text, question_id) VALUES (?, ?, ?, ?)',
+                           [(f'{question_id}-{identifier}', identifier, identifier, question_id)
+                            for quiz_id in quizzes for question_id in questions[quiz_id]
+                            for identifier in ('Correct', 'InCorrect')])
+    subscriptions, asked, last_questions = [], [], []
+    for index in range(args.users):
+        user_id = f'@user{index}:localhost'
+        room_id = f'!room{index}:localhost'
+        for quiz_id in rng.sample(quizzes, min(3, len(quizzes))):
+            subscriptions.append((user_id, quiz_id, room_id, 3))
+            count = rng.randrange(args.questions)
+            for position, question_id in enumerate(questions[quiz_id][:count]):
+                asked.append((user_id, question_id, str(now - timedelta(days=count - position))))
+            if count:
+                last_questions.append((user_id, quiz_id, questions[quiz_id][count - 1], room_id, rng.random() < 0.5))
+    # Duplicates written by concurrent subscribes and answers
+    subscriptions += rng.sample(subscriptions, len(subscriptions) // 100)
+    asked += rng.sample(asked, len(asked) // 100)
+    connection.executemany('INSERT INTO user (id) VALUES (?)', [(f'@user{index}:localhost',)
+                                                               for index in range(args.users)])
+    connection.executemany('INSERT INTO user_subscribed_to_quiz (user_id, quiz_id, room_id, messages_per_day) '
+                           'VALUES (?, ?, ?, ?)', subscriptions)
+    connection.executemany('INSERT INTO user_asked_question (user_id, question_id, ts) VALUES (?, ?, ?)', asked)
+    connection.executemany('INSERT INTO last_question (user_id, quiz_id, question_id, room_id, answered) '
+                           'VALUES (?, ?, ?, ?, ?)', last_questions)
+    connection.commit()
+    connection.close()
+    return {'subscriptions': len(subscriptions), 'asked_questions': len(asked), 'last_questions': len(last_questions)}
+
+
+def measure(path, args):
+    rng = random.Random(args.seed)
+    connection = sqlite3.connect(path)
+    day_start = datetime.combine(datetime.now().date(), datetime.min.time())
+    parameters = []
+    for _ in range(args.lookups):
+        index = rng.randrange(args.users)
+        parameters.append({
+            'user_id': f'@user{index}:localhost',
+            'room_id': f'!room{index}:localhost',
+            'quiz_id': f'quiz{rng.randrange(args.quizzes)}',
+            'question_id': f'quiz{rng.randrange(args.quizzes)}-q{rng.randrange(args.questions)}',
+            'day_start': str(day_start),
+            'day_end': str(day_start + timedelta(days=1)),
+        })
+    report = {}
+    for name, query in QUERIES.items():
+        plan = [row[-1] for row in connection.execute(f'EXPLAIN QUERY PLAN {query}', parameters[0])]
+        started = time.perf_counter()
+        for values in parameters:
+            connection.execute(query, values).fetchall()
+        seconds = (time.perf_counter() - started) / len(parameters)
+        report[name] = {'plan': plan, 'us_per_lookup': round(seconds * 1e6, 1)}
+    connection.close()
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=5000)
+    parser.add_argument('--quizzes', type=int, default=20)
+    parser.add_argument('--questions', type=int, default=50)
+    parser.add_argument('--lookups', type=int, default=500)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='file the JSON report is written to, stdout if not given')
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output) if args.output else None
+    sys.path.insert(0, PROJECT_DIR)
+    # The migration writes its log to the working directory
+    os.chdir(tempfile.mkdtemp(prefix='quizbot-plans-'))
+    path = os.path.join(os.getcwd(), 'quizbot.db')
+    os.environ['QUIZBOT_DB_URI'] = f'sqlite:///{path}'
+    from store import migrations
+    from store.models import Base, engine
+
+    Base.metadata.create_all(engine)
+    rows = fill(path, args)
+    before = measure(path, args)
+    started = time.perf_counter()
+    migrations.upgrade(engine, Base.metadata)
+    migration_seconds = time.perf_counter() - started
+    after = measure(path, args)
+    report = {
+        'rows': rows,
+        'migration_seconds': round(migration_seconds, 3),
+        'queries': {name: {'before': before[name], 'after': after[name]} for name in QUERIES},
+    }
+    if output:
+        with open(output, 'w') as file:
+            json.dump(report, file, indent=2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+# Commits, statements and time per recorded answer. The database work of Quizbot.process_answer is run as it
+# was done with one commit per operation, with the same operations in one unit of work, and with record_answer.
+# Every commit is a transaction of its own and costs at least one fsync on SQLite.
+# Run from the MatrixChatbotGenerator directory:
+# python -m benchmarks.bench_record_answer [--users 20] [--questions 100] [--answers 500]
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def separate_commits(ops, user_id, quiz_id, question_id, room_id):
+    # The operations of process_answer before record_answer, every one commits on its own
+    open_question = ops.get_open_question(user_id)
+    ops.update_user_asked_question(user_id, open_question.id, quiz_id)
+    ops.update_last_question(user_id, quiz_id, open_question.id, room_id, True)
+    ops.get_catalog_quiz(quiz_id)
+    if not ops.get_unanswered_question(user_id, quiz_id):
+        ops.unsubscribe_user_from_quiz(user_id, quiz_id)
+
+
+def one_unit(ops, user_id, quiz_id, question_id, room_id):
+    with ops.unit_of_work():
+        separate_commits(ops, user_id, quiz_id, question_id, room_id)
+
+
+def record_answer(ops, user_id, quiz_id, question_id, room_id):
+    with ops.unit_of_work():
+        ops.record_answer(user_id, quiz_id, question_id, room_id)
+
+
+class Counter:
+    def __init__(self, engine):
+        from sqlalchemy import event
+
+        self.commits = 0
+        self.statements = 0
+        event.listen(engine, 'commit', self.on_commit)
+        event.listen(engine, 'before_cursor_execute', self.on_statement)
+
+    def on_commit(self, connection):
+        self.commits += 1
+
+    def on_statement(self, connection, cursor, statement, parameters, context, executemany):
+        self.statements += 1
+
+    def reset(self):
+        self.commits = self.statements = 0
+
+
+def run(ops, counter, variant, args):
+    from store.models import Question, Quiz
+
+    quiz_id = f'quiz-{variant.__name__}'
+    ops.add_quiz_to_db(quiz_model=Quiz(id=quiz_id, name=quiz_id, messages_per_day=1, short_id=0))
+    for index in range(args.questions):
+        ops.add_db_question_to_db(Question(id=f'{quiz_id}-{index}', text='Question', quiz_id=quiz_id,
+                                           is_essay=False, is_multiple_choice=True))
+    users = [(f'@user{index}:localhost', f'!room{index}:localhost') for index in range(args.users)]
+    for user_id, room_id in users:
+        ops.create_user(user_id)
+        ops.subscribe_user_to_quiz(user_id, quiz_id, room_id)
+
+    commits = statements = 0
+    seconds = 0.0
+    for index in range(args.answers):
+        user_id, room_id = users[index % len(users)]
+        with ops.unit_of_work():
+            question = ops.get_unanswered_question(user_id, quiz_id)
+            if question is None:
+                ops.subscribe_user_to_quiz(user_id, quiz_id, room_id)
+                question = ops.get_unanswered_question(user_id, quiz_id)
+            question_id = question.id
+            ops.ask_question_to_user(user_id, quiz_id, question_id, room_id)
+        counter.reset()
+        started = time.perf_counter()
+        variant(ops, user_id, quiz_id, question_id, room_id)
+        seconds += time.perf_counter() - started
+        commits += counter.commits
+        statements += counter.statements
+    return {
+        'commits_per_answer': round(commits / args.answers, 2),
+        'statements_per_answer': round(statements / args.answers, 2),
+        'ms_per_answer': round(seconds / args.answers * 1000, 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--questions', type=int, default=100)
+    parser.add_argument('--answers', type=int, default=500)
+    args = parser.parse_args()
+
+    sys.path.insert(0, PROJECT_DIR)
+    os.chdir(tempfile.mkdtemp(prefix='quizbot-answers-'))
+    os.environ['QUIZBOT_DB_URI'] = f'sqlite:///{os.path.join(os.getcwd(), "quizbot.db")}'
+    from store import db_operations as ops
+    from store.models import engine, ensure_schema
+
+    ensure_schema()
+    counter = Counter(engine)
+    report = {variant.__name__: run(ops, counter, variant, args)
+              for variant in (separate_commits, one_unit, record_answer)}
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+# Compares sync bandwidth, client CPU time and RSS with and without the sync filter against a fake homeserver.
+# Every mode runs in a fresh process, so the RSS numbers are not influenced by the other run.
+# Run from the MatrixChatbotGenerator directory:
+# python -m benchmarks.bench_sync_filter [--rooms 50] [--members 100] [--syncs 20]
+import argparse
+import asyncio
+import multiprocessing
+import resource
+import threading
+import time
+
+from benchmarks.fake_homeserver import FakeHomeserver
+
+
+def run_client(url, filtered, syncs, results):
+    from nio import AsyncClient, AsyncClientConfig
+    from util.sync_filter import upload_sync_filter
+
+    async def sync():
+        client = AsyncClient(url, '@quizbot:localhost', config=AsyncClientConfig(store_sync_tokens=False))
+        await client.login('password')
+        sync_filter = await upload_sync_filter(client) if filtered else None
+        start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        start_cpu = time.process_time()
+        started = time.monotonic()
+        for _ in range(syncs):
+            await client.sync(timeout=0, sync_filter=sync_filter)
+        results.put({
+            'seconds': time.monotonic() - started,
+            'cpu': time.process_time() - start_cpu,
+            'rss': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            'rss_growth': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - start_rss,
+            'members': sum(len(room.users) for room in client.rooms.values()),
+        })
+        await client.close()
+
+    asyncio.run(sync())
+
+
+def start_server(server):
+    loop = asyncio.new_event_loop()
+    url = loop.run_until_complete(server.start())
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    return url
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rooms', type=int, default=50)
+    parser.add_argument('--members', type=int, default=100)
+    parser.add_argument('--syncs', type=int, default=20)
+    args = parser.parse_args()
+
+    server = FakeHomeserver(args.rooms, args.members)
+    url = start_server(server)
+    context = multiprocessing.get_context('spawn')
+    for name, filtered in (('unfiltered', False), ('filtered', True)):
+        server.reset_counters()
+        results = context.Queue()
+        process = context.Process(target=run_client, args=(url, filtered, args.syncs, results))
+        process.start()
+        result = results.get()
+        process.join()
+        print(f'{name:11} {server.bytes_sent / 1024:10.0f} KiB sent  {result["cpu"]:6.2f}s cpu  '
+              f'{result["seconds"]:6.2f}s wall  {result["rss"] / 1024:6.1f} MiB rss '
+              f'(+{result["rss_growth"] / 1024:.1f})  {result["members"]} members kept')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,347 @@
+# Minimal in-memory Matrix homeserver for benchmarks. It implements login, filters, sync, join and send and the
+# key and to-device endpoints needed for end-to-end encryption. With noise it generates what a busy server sends:
+# presence, typing, receipts, account data and full member lists. Without noise the sync only returns the events
+# sent by the clients or injected by the benchmark, long polling like a real server and separately for every
+# logged in device. Sync filters are applied like a real server does, so filtered and unfiltered syncs can be
+# compared.
+import asyncio
+import itertools
+import json
+import time
+
+from aiohttp import web
+
+API = '/_matrix/client/{version}'
+
+
+class FakeHomeserver:
+    def __init__(self, rooms=50, members=100, messages=5, bot='@quizbot:localhost', noise=True):
+        self.room_count = rooms
+        self.member_count = members
+        self.messages = messages  # new timeline messages per room and sync
+        self.bot = bot
+        self.noise = noise
+        self.filters = {}
+        self.batch = 0
+        self.event_ids = itertools.count()
+        self.bytes_sent = 0
+        self.requests = 0
+        self.rooms = {}  # room_id -> members besides the bot, only used without noise
+        self.encrypted = set()  # rooms with encryption enabled
+        self.sessions = {}  # access token -> (user_id, device_id)
+        self.pending = {}  # access token -> room_id -> events not synced yet
+        self.to_device = {}  # access token -> to-device events not synced yet
+        self.changed = {}  # access token -> users whose devices changed since the last sync
+        self.wakeups = {}  # access token -> event set when something is pending
+        self.device_keys = {}  # user_id -> device_id -> device keys
+        self.one_time_keys = {}  # (user_id, device_id) -> key id -> key
+        self.fallback_keys = {}  # (user_id, device_id) -> key id -> key
+        self.on_send = None  # called with room_id and content of every event the client sends
+        self.app = web.Application()
+        self.app.add_routes([
+            web.post(f'{API}/login', self.login),
+            web.get(f'{API}/account/whoami', self.whoami),
+            web.post(API + '/user/{user_id}/filter', self.upload_filter),
+            web.get(f'{API}/sync', self.sync),
+            web.post(API + '/join/{room_id}', self.join),
+            web.post(API + '/rooms/{room_id}/join', self.join),
+            web.get(API + '/rooms/{room_id}/joined_members', self.joined_members),
+            web.put(API + '/rooms/{room_id}/send/{event_type}/{txn_id}', self.send),
+            web.post(f'{API}/keys/upload', self.keys_upload),
+            web.post(f'{API}/keys/query', self.keys_query),
+            web.post(f'{API}/keys/claim', self.keys_claim),
+            web.put(API + '/sendToDevice/{event_type}/{txn_id}', self.send_to_device),
+        ])
+        self.runner = None
+
+    async def start(self, host='127.0.0.1', port=0):
+        self.runner = web.AppRunner(self.app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f'http://{host}:{port}'
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+    def reset_counters(self):
+        self.bytes_sent = 0
+        self.requests = 0
+
+    def respond(self, content):
+        body = json.dumps(content).encode()
+        self.bytes_sent += len(body)
+        self.requests += 1
+        return web.Response(body=body, content_type='application/json')
+
+    @staticmethod
+    def token(request):
+        header = request.headers.get('Authorization', '')
+        return header[len('Bearer '):] if header.startswith('Bearer ') else request.query.get('access_token')
+
+    def session(self, request):
+        return self.sessions.get(self.token(request), (self.bot, None))
+
+    def members(self, room_id):
+        return [self.bot] + self.rooms.get(room_id, [])
+
+    def wake(self, token):
+        if token in self.wakeups:
+            self.wakeups[token].set()
+
+    def deliver(self, room_id, event):
+        members = self.members(room_id)
+        for token, (user_id, _) in self.sessions.items():
+            if user_id in members:
+                self.pending.setdefault(token, {}).setdefault(room_id, []).append(event)
+                self.wake(token)
+
+    async def login(self, request):
+        body = await request.json()
+        user_id = body.get('identifier', {}).get('user') or body.get('user') or self.bot
+        if not user_id.startswith('@'):
+            user_id = f'@{user_id}:localhost'
+        device_id = body.get('device_id') or f'DEVICE{len(self.sessions) + 1}'
+        token = f'token{len(self.sessions) + 1}'
+        self.sessions[token] = (user_id, device_id)
+        self.wakeups[token] = asyncio.Event()
+        return self.respond({'user_id': user_id, 'access_token': token, 'device_id': device_id})
+
+    async def whoami(self, request):
+        user_id, device_id = self.session(request)
+        return self.respond({'user_id': user_id, 'device_id': device_id})
+
+    async def upload_filter(self, request):
+        filter_id = str(len(self.filters) + 1)
+        self.filters[filter_id] = await request.json()
+        return self.respond({'filter_id': filter_id})
+
+    async def join(self, request):
+        room_id = request.match_info['room_id']
+        self.rooms.setdefault(room_id, [])
+        return self.respond({'room_id': room_id})
+
+    async def joined_members(self, request):
+        return self.respond({'joined': {user_id: {} for user_id in self.members(request.match_info['room_id'])}})
+
+    async def send(self, request):
+        content = await request.json()
+        room_id = request.match_info['room_id']
+        user_id, _ = self.session(request)
+        if self.on_send:
+            self.on_send(room_id, content)
+        event = self.event(request.match_info['event_type'], user_id, content)
+        if not self.noise:
+            self.deliver(room_id, event)
+        return self.respond({'event_id': event['event_id']})
+
+    async def keys_upload(self, request):
+        body = await request.json()
+        user_id, device_id = self.session(request)
+        if 'device_keys' in body:
+            first_upload = device_id not in self.device_keys.get(user_id, {})
+            self.device_keys.setdefault(user_id, {})[device_id] = body['device_keys']
+            if first_upload:
+                # Everybody sharing a room with the user has to query the new device
+                for token, (other_user, _) in self.sessions.items():
+                    if any(user_id in members and other_user in members
+                           for members in map(self.members, self.rooms)):
+                        self.changed.setdefault(token, set()).add(user_id)
+                        self.wake(token)
+        self.one_time_keys.setdefault((user_id, device_id), {}).update(body.get('one_time_keys', {}))
+        self.fallback_keys.setdefault((user_id, device_id), {}).update(body.get('fallback_keys', {}))
+        return self.respond({'one_time_key_counts': self.key_counts(user_id, device_id)})
+
+    def key_counts(self, user_id, device_id):
+        counts = {}
+        for key_id in self.one_time_keys.get((user_id, device_id), {}):
+            algorithm = key_id.split(':')[0]
+            counts[algorithm] = counts.get(algorithm, 0) + 1
+        return counts
+
+    async def keys_query(self, request):
+        body = await request.json()
+        device_keys = {}
+        for user_id, devices in body.get('device_keys', {}).items():
+            known = self.device_keys.get(user_id, {})
+            device_keys[user_id] = {device_id: keys for device_id, keys in known.items()
+                                    if not devices or device_id in devices}
+        return self.respond({'device_keys': device_keys, 'failures': {}})
+
+    async def keys_claim(self, request):
+        body = await request.json()
+        claimed = {}
+        for user_id, devices in body.get('one_time_keys', {}).items():
+            for device_id, algorithm in devices.items():
+                keys = self.one_time_keys.get((user_id, device_id), {})
+                key_id = next((key_id for key_id in keys if key_id.startswith(algorithm)), None)
+                if key_id:
+                    key = {key_id: keys.pop(key_id)}
+                else:
+                    key = self.fallback_keys.get((user_id, device_id), {})
+                if key:
+                    claimed.setdefault(user_id, {})[device_id] = key
+        return self.respond({'one_time_keys': claimed, 'failures': {}})
+
+    async def send_to_device(self, request):
+        body = await request.json()
+        sender, _ = self.session(request)
+        event_type = request.match_info['event_type']
+        for user_id, devices in body.get('messages', {}).items():
+            for token, (other_user, other_device) in self.sessions.items():
+                if other_user == user_id:
+                    content = devices.get(other_device, devices.get('*'))
+                    if content is not None:
+                        self.to_device.setdefault(token, []).append(
+                            {'type': event_type, 'sender': sender, 'content': content})
+                        self.wake(token)
+        return self.respond({})
+
+    def add_room(self, room_id, members, encrypted=False):
+        self.rooms[room_id] = list(members)
+        if encrypted:
+            self.encrypted.add(room_id)
+
+    def inject(self, room_id, sender, body):
+        # Queues a text message from a user, it is returned by the next sync
+        event = self.event('m.room.message', sender, {'msgtype': 'm.text', 'body': body})
+        self.deliver(room_id, event)
+        return event['event_id']
+
+    def event(self, event_type, sender, content, state_key=None):
+        event = {'type': event_type, 'sender': sender, 'content': content,
+                 'event_id': f'$event{next(self.event_ids)}', 'origin_server_ts': int(time.time() * 1000)}
+        if state_key is not None:
+            event['state_key'] = state_key
+        return event
+
+    def member(self, room_index, member_index):
+        return f'@user{room_index}_{member_index}:localhost'
+
+    def room_state(self, room_index):
+        state = [self.event('m.room.create', self.bot, {'creator': self.bot}, ''),
+                 self.event('m.room.name', self.bot, {'name': f'Quiz room {room_index}'}, ''),
+                 self.event('m.room.topic', self.bot, {'topic': 'Daily quiz questions ' * 5}, ''),
+                 self.event('m.room.power_levels', self.bot, {'users': {self.bot: 100}}, ''),
+                 self.event('m.room.member', self.bot, {'membership': 'join'}, self.bot)]
+        for member_index in range(self.member_count):
+            user_id = self.member(room_index, member_index)
+            state.append(self.event('m.room.member', user_id,
+                                    {'membership': 'join', 'displayname': f'User {member_index}'}, user_id))
+        return state
+
+    def room_timeline(self, room_index):
+        timeline = []
+        for message_index in range(self.messages):
+            sender = self.member(room_index, message_index % self.member_count)
+            timeline.append(self.event('m.room.message', sender, {'msgtype': 'm.text', 'body': 'A'}))
+            reaction = {'rel_type': 'm.annotation', 'event_id': '$event0', 'key': '+1'}
+            timeline.append(self.event('m.reaction', sender, {'m.relates_to': reaction}))
+        return timeline
+
+    def room_ephemeral(self, room_index):
+        typing = [self.member(room_index, index) for index in range(min(5, self.member_count))]
+        receipts = {f'$event{index}': {'m.read': {user_id: {'ts': 1}}} for index, user_id in enumerate(typing)}
+        return [{'type': 'm.typing', 'content': {'user_ids': typing}},
+                {'type': 'm.receipt', 'content': receipts}]
+
+    def get_filter(self, request):
+        value = request.query.get('filter')
+        if not value:
+            return {}
+        if value in self.filters:
+            return self.filters[value]
+        return json.loads(value)
+
+    @staticmethod
+    def allowed(events, event_filter):
+        types = event_filter.get('types') if event_filter else None
+        if types is None:
+            return events
+        return [event for event in events if event['type'] in types]
+
+    async def sync(self, request):
+        if not self.noise:
+            return await self.event_sync(request)
+        sync_filter = self.get_filter(request)
+        room_filter = sync_filter.get('room', {})
+        initial = 'since' not in request.query
+        self.batch += 1
+        rooms = {}
+        for room_index in range(self.room_count):
+            timeline = self.allowed(self.room_timeline(room_index), room_filter.get('timeline'))
+            limit = room_filter.get('timeline', {}).get('limit')
+            if limit:
+                timeline = timeline[-limit:]
+            state = self.room_state(room_index) if initial else []
+            state = self.allowed(state, room_filter.get('state'))
+            if room_filter.get('state', {}).get('lazy_load_members'):
+                senders = {event['sender'] for event in timeline} | {self.bot}
+                state = [event for event in state
+                         if event['type'] != 'm.room.member' or event['state_key'] in senders]
+            rooms[f'!room{room_index}:localhost'] = {
+                'timeline': {'events': timeline, 'limited': False, 'prev_batch': f'p{self.batch}'},
+                'state': {'events': state},
+                'ephemeral': {'events': self.allowed(self.room_ephemeral(room_index), room_filter.get('ephemeral'))},
+                'account_data': {'events': self.allowed(
+                    [{'type': 'm.fully_read', 'content': {'event_id': '$event0'}}], room_filter.get('account_data'))},
+                'summary': {'m.joined_member_count': self.member_count + 1},
+                'unread_notifications': {'highlight_count': 0, 'notification_count': 0},
+            }
+        presence = [{'type': 'm.presence', 'sender': self.member(0, index),
+                     'content': {'presence': 'online', 'last_active_ago': 1000}}
+                    for index in range(self.member_count)]
+        account_data = [{'type': 'm.push_rules', 'content': {'global': {'content': [], 'override': []}}}]
+        return self.respond({
+            'next_batch': f's{self.batch}',
+            'rooms': {'join': rooms, 'invite': {}, 'leave': {}},
+            'presence': {'events': self.allowed(presence, sync_filter.get('presence'))},
+            'account_data': {'events': self.allowed(account_data, sync_filter.get('account_data'))},
+            'to_device': {'events': []},
+            'device_lists': {'changed': [], 'left': []},
+            'device_one_time_keys_count': {},
+        })
+
+    async def event_sync(self, request):
+        token = self.token(request)
+        user_id, device_id = self.session(request)
+        room_filter = self.get_filter(request).get('room', {})
+        initial = 'since' not in request.query
+        wakeup = self.wakeups.setdefault(token, asyncio.Event())
+        if not initial and not (self.pending.get(token) or self.to_device.get(token) or self.changed.get(token)):
+            timeout = int(request.query.get('timeout', 0)) / 1000
+            wakeup.clear()
+            try:
+                await asyncio.wait_for(wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self.batch += 1
+        pending = self.pending.pop(token, {})
+        rooms = {}
+        joined = [room_id for room_id in self.rooms if user_id in self.members(room_id)]
+        for room_id in (joined if initial else pending):
+            state = []
+            if initial:
+                state = [self.event('m.room.member', member, {'membership': 'join'}, member)
+                         for member in self.members(room_id)]
+                if room_id in self.encrypted:
+                    state.append(self.event('m.room.encryption', self.bot,
+                                            {'algorithm': 'm.megolm.v1.aes-sha2'}, ''))
+            rooms[room_id] = {
+                'timeline': {'events': self.allowed(pending.get(room_id, []), room_filter.get('timeline')),
+                             'limited': False, 'prev_batch': f'p{self.batch}'},
+                'state': {'events': state},
+                'ephemeral': {'events': []},
+                'account_data': {'events': []},
+            }
+        return self.respond({
+            'next_batch': f's{self.batch}',
+            'rooms': {'join': rooms, 'invite': {}, 'leave': {}},
+            'presence': {'events': []},
+            'account_data': {'events': []},
+            'to_device': {'events': self.to_device.pop(token, [])},
+            'device_lists': {'changed': sorted(self.changed.pop(token, set())), 'left': []},
+            'device_one_time_keys_count': self.key_counts(user_id, device_id),
+        })
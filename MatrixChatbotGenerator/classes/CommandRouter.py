@@ -0,0 +1,64 @@
+import time
+
+from util.metrics import registry
+
+command_calls = registry.counter('quizbot_commands_total', 'Number of processed commands', ['command'])
+command_latency = registry.histogram('quizbot_command_duration_seconds', 'Time to process a command', ['command'])
+
+
+class Command:
+    def __init__(self, name, handler, needs_db=True, single_word=False):
+        self.name = name
+        self.handler = handler  # function taking message, room_id, user_id and parameter
+        self.needs_db = needs_db  # False if the handler can run on the event loop
+        self.single_word = single_word  # only matches if the message has no parameter
+
+
+class Route:
+    def __init__(self, command, message, parameter):
+        self.command = command
+        self.message = message
+        self.parameter = parameter
+
+
+class CommandRouter:
+    """
+    Maps the first word of a message to a registered command with a single lookup in a precomputed alias table.
+    Messages that match no command go to the fallback command.
+    """
+
+    def __init__(self, fallback, empty=None):
+        self.aliases = {}  # alias -> Command
+        self.prefixes = []  # (prefix, Command), only tried if no alias matches
+        self.fallback = fallback
+        self.empty = empty if empty else fallback
+
+    def register(self, name, handler, aliases=(), needs_db=True, single_word=False, prefixes=()):
+        command = Command(name, handler, needs_db, single_word)
+        for alias in (name,) + tuple(aliases):
+            self.aliases[alias] = command
+        for prefix in prefixes:
+            self.prefixes.append((prefix, command))
+        return command
+
+    def resolve(self, message):
+        words = message.lower().split()
+        if not words:
+            return Route(self.empty, message, None)
+        first_word = words[0]
+        parameter = message.strip()[len(first_word):].strip() if len(words) > 1 else None
+        command = self.aliases.get(first_word)
+        if command is None:
+            command = next((command for prefix, command in self.prefixes if first_word.startswith(prefix)), None)
+        if command is None or (command.single_word and len(words) > 1):
+            command = self.fallback
+        return Route(command, message, parameter)
+
+    @staticmethod
+    def call(route, room_id, user_id):
+        started = time.monotonic()
+        try:
+            return route.command.handler(route.message, room_id, user_id, route.parameter)
+        finally:
+            command_calls.inc(route.command.name)
+            command_latency.observe(time.monotonic() - started, route.command.name)
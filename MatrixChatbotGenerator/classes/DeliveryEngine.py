@@ -0,0 +1,76 @@
+import asyncio
+import time
+
+from util import utility_functions as util
+from util.token_bucket import TokenBucket
+
+logger = util.create_logger('delivery_engine')
+
+
+class DeliveryEngine:
+    """
+    Sends a batch of messages with a bounded number of sends in flight and a token bucket per homeserver.
+    Sends are started in the order of the batch and at most one message per room is sent per batch.
+    """
+    # Token buckets are shared by all engines talking to the same homeserver
+    buckets = {}
+
+    def __init__(self, homeserver, send, concurrency=10, rate=5, burst=10):
+        self.homeserver = homeserver
+        self.send = send  # coroutine function taking room_id and message
+        self.concurrency = max(1, concurrency)
+        if homeserver not in DeliveryEngine.buckets:
+            DeliveryEngine.buckets[homeserver] = TokenBucket(rate, burst)
+        self.bucket = DeliveryEngine.buckets[homeserver]
+
+    async def deliver(self, messages):
+        """
+        Delivers a batch of messages.
+
+        :param messages: A list of (room_id, message) tuples in delivery order.
+        :return: A dict with the number of sent and failed messages, throughput and latency percentiles. The latency
+                 runs from handing a message to the outbound queue until it is delivered, so it includes queueing,
+                 coalescing and back-off. The duration of the room_send calls alone is the
+                 quizbot_room_send_duration_seconds histogram of the outbound queue.
+        """
+        semaphore = asyncio.Semaphore(self.concurrency)
+        latencies = []
+        failed = []
+        started = time.monotonic()
+
+        async def send_one(room_id, message):
+            async with semaphore:
+                await self.bucket.acquire()
+                send_started = time.monotonic()
+                try:
+                    await self.send(room_id, message)
+                except Exception as e:
+                    failed.append(room_id)
+                    logger.error(f"Sending to room id {room_id} failed: {e}")
+                latencies.append(time.monotonic() - send_started)
+
+        tasks = []
+        rooms = set()
+        for room_id, message in messages:
+            if room_id in rooms:
+                logger.warning(f"Skipping second message for room id {room_id} in the same batch")
+                continue
+            rooms.add(room_id)
+            # Tasks are started in creation order, so the semaphore and bucket are acquired in batch order
+            tasks.append(asyncio.ensure_future(send_one(room_id, message)))
+        if tasks:
+            await asyncio.gather(*tasks)
+
+        elapsed = time.monotonic() - started
+        stats = {
+            'sent': len(tasks) - len(failed),
+            'failed': len(failed),
+            'seconds': elapsed,
+            'throughput': (len(tasks) / elapsed) if elapsed > 0 else 0.0,
+            'queued_p50': util.percentile(latencies, 50),
+            'queued_p99': util.percentile(latencies, 99)
+        }
+        logger.info(f"Delivered {stats['sent']} messages ({stats['failed']} failed) in {elapsed:.2f}s, "
+                    f"{stats['throughput']:.1f} msg/s, latency including the outbound queue "
+                    f"p50 {stats['queued_p50'] * 1000:.0f}ms, p99 {stats['queued_p99'] * 1000:.0f}ms")
+        return stats
@@ -0,0 +1,76 @@
+from collections import OrderedDict
+
+from util.metrics import registry
+from util.token_bucket import TokenBucket
+
+throttled_messages = registry.counter('quizbot_throttled_messages_total', 'Messages dropped by the flood control',
+                                      ['scope'])
+
+USER = 'user'
+ROOM = 'room'
+
+
+class FloodControl:
+    """
+    Token buckets per user and per room in front of the command path. A message is only processed if both the
+    bucket of the user and the bucket of the room have a token, so a single user or room cannot monopolize the
+    database session. Buckets of idle users and rooms are dropped when more than max_buckets are tracked.
+    A rate of 0 disables the limit.
+    """
+
+    def __init__(self, user_rate=0.5, user_burst=5, room_rate=5, room_burst=20, max_buckets=10000):
+        self.user_rate = user_rate
+        self.user_burst = user_burst
+        self.room_rate = room_rate
+        self.room_burst = room_burst
+        self.max_buckets = max_buckets
+        self.users = OrderedDict()  # user_id -> TokenBucket
+        self.rooms = OrderedDict()  # room_id -> TokenBucket
+        self.notified = set()  # throttled users that were told to slow down
+
+    def bucket(self, buckets, key, rate, burst):
+        bucket = buckets.get(key)
+        if bucket is None:
+            bucket = buckets[key] = TokenBucket(rate, burst)
+            while len(buckets) > self.max_buckets:
+                buckets.popitem(last=False)
+        else:
+            buckets.move_to_end(key)
+        return bucket
+
+    def check(self, room_id, user_id):
+        """
+        Takes a token for the message if the user and the room are within their limits.
+        :param room_id: room the message was sent to
+        :param user_id: sender of the message
+        :return: None if the message may be processed, otherwise the scope of the limit that was hit
+        """
+        user_bucket = self.bucket(self.users, user_id, self.user_rate, self.user_burst) if self.user_rate else None
+        room_bucket = self.bucket(self.rooms, room_id, self.room_rate, self.room_burst) if self.room_rate else None
+        scope = None
+        if user_bucket:
+            user_bucket.refill()
+            if user_bucket.tokens < 1:
+                scope = USER
+        if room_bucket and not scope:
+            room_bucket.refill()
+            if room_bucket.tokens < 1:
+                scope = ROOM
+        if scope:
+            throttled_messages.inc(scope)
+            return scope
+        if user_bucket:
+            user_bucket.tokens -= 1
+        if room_bucket:
+            room_bucket.tokens -= 1
+        self.notified.discard(user_id)
+        return None
+
+    def should_notify(self, user_id):
+        # Only the first throttled message of a user gets an answer, the following ones are dropped silently
+        if user_id in self.notified:
+            return False
+        if len(self.notified) >= self.max_buckets:
+            self.notified.clear()
+        self.notified.add(user_id)
+        return True
@@ -0,0 +1,185 @@
+import asyncio
+import time
+
+from nio import ErrorResponse
+
+from util import utility_functions as util
+from util.metrics import registry
+
+logger = util.create_logger('outbound_queue')
+
+queue_depth = registry.gauge('quizbot_outbound_queue_depth', 'Messages waiting to be sent')
+send_latency = registry.histogram('quizbot_room_send_duration_seconds', 'Duration of room_send calls')
+delivery_latency = registry.histogram('quizbot_outbound_delivery_seconds', 'Time from enqueueing to delivery')
+send_failures = registry.counter('quizbot_room_send_failures_total', 'Failed room_send calls', ['reason'])
+coalesced_messages = registry.counter('quizbot_outbound_coalesced_total', 'Messages merged into another event')
+
+
+class OutboundQueue:
+    """
+    Queue for outgoing messages. Messages waiting for the same room are merged into one event, so a room
+    never has more than one send in flight and the order within a room is kept. A merged event is kept below
+    max_body_bytes, Matrix rejects events over 64 KiB and encryption makes the body about a third larger.
+    When the homeserver answers with M_LIMIT_EXCEEDED all sends pause for the time the server asks for before the
+    message is retried.
+    """
+
+    def __init__(self, client, concurrency=10, max_attempts=5, separator='\n\n', max_body_bytes=32 * 1024):
+        self.client = client
+        self.concurrency = max(1, concurrency)
+        self.max_attempts = max_attempts
+        self.separator = separator
+        self.max_body_bytes = max_body_bytes
+        self.pending = {}  # room_id -> list of (message, future, enqueued timestamp)
+        self.in_flight = {}  # room_id -> list of (message, future, enqueued timestamp) being sent
+        self.active = set()  # rooms that are queued or being sent
+        self.ready = None
+        self.workers = []
+        self.paused_until = 0.0
+
+    def start(self):
+        if not self.workers:
+            self.ready = asyncio.Queue()
+            self.workers = [asyncio.ensure_future(self.worker()) for _ in range(self.concurrency)]
+
+    def depth(self):
+        return sum(len(messages) for messages in self.pending.values())
+
+    def enqueue(self, room_id, message):
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self.pending.setdefault(room_id, []).append((message, future, time.monotonic()))
+        if room_id not in self.active:
+            self.active.add(room_id)
+            self.ready.put_nowait(room_id)
+        queue_depth.set(self.depth())
+        return future
+
+    async def send(self, room_id, message):
+        # Waits until the message is delivered, raises an exception if it could not be delivered
+        await self.enqueue(room_id, message)
+
+    def split(self, message):
+        # Splits a message longer than max_body_bytes, at a line break if there is one
+        data = message.encode('utf-8')
+        parts = []
+        while len(data) > self.max_body_bytes:
+            cut = data.rfind(b'\n', 0, self.max_body_bytes + 1)
+            if cut <= 0:
+                cut = self.max_body_bytes
+                while (data[cut] & 0xC0) == 0x80:  # not inside a UTF-8 character
+                    cut -= 1
+            parts.append(data[:cut].decode('utf-8'))
+            data = data[cut:].lstrip(b'\n')
+        parts.append(data.decode('utf-8'))
+        return parts
+
+    def batches(self, messages):
+        """
+        Merges the waiting messages of a room into as few events as the size limit allows.
+
+        :param messages: list of (message, future, enqueued timestamp) in the order they were enqueued
+        :return: list of (body, messages contained in the body), a split message is contained in several bodies
+        """
+        batches = []
+        size = 0
+        separator = len(self.separator.encode('utf-8'))
+        for entry in messages:
+            for part in self.split(entry[0]):
+                length = len(part.encode('utf-8'))
+                if batches and size + separator + length <= self.max_body_bytes:
+                    batches[-1][0].append(part)
+                    size += separator + length
+                else:
+                    batches.append(([part], []))
+                    size = length
+                if not batches[-1][1] or batches[-1][1][-1] is not entry:
+                    batches[-1][1].append(entry)
+        return [(self.separator.join(parts), entries) for parts, entries in batches]
+
+    async def worker(self):
+        while True:
+            room_id = await self.ready.get()
+            messages = self.pending.pop(room_id, [])
+            self.in_flight[room_id] = messages
+            queue_depth.set(self.depth())
+            try:
+                batches = self.batches(messages)
+                if len(messages) > len(batches):
+                    coalesced_messages.inc(amount=len(messages) - len(batches))
+                # A message is delivered once its last part is sent
+                last_batch = {id(entry): index for index, (_, entries) in enumerate(batches) for entry in entries}
+                for index, (body, entries) in enumerate(batches):
+                    error = await self.deliver(room_id, body)
+                    now = time.monotonic()
+                    for entry in entries:
+                        _, future, enqueued = entry
+                        if future.done():
+                            continue
+                        if error:
+                            future.set_exception(error)
+                        elif last_batch[id(entry)] == index:
+                            delivery_latency.observe(now - enqueued)
+                            future.set_result(True)
+            finally:
+                self.in_flight.pop(room_id, None)
+                # Messages that arrived while sending go out in the next event for the room
+                if room_id in self.pending:
+                    self.ready.put_nowait(room_id)
+                else:
+                    self.active.discard(room_id)
+
+    async def deliver(self, room_id, body):
+        attempts = 0
+        while True:
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            started = time.monotonic()
+            try:
+                response = await self.client.room_send(
+                    room_id,
+                    message_type="m.room.message",
+                    content={"msgtype": "m.text", "body": body},
+                    ignore_unverified_devices=True
+                )
+            except Exception as e:
+                response = e
+            send_latency.observe(time.monotonic() - started)
+            if not isinstance(response, (ErrorResponse, Exception)):
+                return None
+            if isinstance(response, ErrorResponse) and response.status_code == 'M_LIMIT_EXCEEDED':
+                retry_after = (response.retry_after_ms or 5000) / 1000
+                self.paused_until = max(self.paused_until, time.monotonic() + retry_after)
+                send_failures.inc('rate_limited')
+                logger.warning(f"Rate limited sending to room id {room_id}, retrying in {retry_after:.1f}s")
+                continue
+            attempts += 1
+            send_failures.inc('error')
+            if attempts >= self.max_attempts:
+                logger.error(f"Giving up sending to room id {room_id} after {attempts} attempts: {response}")
+                return RuntimeError(f'Sending to room {room_id} failed: {response}')
+            logger.warning(f"Sending to room id {room_id} failed: {response}, retrying")
+            await asyncio.sleep(min(30, 2 ** attempts))
+
+    def futures(self):
+        return [future for messages in list(self.pending.values()) + list(self.in_flight.values())
+                for _, future, _ in messages if not future.done()]
+
+    async def drain(self, timeout=10):
+        # Waits until all queued messages and the sends in flight are finished or the timeout expired
+        futures = self.futures()
+        if futures:
+            await asyncio.wait(futures, timeout=timeout)
+
+    def stop(self):
+        for worker in self.workers:
+            worker.cancel()
+        self.workers = []
+        # Messages that were not sent by now are given up, their senders are not left waiting
+        for future in self.futures():
+            future.cancel()
+        self.pending.clear()
+        self.in_flight.clear()
+        self.active.clear()
+        queue_depth.set(0)
@@ -3,12 +3,28 @@ import re
 from dotenv import load_dotenv
 
 from store.db_operations import *
-from nio import AsyncClient, MatrixRoom, RoomMessageText, SyncResponse, LoginResponse, InviteMemberEvent, MegolmEvent
+from classes.CommandRouter import Command, CommandRouter
+from classes.DeliveryEngine import DeliveryEngine
+from classes.FloodControl import FloodControl, USER
+from classes.OutboundQueue import OutboundQueue
+from classes.QuizScheduler import QuizScheduler
+from nio import AsyncClient, AsyncClientConfig, MatrixRoom, RoomMessageText, SyncResponse, LoginResponse, \
+    InviteMemberEvent, MegolmEvent, WhoamiError
+from nio.crypto import ENCRYPTION_ENABLED
 from util import utility_functions as util
+from util.metrics import registry, start_http_server
+from util.sync_filter import upload_sync_filter
+from util.sync_token_store import SyncTokenStore
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import asyncio
+import functools
 import json
 import os
 import signal
+import socket
+import time
+import uuid
 
 # Set up logging
 logger = util.create_logger('quizbot')
@@ -17,15 +33,80 @@ load_dotenv()
 MATRIX_HOST = os.getenv('MATRIX_HOST')
 MATRIX_USER = os.getenv('MATRIX_USER')
 MATRIX_PASSWORD = os.getenv('MATRIX_PASSWORD')
+MATRIX_STORE_PATH = os.getenv('MATRIX_STORE_PATH', './data/store')  # crypto store, keeps the device keys
+MATRIX_DEVICE_NAME = os.getenv('MATRIX_DEVICE_NAME', 'Quizbot')
+DELIVERY_CONCURRENCY = int(os.getenv('DELIVERY_CONCURRENCY', 10))  # room_send calls in flight
+DELIVERY_RATE = float(os.getenv('DELIVERY_RATE', 5))  # messages per second and homeserver
+DELIVERY_BURST = int(os.getenv('DELIVERY_BURST', 10))
+QUIZ_WINDOW_START = os.getenv('QUIZ_WINDOW_START', '09:00')  # questions are only sent within this window
+QUIZ_WINDOW_END = os.getenv('QUIZ_WINDOW_END', '20:00')
+QUIZ_JITTER = float(os.getenv('QUIZ_JITTER', 0.2))  # fraction of the time between two questions
+DB_WORKERS = int(os.getenv('DB_WORKERS', 1))  # threads running database work, SQLite serializes writes anyway
+MAX_CONCURRENT_COMMANDS = int(os.getenv('MAX_CONCURRENT_COMMANDS', 20))  # commands queued for the DB executor
+SYNC_TOKEN_FLUSH_INTERVAL = int(os.getenv('SYNC_TOKEN_FLUSH_INTERVAL', 30))  # seconds between token writes
+SHARD_LEASE_SECONDS = int(os.getenv('SHARD_LEASE_SECONDS', 60))  # a dead worker's shard is free after this time
+OUTBOUND_CONCURRENCY = int(os.getenv('OUTBOUND_CONCURRENCY', 10))  # rooms sent to at the same time
+OUTBOUND_MAX_ATTEMPTS = int(os.getenv('OUTBOUND_MAX_ATTEMPTS', 5))  # attempts before a message is dropped
+STALE_EVENT_CUTOFF = int(os.getenv('STALE_EVENT_CUTOFF', 900))  # messages older than this are skipped, 0 keeps all
+PROCESSED_EVENTS_MAX = int(os.getenv('PROCESSED_EVENTS_MAX', 10000))  # event ids remembered to skip replays
+METRICS_PORT = int(os.getenv('METRICS_PORT', 0))  # port of the metrics listener, 0 disables it
+METRICS_HOST = os.getenv('METRICS_HOST', '127.0.0.1')
+PRELOAD_BUDGET = float(os.getenv('PRELOAD_BUDGET', 5))  # seconds spent preloading questions at startup
+FLOOD_USER_RATE = float(os.getenv('FLOOD_USER_RATE', 0.5))  # messages per second a user may send, 0 disables
+FLOOD_USER_BURST = int(os.getenv('FLOOD_USER_BURST', 5))
+FLOOD_ROOM_RATE = float(os.getenv('FLOOD_ROOM_RATE', 5))  # messages per second in a room, 0 disables
+FLOOD_ROOM_BURST = int(os.getenv('FLOOD_ROOM_BURST', 20))
+
+sync_latency = registry.histogram('quizbot_sync_duration_seconds', 'Duration of sync requests including the long poll',
+                                  buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 45.0, 60.0))
+sync_events = registry.histogram('quizbot_sync_events', 'Timeline and invite events per sync',
+                                 buckets=(0, 1, 5, 10, 50, 100, 500, 1000, 5000))
+last_sync = registry.gauge('quizbot_last_sync_timestamp_seconds', 'Unix time of the last successful sync')
+db_latency = registry.histogram('quizbot_db_duration_seconds', 'Time spent in database work', ['operation'])
+db_wait = registry.histogram('quizbot_db_wait_seconds', 'Time database work waited for the DB executor')
 
 
 class Quizbot:
-    def __init__(self):
+    def __init__(self, worker_count=1, shard_index=0):
         # self.config = ChatbotConfig()
+        # In sharded mode every worker only handles the rooms of its shard
+        self.worker_count = worker_count
+        self.shard_index = shard_index
+        self.lease_owner = f'{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}'
+        self.lease_expires = None
+        if worker_count > 1:
+            # The state of a user is changed by every worker owning one of the user's rooms
+            user_state_cache.disable()
+            logger.info("User state cache disabled for sharded workers")
         self.homeserver = MATRIX_HOST
         self.user = MATRIX_USER
         self.password = MATRIX_PASSWORD
-        self.client = AsyncClient(self.homeserver, self.user)
+        # The sync token is kept by the SyncTokenStore, nio does not need to store it.
+        # Encryption needs the olm dependencies of matrix-nio[e2e], without them encrypted rooms are not supported.
+        self.encryption = ENCRYPTION_ENABLED
+        if self.encryption:
+            os.makedirs(MATRIX_STORE_PATH, exist_ok=True)
+        else:
+            logger.warning("Encryption dependencies are not installed, encrypted rooms are not supported")
+        self.client = AsyncClient(self.homeserver, self.user, store_path=MATRIX_STORE_PATH if self.encryption else '',
+                                  config=AsyncClientConfig(store_sync_tokens=False, encryption_enabled=self.encryption))
+        # The device is reused across restarts, so clients do not have to share keys with a new device
+        self.credentials_file = './data/credentials.json' if worker_count == 1 \
+            else f'./data/credentials_{shard_index}.json'
+        self.requested_sessions = set()
+        self.recent_events = OrderedDict()  # ids of events answered by DB-free commands
+        self.sync_filter = None
+        self.outbound = OutboundQueue(self.client, OUTBOUND_CONCURRENCY, OUTBOUND_MAX_ATTEMPTS)
+        self.delivery_engine = DeliveryEngine(self.homeserver, self.send_message, DELIVERY_CONCURRENCY,
+                                              DELIVERY_RATE, DELIVERY_BURST)
+        # All database work runs on this executor so the event loop only does network I/O.
+        # Every call runs in its own unit of work on a session of the executor thread.
+        self.db_executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix='quizbot-db')
+        self.flood_control = FloodControl(FLOOD_USER_RATE, FLOOD_USER_BURST, FLOOD_ROOM_RATE, FLOOD_ROOM_BURST)
+        self.command_semaphore = None
+        self.command_tasks = set()
+        self.router = self.register_commands()
+        self.scheduler = QuizScheduler(self.send_quiz_questions, QUIZ_WINDOW_START, QUIZ_WINDOW_END, QUIZ_JITTER)
         print(self.homeserver)
         print(self.user)
         print(self.password)
@@ -33,7 +114,9 @@ class Quizbot:
         # logger.info(self.config.get())
 
         # Path to store the next_batch token
-        self.next_batch_file = './data/next_batch_token.json'
+        self.next_batch_file = './data/next_batch_token.json' if worker_count == 1 \
+            else f'./data/next_batch_token_{shard_index}.json'
+        self.sync_tokens = SyncTokenStore(self.next_batch_file, SYNC_TOKEN_FLUSH_INTERVAL)
         self.load_next_batch()
 
     @staticmethod
@@ -52,7 +135,7 @@ class Quizbot:
 
     @staticmethod
     def quizzes_list():
-        quizzes = get_all_quizzes()
+        quizzes = get_quiz_catalog().quizzes
         if len(quizzes) == 0:
             return 'There are no quizzes available.'
         result = 'Enter "subscribe" and the quiz number or name to subscribe to a Quiz.\n' \
@@ -65,12 +148,13 @@ class Quizbot:
         quiz_id = self.get_quiz_id_by_number_or_name(parm)
         if not quiz_id:
             return 'This Quiz does not exist.'
-        quiz = get_quiz_by_id(quiz_id)
+        quiz = get_catalog_quiz(quiz_id)
         if not user_exists(user_id):
             create_user(user_id)
         if is_user_subscribed(user_id, quiz_id):
             return f'You are already subscribed to the Quiz "{quiz.name}".'
         if subscribe_user_to_quiz(user_id, quiz_id, room_id):
+            self.scheduler.schedule(user_id, quiz_id, room_id, quiz.messages_per_day)
             return f'You have successfully subscribed to the Quiz "{quiz.name}".'
         else:
             return "I'm sorry, that didn't work."
@@ -90,10 +174,11 @@ class Quizbot:
         quiz_id = self.get_quiz_id_by_number_or_name(quiz_name)
         if not quiz_id:
             return 'This Quiz does not exist.'
-        quiz = get_quiz_by_id(quiz_id)
+        quiz = get_catalog_quiz(quiz_id)
         if not is_user_subscribed(user_id, quiz_id):
             return f'You are not subscribed to the Quiz "{quiz.name}".'
         if unsubscribe_user_from_quiz(user_id, quiz_id):
+            self.scheduler.unschedule(user_id, quiz_id)
             return f'You have successfully unsubscribed from the Quiz "{quiz.name}".'
         else:
             return "I'm sorry, that didn't work."
@@ -114,70 +199,64 @@ class Quizbot:
             return self.ask_question(quiz_id, user_id, question, room_id)
         else:
             unsubscribe_user_from_quiz(user_id, quiz_id)
+            self.scheduler.unschedule(user_id, quiz_id)
             return 'There is no question left i could ask you.'
 
     @staticmethod
     def ask_question(quiz_id, user_id, db_question, room_id):
-        question = convert_question_model_to_question(db_question)
-        if ask_question_to_user(user_id, quiz_id, question.id, room_id):
-            return question.get()
+        question = get_cached_question(db_question.id, quiz_id)
+        if question and ask_question_to_user(user_id, quiz_id, question.id, room_id):
+            return question.body
         else:
             return 'There was an unexpected error trying to ask a question.'
 
     def process_answer(self, user_id, message, room_id):
-        open_question = get_open_question(user_id)
-        question = convert_question_model_to_question(open_question)
+        open_question = get_open_question_key(user_id, room_id)
+        if not open_question:
+            return 'You have no open question.'
+        quiz_id, question_id = open_question
+        question = get_cached_question(question_id, quiz_id)
+        if question is None:
+            # The question was deleted since it was asked or the cached state of the user is stale
+            user_state_cache.invalidate(user_id)
+            return 'You have no open question.'
         response = ' '
 
-        if open_question.is_essay:
+        if question.is_essay:
             response = self.check_essay_answer(question, message)
-        elif open_question.is_multiple_choice:
+        elif question.is_multiple_choice:
             response = self.check_multiple_choice_answer(message, question)
 
-        update_user_asked_question(user_id, question.id)
-        update_last_question(user_id, open_question.quiz_id, question.id, room_id, True)
-        quiz = get_quiz_by_id(open_question.quiz_id)
-        if not get_unanswered_question(user_id, open_question.quiz_id):
+        # Marks the question as answered and ends the subscription after the last question in one transaction
+        if record_answer(user_id, quiz_id, question.id, room_id):
+            quiz = get_catalog_quiz(quiz_id)
             response += f'\nCongratulations, you have completed the quiz "{quiz.name}".'
-            unsubscribe_user_from_quiz(user_id, open_question.quiz_id)
+            self.scheduler.unschedule(user_id, quiz_id)
         return response
 
     def check_essay_answer(self, question, user_answer):
-        model_answer = get_model_answer(question.id)
         response = 'Thanks for answering the open question. '
 
-        if not model_answer:
+        if 'Model' not in question.feedback:
             response += 'No model answer available to compare.'
             return response
-        if model_answer and model_answer.text:
-            response += f'Here is a model answer:\n{model_answer.text}'
+        model_answer = question.feedback['Model']
+        if model_answer:
+            response += f'Here is a model answer:\n{model_answer}'
         return response
 
-    def check_multiple_choice_answer(self, user_input, question):
-        # Create answer map
-        answer_map = self.create_answers_map(question.answers)
-        # Separate correct and incorrect answers
-        correct_answers = {answer.identifier.lower() for answer in question.answers if answer.correct}
-
-        # Normalize the user input
-        user_answers = self.normalize_user_input(user_input, question)
-        user_answers_set = set(user_answers)
-        # Determine the result
-        if user_answers_set == correct_answers:
-            result = "Correct"
-        elif user_answers_set & correct_answers:
-            result = "Partly Correct"
-        else:
-            result = "Incorrect"
-        fb = get_feedback(question.id, True if result == 'Correct' else False)
+    @staticmethod
+    def check_multiple_choice_answer(user_input, question):
+        result = question.matcher.evaluate(user_input)
+        fb = question.get_feedback(True if result == 'Correct' else False)
         if result == 'Correct':
             response = 'You gave the correct answer.\n'
         elif result == 'Partly Correct':
             response = 'Your answer is partly correct. \n'
         else:
             response = 'Your answer is incorrect. \n'
-        if fb and fb.text:
-            response += fb.text
+        if fb:
+            response += fb
         else:
             if result != 'Correct':
                 response += 'The correct answer is: \n'
@@ -213,120 +292,237 @@ class Quizbot:
         if numbers:
             quiz_name = parm.rsplit(numbers[-1], 1)[0].strip()
             quiz_id = self.get_quiz_id_by_number_or_name(quiz_name)
-            quiz = get_quiz_by_id(quiz_id)
+            quiz = get_catalog_quiz(quiz_id)
             if not quiz:
                 return 'I could not find the quiz.'
         if not messages_per_day or not isinstance(messages_per_day, int) \
                 or messages_per_day < 0 or messages_per_day > 10:
             return 'It seems you entered an invalid number'
         if update_messages_per_day(user_id, quiz_id, messages_per_day):
+            self.scheduler.update_messages_per_day(user_id, quiz_id, messages_per_day)
             return f'You will now receive {messages_per_day} messages per day for the quiz "{quiz.name}".'
         else:
             return "I'm sorry, that didn't work."
 
     @staticmethod
     def get_quiz_id_by_number_or_name(parm):
-        quiz_id = get_quiz_id_by_name(parm)
-        if not quiz_id:
-            quiz_id = get_quiz_id_by_short_id(parm)
-        return quiz_id if quiz_id else None
+        quiz = find_catalog_quiz(parm)
+        return quiz.id if quiz else None
+
+    def prepare_scheduled_questions(self, due):
+        states = {(state.user_id, state.quiz_id): state
+                  for state in get_subscription_states(datetime.now(), {user_id for user_id, _ in due})}
+        messages = []
+        outcomes = {}
+        notified_rooms = set()
+        for user_id, quiz_id in due:
+            state = states.get((user_id, quiz_id))
+            if not state:
+                continue
+            delivered = False
+            # Only one question per room at a time, the scheduler puts the largest quota deficit of a room first
+            if state.asked_today < state.messages_per_day and not state.open_in_quiz \
+                    and not state.open_in_room and state.room_id not in notified_rooms:
+                question = get_unanswered_question(user_id, quiz_id)
+                if question:
+                    messages.append((state.room_id, self.ask_question(quiz_id, user_id, question, state.room_id)))
+                    notified_rooms.add(state.room_id)
+                    delivered = True
+            outcomes[(user_id, quiz_id)] = (state.asked_today + (1 if delivered else 0), delivered)
+        return messages, outcomes
+
+    async def send_quiz_questions(self, due):
+        if not self.has_lease():
+            raise RuntimeError(f'The lease of shard {self.shard_index} is not held')
+        messages, outcomes = await self.run_db(self.prepare_scheduled_questions, due)
+        logger.info(f"Scheduler is sending {len(messages)} questions for {len(due)} due subscriptions")
+        try:
+            await self.claim_missing_sessions({room_id for room_id, _ in messages})
+        except Exception as e:
+            logger.error(f"Claiming keys failed: {e}")
+        await self.delivery_engine.deliver(messages)
+        return outcomes
+
+    def owns_room(self, room_id):
+        return self.worker_count == 1 or util.room_shard(room_id, self.worker_count) == self.shard_index
+
+    def has_lease(self):
+        if self.worker_count == 1:
+            return True
+        return self.lease_expires is not None and util.utc_now() < self.lease_expires
+
+    async def hold_lease(self):
+        # Acquires the lease of the shard and keeps renewing it, a restarted worker waits until the old lease expired
+        while True:
+            try:
+                expires = await self.run_db(acquire_shard_lease, self.shard_index, self.worker_count,
+                                            self.lease_owner, SHARD_LEASE_SECONDS)
+            except Exception as e:
+                logger.error(f"Renewing the lease of shard {self.shard_index}/{self.worker_count} failed: {e}")
+                expires = None
+            if expires and not self.lease_expires:
+                logger.info(f"Acquired lease of shard {self.shard_index}/{self.worker_count}")
+            elif not expires and self.lease_expires:
+                logger.error(f"Lost lease of shard {self.shard_index}/{self.worker_count}")
+            self.lease_expires = expires
+            await asyncio.sleep(SHARD_LEASE_SECONDS / 3)
+
+    async def run_db(self, func, *args, operation=None):
+        # Runs blocking database work on the DB executor, operation labels its latency and defaults to the name of
+        # the function
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.db_executor, functools.partial(
+            self.timed_db, time.monotonic(), operation or getattr(func, '__name__', 'unknown'), func, *args))
 
     @staticmethod
-    def get_users_to_notify():
-        quizzes = get_all_quizzes()
-        users_to_notify = []
-        notified_rooms = set()
-        for quiz in quizzes:
-            quiz_id = quiz.id
-            messages_per_day = quiz.messages_per_day
-            subscribed_users = get_subscribed_users(quiz_id)
-
-            for user in subscribed_users:
-                room_id = get_subscribed_room(user.id, quiz_id)
-                if room_id in notified_rooms:
-                    continue
-                if get_asked_questions_count_on_date(user.id, quiz_id, datetime.now()) < get_messages_per_day(quiz_id,
-                                                                                                              user.id) \
-                        and not has_open_question(user.id, quiz_id) \
-                        and not has_open_question(user.id, None, room_id):
-                    users_to_notify.append((user.id, quiz_id, room_id))
-                    notified_rooms.add(room_id)
-
-        return users_to_notify
-
-    async def send_quiz_questions(self):
-        users_to_notify = self.get_users_to_notify()
-        logger.info(f"Periodic Task found {len(users_to_notify)} users to be notified")
-        for user_id, quiz_id, room_id in users_to_notify:
-            question = get_unanswered_question(user_id, quiz_id)
-            if question:
-                message = self.ask_question(quiz_id, user_id, question, room_id)
-                await self.send_message(room_id, message)
+    def timed_db(queued, operation, func, *args):
+        started = time.monotonic()
+        db_wait.observe(started - queued)
+        try:
+            with unit_of_work():
+                return func(*args)
+        finally:
+            db_latency.observe(time.monotonic() - started, operation)
+
+    async def handle_message(self, message, room_id, user_id, event_id=None):
+        route = self.router.resolve(message)
+        command = route.command.name
+        started = time.monotonic()
+        try:
+            async with self.command_semaphore:
+                waited = time.monotonic() - started
+                if route.command.needs_db:
+                    response_message = await self.run_db(self.process_event, route, room_id, user_id, event_id,
+                                                         operation=command)
+                elif event_id in self.recent_events:
+                    response_message = None
+                else:
+                    self.remember_event(event_id)
+                    response_message = self.router.call(route, room_id, user_id)
+                if response_message is None:
+                    logger.info(f"Skipping already processed event {event_id}")
+                    return
+            logger.info(f"Processed command '{command}' in {(time.monotonic() - started) * 1000:.1f}ms "
+                        f"(waited {waited * 1000:.1f}ms)")
+            await self.send_message(room_id, response_message)
+        except Exception as e:
+            logger.error(f"Processing message from user {user_id} failed: {e}")
+
+    def process_event(self, route, room_id, user_id, event_id):
+        # Events replayed after a restart were already answered, the event is recorded in the unit of work of the
+        # command, so it is only recorded if the command succeeded
+        if event_id and not record_processed_event(event_id, room_id, PROCESSED_EVENTS_MAX):
+            return None
+        return self.router.call(route, room_id, user_id)
+
+    def remember_event(self, event_id):
+        # DB-free commands are cheap to answer again, their events are only deduplicated in memory
+        if event_id:
+            self.recent_events[event_id] = None
+            while len(self.recent_events) > PROCESSED_EVENTS_MAX:
+                self.recent_events.popitem(last=False)
 
     async def send_message(self, room_id, message):
         logger.info(f"sending message to room id {room_id}: {message}")
-        await self.client.room_send(
-            room_id,
-            message_type="m.room.message",
-            content={"msgtype": "m.text", "body": message}
+        await self.outbound.send(room_id, message)
+
+    def register_commands(self):
+        router = CommandRouter(
+            fallback=Command('answer', lambda message, room_id, user_id, parm: self.answer(message, room_id, user_id)),
+            empty=Command('unknown', lambda message, room_id, user_id, parm: self.message_unknown(), needs_db=False)
         )
+        router.register('hello', lambda message, room_id, user_id, parm: 'Hello!', needs_db=False,
+                        prefixes=('hello', 'hi', 'hey', 'hallo'))
+        router.register('help', lambda message, room_id, user_id, parm: self.message_help(), aliases=('!help',),
+                        needs_db=False, single_word=True)
+        router.register('quizzes', lambda message, room_id, user_id, parm: self.quizzes_list(),
+                        aliases=('!quizzes',), single_word=True)
+        router.register('subscribe', lambda message, room_id, user_id, parm: self.subscribe(user_id, room_id, parm),
+                        aliases=('!subscribe', '!sub'))
+        router.register('unsubscribe', lambda message, room_id, user_id, parm: self.unsubscribe(user_id, parm),
+                        aliases=('!unsubscribe', '!unsub'))
+        router.register('subscribed', lambda message, room_id, user_id, parm: self.subscribed_quizzes(user_id),
+                        aliases=('!subscribed',))
+        router.register('nextquestion', lambda message, room_id, user_id, parm: self.next_question(user_id, parm,
+                                                                                                   room_id),
+                        aliases=('!nextquestion', '!nq'))
+        router.register('delete', lambda message, room_id, user_id, parm: self.delete_quiz(parm), aliases=('!delete',))
+        router.register('reset', lambda message, room_id, user_id, parm: self.reset_quiz(user_id, parm),
+                        aliases=('!reset',))
+        router.register('messages', lambda message, room_id, user_id, parm: self.update_messages_per_day(user_id,
+                                                                                                         parm),
+                        aliases=('!messages',))
+        return router
 
-    def process_message(self, message, room_id, user_id):
-        message_lower = message.lower()
-        words = message_lower.split()
-        command = words[0]
-        parameter = message[len(words[0]):].strip() if len(words) > 1 else None
-
-        if command.startswith('hello') or command.startswith('hi') or command.startswith('hey') \
-                or command.startswith('hallo'):
-            return "Hello!"
-        elif command in ('help', '!help') and len(words) == 1:
-            return self.message_help()
-        elif command in ('quizzes', '!quizzes') and len(words) == 1:
-            return self.quizzes_list()
-        elif command in ('subscribe', '!subscribe', 'unsubscribe', '!unsubscribe', '!sub', '!unsub'):
-            if command in ('subscribe', '!subscribe', '!sub'):
-                return self.subscribe(user_id, room_id, parameter)
-            else:
-                return self.unsubscribe(user_id, parameter)
-        elif command in ('subscribed', '!subscribed'):
-            return self.subscribed_quizzes(user_id)
-        elif command in ('nextquestion', '!nextquestion', '!nq'):
-            return self.next_question(user_id, parameter, room_id)
-        elif command in ('delete', '!delete'):
-            return self.delete_quiz(parameter)
-        elif command in ('reset', '!reset'):
-            return self.reset_quiz(user_id, parameter)
-        elif command in ('messages', '!messages'):
-            return self.update_messages_per_day(user_id, parameter)
-        elif has_open_question(user_id, None, room_id):
+    @staticmethod
+    def message_unknown():
+        return "I didn't understand that. Type 'help' to see what I can understand."
+
+    def answer(self, message, room_id, user_id):
+        if has_open_question(user_id, None, room_id):
             return self.process_answer(user_id, message, room_id)
         else:
-            return "I didn't understand that. Type 'help' to see what I can understand."
+            return self.message_unknown()
+
+    def process_message(self, message, room_id, user_id):
+        return self.router.call(self.router.resolve(message), room_id, user_id)
+
+    @staticmethod
+    def is_stale(event):
+        # After downtime the sync replays the backlog, messages older than the cutoff are not answered anymore
+        if not STALE_EVENT_CUTOFF or not event.server_timestamp:
+            return False
+        return time.time() - event.server_timestamp / 1000 > STALE_EVENT_CUTOFF
+
+    async def undecrypted_message(self, room: MatrixRoom, event: MegolmEvent):
+        if not self.encryption:
+            logger.error(f"Encrypted message from user {event.sender}, encryption is not supported")
+            await self.send_message(room.room_id, 'Encrypted messages are not supported.')
+            return
+        # The key is requested once per session, the message is not answered
+        logger.error(f"Could not decrypt message {event.event_id} from user {event.sender}")
+        if event.session_id not in self.requested_sessions:
+            self.requested_sessions.add(event.session_id)
+            try:
+                await self.client.request_room_key(event)
+            except Exception as e:
+                logger.error(f"Requesting the room key for session {event.session_id} failed: {e}")
 
     async def message_callback(self, room: MatrixRoom, event):
+        if not self.owns_room(room.room_id) or not self.has_lease():
+            return
         if event.sender != self.user:
             if isinstance(event, MegolmEvent):
-                # Decrypt the MegolmEvent to get the plaintext message
-                # message = event.parse_encrypted_event()
-                # print(message)
-                message = ' '
-                if event.decrypted:
-                    message = event.body
-                else:
-                    message = ' '
-                    response_message = 'Encrypted messages are not supported.'
-                    logger.error(f"{response_message}")
+                # nio decrypts messages during the sync, a MegolmEvent here could not be decrypted
+                await self.undecrypted_message(room, event)
+                return
             elif isinstance(event, RoomMessageText):
                 message = event.body
             else:
                 logger.info(f'Unknown event type: {event.type}')
                 return  # Unknown event type, skip processing
+            if self.is_stale(event):
+                logger.info(f"Skipping stale message from user {event.sender}: {message}")
+                return
+            throttled = self.flood_control.check(room.room_id, event.sender)
+            if throttled:
+                logger.info(f"Dropping message from user {event.sender}, {throttled} limit reached: {message}")
+                if throttled == USER and self.flood_control.should_notify(event.sender):
+                    task = asyncio.ensure_future(self.send_message(
+                        room.room_id, 'You are sending messages too fast, please wait a moment before sending the '
+                                      'next one.'))
+                    self.command_tasks.add(task)
+                    task.add_done_callback(self.command_tasks.discard)
+                return
             logger.info(f"Received message from user {event.sender}: {message}")
-            response_message = self.process_message(message, room.room_id, event.sender)
-            await self.send_message(room.room_id, response_message)
+            # Handle the message in its own task so the sync loop is not blocked by the command
+            task = asyncio.ensure_future(self.handle_message(message, room.room_id, event.sender, event.event_id))
+            self.command_tasks.add(task)
+            task.add_done_callback(self.command_tasks.discard)
 
     async def invite_callback(self, room: MatrixRoom, event: InviteMemberEvent):
+        if not self.owns_room(room.room_id) or not self.has_lease():
+            return
         if event.membership == "invite":
             await self.client.join(room.room_id)
             logger.info(f"Joined room: {room.room_id}")
@@ -337,95 +533,145 @@ class Quizbot:
                       f"commands I understand. "
             await self.send_message(room.room_id, message)
 
-    async def periodic_task(self):
-        while True:
-            current_time = datetime.now().time()
-            start_time = datetime.strptime("09:00", "%H:%M").time()
-            end_time = datetime.strptime("20:00", "%H:%M").time()
-            logger.info("Periodic Task started")
-            if start_time <= current_time <= end_time:
-                await self.send_quiz_questions()
-                await asyncio.sleep(15*60)  # Run every x seconds
-            else:
-                # If outside the time range, wait for next full hour before checking again
-                logger.info("Periodic Task outside the time range. Trying again in an hour.")
-                now = datetime.now()
-                next_hour = (now + timedelta(hours=1)).replace(minute=0, second=0, microsecond=0)
-                wait_time = (next_hour - now).total_seconds()
-
-                await asyncio.sleep(wait_time)
-
-    def normalize_user_input(self, user_input, question):
-        # Remove any unwanted characters and split the input
-        user_input = re.sub(r'[^\w\s]', '', user_input.lower())
-        tokens = re.split(r'\s+|and', user_input)
-        # Map possible text answers to their identifiers
-        answer_map = self.create_answers_map(question.answers)
-        normalized_answers = []
-        for token in tokens:
-            token = token.strip()
-            if token in answer_map:
-                normalized_answers.append(answer_map[token])
-            elif token in answer_map.values():
-                normalized_answers.append(token)
-        return normalized_answers
-
-    @staticmethod
-    def create_answers_map(answers):
-        answer_map = {}
-        for answer in answers:
-            answer_map[answer.text.lower()] = answer.identifier.lower()
-        return answer_map
+    async def start_scheduler(self):
+        started = time.monotonic()
+        states = await self.run_db(get_subscription_states, datetime.now())
+        self.scheduler.load([state for state in states if self.owns_room(state.room_id)])
+        logger.info(f"Scheduler loaded {len(self.scheduler.subscriptions)} subscriptions "
+                    f"in {(time.monotonic() - started) * 1000:.1f}ms")
+        await self.scheduler.run()
+
+    async def warm_up(self):
+        # A single schema check, then the quiz catalog and questions are loaded before the first command arrives
+        timings = await self.run_db(warm_up, PRELOAD_BUDGET)
+        logger.info(f"Startup: schema {timings['schema'] * 1000:.1f}ms, "
+                    f"catalog {timings['catalog'] * 1000:.1f}ms ({timings['quizzes']} quizzes), "
+                    f"questions {timings['questions'] * 1000:.1f}ms ({timings['preloaded_questions']} questions "
+                    f"of {timings['preloaded_quizzes']} quizzes)")
 
     async def run(self):
         self.client.add_event_callback(self.message_callback, RoomMessageText)
         self.client.add_response_callback(self.sync_callback, SyncResponse)
         self.client.add_event_callback(self.invite_callback, InviteMemberEvent)
         self.client.add_event_callback(self.message_callback, MegolmEvent)
+        self.command_semaphore = asyncio.Semaphore(MAX_CONCURRENT_COMMANDS)
+        if METRICS_PORT:
+            # Every worker of a sharded bot listens on its own port
+            start_http_server(METRICS_PORT + self.shard_index, METRICS_HOST)
+            logger.info(f"Serving metrics on http://{METRICS_HOST}:{METRICS_PORT + self.shard_index}/metrics")
+        if self.worker_count > 1:
+            # The lease lives in the database, a fresh or old database needs its tables first
+            await self.run_db(ensure_schema)
+            asyncio.create_task(self.hold_lease())
+            logger.info(f"Waiting for the lease of shard {self.shard_index}/{self.worker_count}")
+            while not self.has_lease():
+                await asyncio.sleep(1)
+        await self.warm_up()
+        started = time.monotonic()
         await self.login()
+        logger.info(f"Startup: login {(time.monotonic() - started) * 1000:.1f}ms")
 
-        asyncio.create_task(self.periodic_task())
+        self.outbound.start()
+        self.sync_filter = await upload_sync_filter(self.client)
+        asyncio.create_task(self.start_scheduler())
+        self.sync_tokens.start()
 
         while True:
             try:
                 logger.info("Starting sync...")
-                await self.client.sync_forever(timeout=30000)  # Adjust timeout as needed
+                await self.client.sync_forever(timeout=30000, sync_filter=self.sync_filter)  # Adjust timeout as needed
             except Exception as e:
                 logger.error(f"Error during sync: {e}")
                 logger.info("Retrying after error...")
                 await asyncio.sleep(5)
 
     async def login(self):
-        response = await self.client.login(self.password)
+        credentials = self.load_credentials()
+        if credentials:
+            self.client.restore_login(credentials['user_id'], credentials['device_id'], credentials['access_token'])
+            if not isinstance(await self.client.whoami(), WhoamiError):
+                logger.info(f"Restored login of device {self.client.device_id}")
+                return
+            logger.error("The stored access token is not valid anymore, logging in again")
+        response = await self.client.login(self.password, device_name=MATRIX_DEVICE_NAME)
         if isinstance(response, LoginResponse):
-            logger.info("Login successful!")
+            logger.info(f"Login successful, device {response.device_id}")
+            self.save_credentials(response)
         else:
             logger.error("Login failed!")
 
+    def load_credentials(self):
+        """Load the access token and device id of the last login, returns None if there is none."""
+        if not os.path.exists(self.credentials_file):
+            return None
+        try:
+            with open(self.credentials_file, 'r') as file:
+                credentials = json.load(file)
+            if credentials.get('homeserver') == self.homeserver and credentials.get('user_id') \
+                    and credentials.get('device_id') and credentials.get('access_token'):
+                return credentials
+        except (OSError, ValueError, AttributeError) as e:
+            logger.error(f"Could not read credentials from {self.credentials_file}: {e}")
+        return None
+
+    def save_credentials(self, response):
+        """Store the access token and device id, the file is only readable by the owner."""
+        try:
+            descriptor = os.open(self.credentials_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+            with os.fdopen(descriptor, 'w') as file:
+                json.dump({'homeserver': self.homeserver, 'user_id': response.user_id,
+                           'device_id': response.device_id, 'access_token': response.access_token}, file)
+        except OSError as e:
+            logger.error(f"Could not write credentials to {self.credentials_file}: {e}")
+
+    async def claim_missing_sessions(self, room_ids):
+        # Claims the one-time keys for all devices in the rooms that have no olm session yet with a single
+        # request, instead of one request per room when the group sessions are shared
+        if not self.client.olm:
+            return
+        missing = {}
+        for room_id in room_ids:
+            room = self.client.rooms.get(room_id)
+            if room is None or not room.encrypted:
+                continue
+            for user_id, devices in self.client.get_missing_sessions(room_id).items():
+                missing.setdefault(user_id, set()).update(devices)
+        if missing:
+            response = await self.client.keys_claim(missing)
+            logger.info(f"Claimed keys for {sum(len(devices) for devices in missing.values())} devices: {response}")
+
     def load_next_batch(self):
         """Load the next_batch token from a file."""
-        if os.path.exists(self.next_batch_file):
-            with open(self.next_batch_file, 'r') as file:
-                data = json.load(file)
-                self.client.next_batch = data.get('next_batch', None)
-                logger.info(f"Loaded next_batch token: {self.client.next_batch}")
+        next_batch = self.sync_tokens.load()
+        if next_batch:
+            self.client.next_batch = next_batch
+            logger.info(f"Loaded next_batch token: {self.client.next_batch}")
 
     def save_next_batch(self, next_batch):
-        """Save the next_batch token to a file."""
-        with open(self.next_batch_file, 'w') as file:
-            json.dump({'next_batch': next_batch}, file)
-            # logger.info(f"Saved next_batch token: {next_batch}")
+        """Remember the next_batch token, it is written to the file in the background."""
+        self.sync_tokens.update(next_batch)
 
     async def sync_callback(self, response: SyncResponse):
         if isinstance(response, SyncResponse):
             self.save_next_batch(response.next_batch)
+            if response.elapsed:
+                sync_latency.observe(response.elapsed)
+            sync_events.observe(sum(len(room.timeline.events) for room in response.rooms.join.values())
+                                + len(response.rooms.invite))
+            last_sync.set(time.time())
             # logger.info("Sync completed successfully.")
         else:
             logger.error("Sync failed.")
 
     async def close(self):
         logger.info("Closing client session...")
+        await self.sync_tokens.close()
+        await self.outbound.drain()
+        self.outbound.stop()
         await self.client.close()
+        if self.worker_count > 1 and self.lease_expires:
+            await self.run_db(release_shard_lease, self.shard_index, self.lease_owner)
+        self.db_executor.shutdown(wait=False)
         logger.info("Client session closed.")
 
 
@@ -436,8 +682,8 @@ def handle_exit(signum, frame, bot, loop):
     loop.call_soon(loop.stop)
 
 
-async def main():
-    quizbot = Quizbot()
+async def main(worker_count=1, shard_index=0):
+    quizbot = Quizbot(worker_count, shard_index)
 
     loop = asyncio.get_event_loop()
 
@@ -0,0 +1,218 @@
+import asyncio
+import heapq
+import itertools
+import random
+import threading
+import time
+from datetime import datetime, timedelta
+
+from util import utility_functions as util
+from util.metrics import registry
+
+logger = util.create_logger('quiz_scheduler')
+
+tick_latency = registry.histogram('quizbot_scheduler_tick_duration_seconds',
+                                  'Time to deliver and reschedule due questions',
+                                  buckets=(0.01, 0.05, 0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 300.0))
+due_subscriptions = registry.histogram('quizbot_scheduler_due_subscriptions', 'Due subscriptions per scheduler tick',
+                                       buckets=(1, 5, 10, 50, 100, 500, 1000, 5000))
+
+
+class QuizScheduler:
+    """
+    Keeps the next due time of every subscription in a heap and wakes up exactly when the first one is due.
+    The messages per day of a subscription are spread evenly over the daily time window with some jitter.
+    A room only gets one question at a time, due subscriptions sharing a room are ordered by their quota deficit
+    so that every quiz of the room gets its share.
+    """
+
+    def __init__(self, deliver, window_start='09:00', window_end='20:00', jitter=0.2, retry_delay=15 * 60):
+        # deliver is a coroutine function taking a list of due (user_id, quiz_id) keys and returning a dict
+        # key -> (asked_today, delivered) for every key that still has a subscription
+        self.deliver = deliver
+        self.window_start = datetime.strptime(window_start, "%H:%M").time()
+        self.window_end = datetime.strptime(window_end, "%H:%M").time()
+        self.jitter = jitter
+        self.retry_delay = retry_delay
+        self.heap = []  # (due timestamp, sequence, key)
+        self.subscriptions = {}  # key -> subscription state
+        self.sequence = itertools.count()
+        self.loop = None
+        self.loop_thread = None
+        self.wakeup = None
+        self.lock = threading.Lock()
+        self.pending = []  # changes that arrived before run() started, applied on the event loop thread
+
+    def load(self, states):
+        """
+        Schedules all subscriptions from a list of subscription states (see get_subscription_states).
+        """
+        for state in states:
+            self._schedule(state.user_id, state.quiz_id, state.room_id, state.messages_per_day, state.asked_today)
+        logger.info(f"Scheduler loaded {len(self.subscriptions)} subscriptions")
+
+    def schedule(self, user_id, quiz_id, room_id, messages_per_day, asked_today=0):
+        self._call(self._schedule, user_id, quiz_id, room_id, messages_per_day, asked_today)
+
+    def unschedule(self, user_id, quiz_id):
+        self._call(self._unschedule, user_id, quiz_id)
+
+    def update_messages_per_day(self, user_id, quiz_id, messages_per_day):
+        self._call(self._update_messages_per_day, user_id, quiz_id, messages_per_day)
+
+    def _call(self, func, *args):
+        # Changes may come from the DB executor, the heap is only touched on the event loop thread
+        with self.lock:
+            if self.loop is None:
+                self.pending.append((func, args))
+                return
+        if threading.get_ident() != self.loop_thread:
+            self.loop.call_soon_threadsafe(func, *args)
+        else:
+            func(*args)
+
+    def _schedule(self, user_id, quiz_id, room_id, messages_per_day, asked_today):
+        subscription = {
+            'room_id': room_id,
+            'messages_per_day': messages_per_day or 0,
+            'asked_today': asked_today,
+            'day': datetime.now().date()
+        }
+        self.subscriptions[(user_id, quiz_id)] = subscription
+        self._push((user_id, quiz_id), self.next_due(subscription, datetime.now()))
+
+    def _unschedule(self, user_id, quiz_id):
+        # The heap entry is skipped lazily once it comes up
+        self.subscriptions.pop((user_id, quiz_id), None)
+
+    def _update_messages_per_day(self, user_id, quiz_id, messages_per_day):
+        subscription = self.subscriptions.get((user_id, quiz_id))
+        if subscription:
+            subscription['messages_per_day'] = messages_per_day
+            self._push((user_id, quiz_id), self.next_due(subscription, datetime.now()))
+
+    def _push(self, key, due):
+        subscription = self.subscriptions[key]
+        subscription['sequence'] = next(self.sequence)
+        subscription['due'] = due
+        if due is None:
+            return
+        heapq.heappush(self.heap, (due.timestamp(), subscription['sequence'], key))
+        if self.wakeup:
+            self.wakeup.set()
+
+    def window(self, day):
+        return datetime.combine(day, self.window_start), datetime.combine(day, self.window_end)
+
+    def next_due(self, subscription, now):
+        """
+        Computes the next due time of a subscription. The day is split into one slot per message and the
+        question is due in the middle of the next free slot, shifted by the jitter.
+
+        :return: The datetime the next question is due or None if no messages should be sent.
+        """
+        messages_per_day = subscription['messages_per_day']
+        if messages_per_day <= 0:
+            return None
+        if subscription['day'] != now.date():
+            subscription['day'] = now.date()
+            subscription['asked_today'] = 0
+        start, end = self.window(now.date())
+        asked = subscription['asked_today']
+        if asked >= messages_per_day or now >= end:
+            # Nothing left for today, start with the first slot tomorrow
+            start, end = self.window(now.date() + timedelta(days=1))
+            asked = 0
+        slot = (end - start) / messages_per_day
+        due = start + slot * (asked + 0.5) + slot * random.uniform(-self.jitter / 2, self.jitter / 2)
+        if due < now:
+            # Behind schedule, catch up within one slot instead of sending everything at once
+            remaining = max(1, messages_per_day - asked)
+            due = now + min(slot, (end - now) / remaining) * random.uniform(0, self.jitter)
+        return due
+
+    def pop_due(self, now):
+        due = []
+        while self.heap and self.heap[0][0] <= now.timestamp():
+            _, sequence, key = heapq.heappop(self.heap)
+            subscription = self.subscriptions.get(key)
+            if subscription and subscription['sequence'] == sequence:
+                due.append(key)
+        return self.order_due(due, now)
+
+    def deficit(self, subscription, now):
+        # Questions the subscription is behind its even spread over today's window
+        start, end = self.window(now.date())
+        elapsed = min(max((now - start) / (end - start), 0.0), 1.0)
+        asked = subscription['asked_today'] if subscription['day'] == now.date() else 0
+        return subscription['messages_per_day'] * elapsed - asked
+
+    def order_due(self, due, now):
+        """
+        Groups the due subscriptions by room. Within a room the subscription with the largest quota deficit comes
+        first, on equal deficits the one served longest ago. The deliver function serves the first eligible
+        subscription of every room.
+
+        :return: The due keys, grouped by room.
+        """
+        rooms = {}
+        for key in due:
+            rooms.setdefault(self.subscriptions[key]['room_id'], []).append(key)
+        ordered = []
+        for keys in rooms.values():
+            keys.sort(key=lambda key: (-self.deficit(self.subscriptions[key], now),
+                                       self.subscriptions[key].get('served', -1)))
+            ordered.extend(keys)
+        return ordered
+
+    def reschedule(self, due, outcomes, now):
+        for key in due:
+            subscription = self.subscriptions.get(key)
+            if not subscription:
+                continue
+            if key not in outcomes:
+                # The subscription does not exist anymore
+                self._unschedule(*key)
+                continue
+            subscription['asked_today'], delivered = outcomes[key]
+            subscription['day'] = now.date()
+            if delivered:
+                # Rotation within the room, on equal deficits the other subscriptions go first next time
+                subscription['served'] = next(self.sequence)
+            if delivered or subscription['asked_today'] >= subscription['messages_per_day']:
+                self._push(key, self.next_due(subscription, now))
+            else:
+                # Open question or room already served, try again later today
+                retry = now + timedelta(seconds=self.retry_delay)
+                self._push(key, retry if retry < self.window(now.date())[1] else self.next_due(subscription, now))
+
+    async def run(self):
+        self.wakeup = asyncio.Event()
+        with self.lock:
+            self.loop = asyncio.get_running_loop()
+            self.loop_thread = threading.get_ident()
+            pending, self.pending = self.pending, []
+        for func, args in pending:
+            func(*args)
+        while True:
+            now = datetime.now()
+            due = self.pop_due(now)
+            if due:
+                logger.info(f"Scheduler found {len(due)} due subscriptions")
+                started = time.monotonic()
+                due_subscriptions.observe(len(due))
+                try:
+                    outcomes = await self.deliver(due)
+                except Exception as e:
+                    logger.error(f"Delivering due questions failed: {e}")
+                    outcomes = {key: (self.subscriptions[key]['asked_today'], False)
+                                for key in due if key in self.subscriptions}
+                self.reschedule(due, outcomes, datetime.now())
+                tick_latency.observe(time.monotonic() - started)
+                continue
+            timeout = (self.heap[0][0] - now.timestamp()) if self.heap else None
+            self.wakeup.clear()
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
@@ -1,10 +1,41 @@
+import argparse
 import asyncio
+import multiprocessing
 from classes.QuizBot import main
 
 
-def run_main():
-    asyncio.run(main())
+def run_main(worker_count=1, shard_index=0):
+    asyncio.run(main(worker_count, shard_index))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Run the Quizbot.')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of worker processes the rooms are partitioned into')
+    parser.add_argument('--shard', type=int, default=None,
+                        help='run only the worker of this shard index, otherwise all workers are started')
+    args = parser.parse_args()
+    if args.workers < 1:
+        parser.error('--workers must be at least 1')
+    if args.shard is not None and not 0 <= args.shard < args.workers:
+        parser.error('--shard must be between 0 and --workers - 1')
+    return args
 
 
 if __name__ == '__main__':
-    run_main()
+    args = parse_args()
+    if args.shard is not None or args.workers == 1:
+        run_main(args.workers, args.shard or 0)
+    else:
+        # The schema is created once before the workers start, so they do not race to create the tables
+        from store.models import engine, ensure_schema
+        ensure_schema()
+        engine.dispose()
+        # Fresh interpreters, so no database connections are inherited from this process
+        context = multiprocessing.get_context('spawn')
+        workers = [context.Process(target=run_main, args=(args.workers, shard_index))
+                   for shard_index in range(args.workers)]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
@@ -1,5 +1,76 @@
 import os
 
+from dotenv import load_dotenv
+from sqlalchemy.engine import URL
+
+load_dotenv()
+
+# Storage profiles, selected with QUIZBOT_DB_PROFILE, PostgreSQL databases use the postgres profile by default.
+# The pragmas only apply to SQLite, the pool settings to every database. A single setting of the profile can be
+# overridden with QUIZBOT_DB_<SETTING>, e.g. QUIZBOT_DB_BUSY_TIMEOUT=10000.
+PROFILES = {
+    # WAL lets the Flask app read while the bot writes, NORMAL only syncs at checkpoints
+    'default': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,  # milliseconds a writer waits for the lock instead of failing with "database is locked"
+        'mmap_size': 64 * 1024 * 1024,
+        'cache_size': -16000,  # negative values are KiB
+        'pool_size': 5,
+        'max_overflow': 10,
+        'pool_timeout': 30,
+        'pool_recycle': -1,
+        'pool_pre_ping': False,
+    },
+    # Every commit is synced, no committed answer is lost on a power failure
+    'durable': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'busy_timeout': 5000,
+        'mmap_size': 0,
+        'cache_size': -16000,
+        'pool_size': 5,
+        'max_overflow': 10,
+        'pool_timeout': 30,
+        'pool_recycle': -1,
+        'pool_pre_ping': False,
+    },
+    # Database on a network share, WAL and memory mapping need a local file system
+    'network': {
+        'journal_mode': 'DELETE',
+        'synchronous': 'FULL',
+        'busy_timeout': 30000,
+        'mmap_size': 0,
+        'cache_size': -16000,
+        'pool_size': 2,
+        'max_overflow': 2,
+        'pool_timeout': 60,
+        'pool_recycle': 3600,
+        'pool_pre_ping': True,
+    },
+    # PostgreSQL server shared by all workers, connections are checked before use and replaced after 30 minutes
+    'postgres': {
+        'pool_size': 10,
+        'max_overflow': 20,
+        'pool_timeout': 30,
+        'pool_recycle': 1800,
+        'pool_pre_ping': True,
+    },
+    # The SQLite defaults the bot used before the profiles existed
+    'legacy': {
+        'journal_mode': 'DELETE',
+        'synchronous': 'FULL',
+        'busy_timeout': 0,
+        'mmap_size': 0,
+        'cache_size': -2000,
+        'pool_size': 5,
+        'max_overflow': 10,
+        'pool_timeout': 30,
+        'pool_recycle': -1,
+        'pool_pre_ping': False,
+    },
+}
+
 
 class Config:
     BASE_DIR = os.path.dirname(os.path.abspath(__file__))  # Get the directory of the current file
@@ -8,5 +79,51 @@ class Config:
 
     @staticmethod
     def get_db_uri():
+        # QUIZBOT_DB_URI points the bot to another database, e.g. a seeded copy for benchmarks
+        if os.getenv('QUIZBOT_DB_URI'):
+            return os.getenv('QUIZBOT_DB_URI')
+        if os.getenv('QUIZBOT_PG_HOST'):
+            return Config.get_postgres_uri()
         return Config.LOCAL_DB_PATH
         # return Config.NETWORK_DB_PATH
+
+    @staticmethod
+    def get_postgres_uri():
+        """
+        Builds the URI of the PostgreSQL database from the QUIZBOT_PG_* environment variables.
+
+        :return: The URI, using the psycopg2 driver.
+        """
+        return URL.create(
+            'postgresql+psycopg2',
+            username=os.getenv('QUIZBOT_PG_USER', 'quizbot'),
+            password=os.getenv('QUIZBOT_PG_PASSWORD') or None,
+            host=os.getenv('QUIZBOT_PG_HOST'),
+            port=int(os.getenv('QUIZBOT_PG_PORT', 5432)),
+            database=os.getenv('QUIZBOT_PG_DATABASE', 'quizbot')
+        ).render_as_string(hide_password=False)
+
+    @staticmethod
+    def get_db_profile_name(uri=None):
+        uri = uri or Config.get_db_uri()
+        # An empty QUIZBOT_DB_PROFILE, as in .env.example, picks the profile for the database
+        return os.getenv('QUIZBOT_DB_PROFILE') or ('postgres' if uri.startswith('postgresql') else 'default')
+
+    @staticmethod
+    def get_db_profile(name=None):
+        """
+        Returns the settings of a storage profile with the overrides from the environment applied.
+
+        :param name: The name of the profile, the configured one for the database if not given.
+        :return: A dict with the settings.
+        """
+        name = name or Config.get_db_profile_name()
+        if name not in PROFILES:
+            raise ValueError(f'Unknown storage profile "{name}", use one of {", ".join(PROFILES)}')
+        profile = dict(PROFILES[name])
+        for setting, value in profile.items():
+            override = os.getenv(f'QUIZBOT_DB_{setting.upper()}')
+            if override is not None:
+                profile[setting] = override.lower() in ('1', 'true', 'yes') if isinstance(value, bool) \
+                    else type(value)(override)
+        return profile
@@ -0,0 +1,58 @@
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+
+from store import db_config
+from util import utility_functions as util
+
+logger = util.create_logger('db_engine')
+
+PRAGMAS = ['journal_mode', 'synchronous', 'busy_timeout', 'mmap_size', 'cache_size']
+POOL_SETTINGS = ['pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle', 'pool_pre_ping']
+
+shared_engine = None
+
+
+def set_sqlite_pragmas(dbapi_connection, profile):
+    cursor = dbapi_connection.cursor()
+    try:
+        for pragma in [pragma for pragma in PRAGMAS if pragma in profile]:
+            cursor.execute(f'PRAGMA {pragma} = {profile[pragma]}')
+    finally:
+        cursor.close()
+
+
+def create_db_engine(uri=None, profile=None):
+    """
+    Creates an engine with the settings of a storage profile. SQLite connections get the pragmas of the profile
+    when they are opened, the pool settings apply to every file or server database.
+
+    :param uri: The database URI, the configured one if not given.
+    :param profile: The name of the storage profile, the configured one for the database if not given.
+    :return: The engine.
+    """
+    uri = uri or db_config.Config.get_db_uri()
+    settings = db_config.Config.get_db_profile(profile or db_config.Config.get_db_profile_name(uri))
+    url = make_url(uri)
+    in_memory = url.get_backend_name() == 'sqlite' and url.database in (None, '', ':memory:')
+    # An in-memory database lives in a single connection, it keeps the default pool
+    options = {} if in_memory else {setting: settings[setting] for setting in POOL_SETTINGS}
+    engine = create_engine(uri, **options)
+    if url.get_backend_name() == 'sqlite':
+        @event.listens_for(engine, 'connect')
+        def on_connect(dbapi_connection, connection_record):
+            set_sqlite_pragmas(dbapi_connection, settings)
+    return engine
+
+
+def get_engine():
+    """
+    Returns the engine of the configured database, all modules of a process share it and its connection pool.
+
+    :return: The engine.
+    """
+    global shared_engine
+    if shared_engine is None:
+        shared_engine = create_db_engine()
+        logger.info(f"Opened {shared_engine.url.render_as_string(hide_password=True)} "
+                    f"with storage profile {db_config.Config.get_db_profile_name()}")
+    return shared_engine
@@ -1,22 +1,121 @@
 from store.models import User, Quiz as DbQuiz, Question as DbQuestion, Answer as DbAnswer, \
-    Feedback as DbFeedback, LastQuestion, user_subscribed_to_quiz, user_asked_question
-from sqlalchemy import create_engine, exists, func, update
-from sqlalchemy.orm import sessionmaker
-from store import db_config
+    Feedback as DbFeedback, LastQuestion, ProcessedEvent, QuizRevision, ShardLease, user_subscribed_to_quiz, \
+    user_asked_question, engine, ensure_schema
+from sqlalchemy import exists, func, or_, select, update
+from sqlalchemy.dialects.postgresql import insert as postgresql_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import scoped_session, selectinload, sessionmaker
+from store.question_cache import CachedQuestion, question_cache
+from store.quiz_catalog import quiz_catalog
+from store.user_state_cache import UserState, user_state_cache
 from structures.quiz import Quiz
 from structures.question import Question
 from structures.answer import Answer
 from structures.feedback import Feedback
+from contextlib import contextmanager
 from datetime import datetime, timedelta
+from functools import lru_cache
 from util import utility_functions as util
-
-# Initialize the database connection
-engine = create_engine(db_config.Config.get_db_uri())
-Session = sessionmaker(bind=engine)
-session = Session()
+import os
+import random
+import sys
+import threading
+import time
+
+# Initialize the database connection, the engine is shared with the models. Every thread gets its own session,
+# session is a proxy to the session of the calling thread.
+Session = scoped_session(sessionmaker(bind=engine))
+session = Session
+unit = threading.local()  # depth and state of the unit of work of the current thread
 
 logger = util.create_logger('db_operations')
 
+QUESTION_SHUFFLE = os.getenv('QUESTION_SHUFFLE', 'false').lower() == 'true'  # per-user order for new subscriptions
+UPSERT_DIALECTS = {'sqlite': sqlite_insert, 'postgresql': postgresql_insert}  # INSERT ... ON CONFLICT support
+PRUNE_INTERVAL = 100  # processed events are pruned every this many recorded events
+processed_events_recorded = 0
+
+
+def in_unit_of_work():
+    return getattr(unit, 'depth', 0) > 0
+
+
+def begin_unit():
+    """
+    Starts a unit of work on the current thread, a unit started inside another one joins it.
+    """
+    if not in_unit_of_work():
+        unit.depth = 0
+        unit.failed = False
+        unit.flushed = False  # True once an operation of the unit changed data and possibly cached state
+    unit.depth += 1
+
+
+def end_unit(exception=None):
+    """
+    Ends a unit of work. The outermost unit commits all changes at once, or rolls them back if an exception
+    occurred or an operation of the unit failed. The session is closed and its connection returned to the pool.
+
+    :param exception: The exception that ended the unit (optional).
+    :raises Exception: If the commit fails, the changes are rolled back.
+    """
+    if not in_unit_of_work():
+        return
+    unit.depth -= 1
+    if exception is not None:
+        unit.failed = True
+    if unit.depth > 0:
+        return
+    try:
+        if not unit.failed:
+            session.commit()
+    except Exception:
+        unit.failed = True
+        raise
+    finally:
+        if unit.failed:
+            session.rollback()
+            # Cached state may contain changes that were rolled back
+            if unit.flushed:
+                user_state_cache.clear()
+        Session.remove()
+
+
+@contextmanager
+def unit_of_work():
+    """
+    Runs the enclosed database work in one transaction on a short-lived session of the current thread.
+
+    :return: A context manager yielding the session.
+    """
+    begin_unit()
+    try:
+        yield session
+    except BaseException as e:
+        end_unit(e)
+        raise
+    end_unit()
+
+
+def _commit():
+    # Inside a unit of work the changes are only flushed, the unit commits them once at the end
+    if in_unit_of_work():
+        session.flush()
+        unit.flushed = True
+    else:
+        session.commit()
+
+
+def _rollback():
+    # A rollback undoes the whole unit of work, not only the failed operation. Inside a unit the error is raised
+    # again, so the caller does not report success for changes that are rolled back.
+    session.rollback()
+    if in_unit_of_work():
+        unit.failed = True
+        if sys.exc_info()[1] is not None:
+            raise
+
 
 def convert_quiz_to_db_model(quiz):
     return DbQuiz(
@@ -94,7 +193,8 @@ def add_custom_question_to_db(question, quiz_id):
     """
     question_model = convert_question_to_db_model(question, quiz_id)
     session.add(question_model)
-    session.commit()
+    bump_quiz_revision(quiz_id)
+    _commit()
 
 
 def add_quiz_to_db(quiz=None, quiz_model=None):
@@ -113,7 +213,9 @@ def add_quiz_to_db(quiz=None, quiz_model=None):
         max_short_id = 0
     quiz_model.short_id = max_short_id + 1
     session.add(quiz_model)
-    session.commit()
+    session.flush()
+    bump_quiz_revision(quiz_model.id)
+    _commit()
 
 
 def add_db_question_to_db(db_question):
@@ -124,7 +226,8 @@ def add_db_question_to_db(db_question):
     """
     try:
         session.add(db_question)
-        session.commit()
+        bump_quiz_revision(db_question.quiz_id)
+        _commit()
     except Exception as e:
         logger.error(f"An error occurred in {util.current_function_name()}: {e}")
 
@@ -137,7 +240,8 @@ def add_db_answer_to_db(db_answer):
     """
     try:
         session.add(db_answer)
-        session.commit()
+        bump_quiz_revision(session.query(DbQuestion.quiz_id).filter_by(id=db_answer.question_id).scalar())
+        _commit()
     except Exception as e:
         logger.error(f"An error occurred in {util.current_function_name()}: {e}")
 
@@ -150,11 +254,148 @@ def add_db_feedback_to_db(db_feedback):
     """
     try:
         session.add(db_feedback)
-        session.commit()
+        bump_quiz_revision(session.query(DbQuestion.quiz_id).filter_by(id=db_feedback.question_id).scalar())
+        _commit()
     except Exception as e:
         logger.error(f"An error occurred in {util.current_function_name()}: {e}")
 
 
+def bump_quiz_revision(quiz_id):
+    """
+    Increments the revision of a quiz so cached questions of the quiz are reloaded, also in other processes.
+    The change is committed together with the calling operation.
+
+    :param quiz_id: The ID of the quiz that changed.
+    """
+    if not quiz_id:
+        return
+    upsert(QuizRevision.__table__, {'quiz_id': quiz_id, 'revision': 1}, ['quiz_id'],
+           {'revision': QuizRevision.revision + 1})
+    question_cache.invalidate_quiz(quiz_id)
+    quiz_catalog.invalidate()
+
+
+def check_quiz_revisions():
+    """
+    Drops cached questions of changed quizzes and reloads the quiz catalog if any quiz changed.
+    The revisions are read at most once per check interval.
+    """
+    if not question_cache.needs_check() and not quiz_catalog.needs_check():
+        return
+    revisions = dict(session.query(QuizRevision.quiz_id, QuizRevision.revision).all())
+    question_cache.check_revisions(revisions)
+    if not quiz_catalog.is_current(revisions):
+        quiz_catalog.load(session.query(DbQuiz).all(), revisions)
+
+
+def get_quiz_catalog():
+    """
+    Returns the in-memory snapshot of all quizzes, reloaded if a quiz changed.
+
+    :return: The QuizCatalog.
+    """
+    try:
+        check_quiz_revisions()
+    except Exception as e:
+        _rollback()
+        logger.error(f"An error occurred in {util.current_function_name()}: {e}")
+    return quiz_catalog
+
+
+def get_catalog_quiz(quiz_id):
+    """
+    Returns a quiz from the quiz catalog.
+
+    :param quiz_id: The ID of the quiz.
+    :return: A CatalogQuiz object or None if the quiz does not exist.
+    """
+    return get_quiz_catalog().get(quiz_id)
+
+
+def find_catalog_quiz(name_or_number):
+    """
+    Finds a quiz in the quiz catalog by its name or short ID.
+
+    :param name_or_number: The name or the short ID of the quiz.
+    :return: A CatalogQuiz object or None if no quiz matches.
+    """
+    return get_quiz_catalog().find(name_or_number)
+
+
+def warm_up(budget):
+    """
+    Prepares the database for the bot: checks the schema once, loads the quiz catalog and loads the questions
+    of as many quizzes into the question cache as fit into the budget.
+
+    :param budget: The number of seconds preloading questions may take.
+    :return: A dict with the durations of the steps in seconds and the number of loaded quizzes and questions.
+    """
+    timings = {}
+    started = time.monotonic()
+    ensure_schema()
+    timings['schema'] = time.monotonic() - started
+
+    started = time.monotonic()
+    catalog = get_quiz_catalog()
+    timings['catalog'] = time.monotonic() - started
+    timings['quizzes'] = len(catalog.quizzes)
+
+    started = time.monotonic()
+    loaded = 0
+    try:
+        for quiz in catalog.quizzes:
+            if time.monotonic() - started > budget or len(question_cache.entries) >= question_cache.max_size:
+                break
+            load_quiz_questions(quiz.id)
+            loaded += 1
+    except Exception as e:
+        # Preloading only reads and is best effort, the questions are loaded on first use instead
+        session.rollback()
+        logger.error(f"An error occurred in {util.current_function_name()}: {e}")
+    timings['questions'] = time.monotonic() - started
+    timings['preloaded_quizzes'] = loaded
+    timings['preloaded_questions'] = len(question_cache.entries)
+    return timings
+
+
+def load_quiz_questions(quiz_id):
+    """
+    Loads all questions of a quiz with their answers and feedback and puts them into the question cache.
+
+    :param quiz_id: The ID of the quiz.
+    """
+    revision = session.query(QuizRevision.revision).filter_by(quiz_id=quiz_id).scalar() or 0
+    questions = session.query(DbQuestion).options(selectinload(DbQuestion.answers),
+                                                  selectinload(DbQuestion.feedback)).\
+        filter_by(quiz_id=quiz_id).all()
+    question_cache.put_quiz(quiz_id, revision, [
+        CachedQuestion(convert_question_model_to_question(question), question) for question in questions
+    ])
+
+
+def get_cached_question(question_id, quiz_id=None):
+    """
+    Returns the rendered question and the data needed to evaluate answers, loading the quiz if it is not cached.
+
+    :param question_id: The ID of the question.
+    :param quiz_id: The ID of the quiz of the question (optional, saves a query on a cache miss).
+    :return: A CachedQuestion object or None if the question does not exist.
+    """
+    try:
+        check_quiz_revisions()
+        cached_question = question_cache.get(question_id)
+        if cached_question is None:
+            if not quiz_id:
+                quiz_id = session.query(DbQuestion.quiz_id).filter_by(id=question_id).scalar()
+            if quiz_id:
+                load_quiz_questions(quiz_id)
+                cached_question = question_cache.get(question_id)
+        return cached_question
+    except Exception as e:
+        logger.error(f"An error occurred in {util.current_function_name()}: {e}")
+        return None
+
+
 def quiz_exists(quiz_name):
     """
     Checks if a quiz with the given name exists in the database.
@@ -186,9 +427,9 @@ def create_user(user_id):
         try:
             user = User(id=user_id)
             session.add(user)
-            session.commit()
+            _commit()
         except Exception as e:
-            session.rollback()
+            _rollback()
             logger.error(e)
             return False
     else:
@@ -226,6 +467,8 @@ def get_subscribed_quizzes(user_id):
     :param user_id: The ID of the user.
     :return: A list of quizzes the user is subscribed to, or an empty list if there are no subscriptions.
     """
+    if not get_user_state(user_id).subscriptions:
+        return []
     quizzes = session.query(DbQuiz).join(user_subscribed_to_quiz).\
         filter(user_subscribed_to_quiz.c.user_id == user_id).all()
     return quizzes if quizzes else []
@@ -322,6 +565,8 @@ def get_asked_questions_count_on_date(user_id, quiz_id, date):
     :param date: The specific date to count the questions (datetime.date object).
     :return: The number of questions asked on the specified date to the user from the quiz.
     """
+    if date_of(date) == datetime.now().date():
+        return get_user_state(user_id).asked_today.get(quiz_id, 0)
     try:
         # Get the start and end datetime for the specified date
         day_start = datetime.combine(date, datetime.min.time())
@@ -339,25 +584,195 @@ def get_asked_questions_count_on_date(user_id, quiz_id, date):
         return 0
 
 
-def get_unanswered_question(user_id, quiz_id):
+def date_of(date):
+    return date.date() if isinstance(date, datetime) else date
+
+
+def load_user_state(user_id):
+    """
+    Loads the subscriptions, open questions and the number of questions asked today of a user.
+
+    :param user_id: The ID of the user.
+    :return: A UserState object.
+    """
+    today = datetime.now().date()
+    day_start = datetime.combine(today, datetime.min.time())
+    subscriptions = session.query(user_subscribed_to_quiz).filter_by(user_id=user_id).all()
+    open_questions = session.query(LastQuestion).filter_by(user_id=user_id, answered=False).all()
+    asked_today = session.query(DbQuestion.quiz_id, func.count(user_asked_question.c.question_id)).\
+        join(DbQuestion, DbQuestion.id == user_asked_question.c.question_id).\
+        filter(user_asked_question.c.user_id == user_id,
+               user_asked_question.c.ts >= day_start,
+               user_asked_question.c.ts < day_start + timedelta(days=1)).\
+        group_by(DbQuestion.quiz_id).all()
+    return UserState(
+        day=today,
+        subscriptions={sub.quiz_id: (sub.room_id, sub.messages_per_day) for sub in subscriptions},
+        open_questions={lq.quiz_id: (lq.question_id, lq.room_id) for lq in open_questions},
+        asked_today={quiz_id: count for quiz_id, count in asked_today}
+    )
+
+
+def get_user_state(user_id):
+    """
+    Returns the cached state of a user and loads it from the database if it is not cached.
+
+    :param user_id: The ID of the user.
+    :return: A UserState object.
+    """
+    today = datetime.now().date()
+    state = user_state_cache.get(user_id, today)
+    if state is None:
+        state = load_user_state(user_id)
+        user_state_cache.put(user_id, state)
+    return state
+
+
+def subscription_state_query(date, user_ids=None):
+    """
+    Builds a query for the state of all subscriptions on a specific date: the number of questions asked on that
+    date, the messages per day of the subscription and whether the user has an open question in the quiz or in
+    the room of the subscription.
+
+    :param date: The specific date to count the questions (datetime.date object).
+    :param user_ids: Restrict the query to these users (optional).
+    :return: The query.
+    """
+    day_start = datetime.combine(date, datetime.min.time())
+    day_end = day_start + timedelta(days=1)
+
+    # Questions asked on the date per user and quiz
+    asked_today = session.query(user_asked_question.c.user_id.label('user_id'),
+                                DbQuestion.quiz_id.label('quiz_id'),
+                                func.count(user_asked_question.c.question_id).label('asked')).\
+        join(DbQuestion, DbQuestion.id == user_asked_question.c.question_id).\
+        filter(user_asked_question.c.ts >= day_start,
+               user_asked_question.c.ts < day_end)
+    if user_ids is not None:
+        asked_today = asked_today.filter(user_asked_question.c.user_id.in_(user_ids))
+    asked_today = asked_today.group_by(user_asked_question.c.user_id, DbQuestion.quiz_id).subquery()
+
+    asked_count = func.coalesce(asked_today.c.asked, 0)
+    messages_per_day = func.coalesce(user_subscribed_to_quiz.c.messages_per_day, 0)
+    open_in_quiz = exists().where(LastQuestion.user_id == user_subscribed_to_quiz.c.user_id,
+                                  LastQuestion.quiz_id == user_subscribed_to_quiz.c.quiz_id,
+                                  LastQuestion.answered == False)  # noqa: E712
+    open_in_room = exists().where(LastQuestion.user_id == user_subscribed_to_quiz.c.user_id,
+                                  LastQuestion.room_id == user_subscribed_to_quiz.c.room_id,
+                                  LastQuestion.answered == False)  # noqa: E712
+
+    query = session.query(user_subscribed_to_quiz.c.user_id,
+                          user_subscribed_to_quiz.c.quiz_id,
+                          user_subscribed_to_quiz.c.room_id,
+                          asked_count.label('asked_today'),
+                          messages_per_day.label('messages_per_day'),
+                          open_in_quiz.label('open_in_quiz'),
+                          open_in_room.label('open_in_room')).\
+        join(DbQuiz, DbQuiz.id == user_subscribed_to_quiz.c.quiz_id).\
+        outerjoin(asked_today, (asked_today.c.user_id == user_subscribed_to_quiz.c.user_id) &
+                  (asked_today.c.quiz_id == user_subscribed_to_quiz.c.quiz_id))
+    if user_ids is not None:
+        query = query.filter(user_subscribed_to_quiz.c.user_id.in_(user_ids))
+    return query.order_by(DbQuiz.short_id)
+
+
+def get_subscription_states(date, user_ids=None):
+    """
+    Retrieves the state of all subscriptions on a specific date in a single query.
+
+    :param date: The specific date to count the questions (datetime.date object).
+    :param user_ids: Restrict the result to these users (optional).
+    :return: A list of rows (user_id, quiz_id, room_id, asked_today, messages_per_day, open_in_quiz,
+             open_in_room) ordered by quiz, or an empty list if an error occurs.
+    """
+    try:
+        return subscription_state_query(date, user_ids).all()
+    except Exception as e:
+        logger.error(f"An error occurred in {util.current_function_name()}: {e}")
+        return []
+
+
+@lru_cache(maxsize=1024)
+def shuffled_positions(shuffle_seed, size):
+    # Order in which a shuffled subscription asks the positions of a quiz, its cursor is an index into the list
+    positions = list(range(size))
+    random.Random(shuffle_seed).shuffle(positions)
+    return positions
+
+
+def count_positions(quiz_id):
+    last_position = session.query(func.max(DbQuestion.position)).filter_by(quiz_id=quiz_id).scalar()
+    return 0 if last_position is None else last_position + 1
+
+
+def get_progress(user_id, quiz_id):
     """
-    Retrieves the first unanswered question for a user in a specific quiz.
+    Retrieves the progress cursor of a subscription.
 
     :param user_id: The ID of the user.
     :param quiz_id: The ID of the quiz.
-    :return: The first unanswered question object, or None if all questions are answered.
+    :return: A row (next_position, shuffle_seed), or None if the user is not subscribed.
     """
-    answered_questions = session.query(user_asked_question).filter_by(user_id=user_id).all()
-    answered_ids = {aq.question_id for aq in answered_questions}
+    return session.query(user_subscribed_to_quiz.c.next_position, user_subscribed_to_quiz.c.shuffle_seed).\
+        filter_by(user_id=user_id, quiz_id=quiz_id).first()
 
-    all_questions = session.query(DbQuestion).filter_by(quiz_id=quiz_id).all()
 
-    for question in all_questions:
-        if question.id not in answered_ids:
+def set_progress(user_id, quiz_id, next_position, only_forward=False):
+    stmt = update(user_subscribed_to_quiz).\
+        where(user_subscribed_to_quiz.c.user_id == user_id).\
+        where(user_subscribed_to_quiz.c.quiz_id == quiz_id)
+    if only_forward:
+        stmt = stmt.where(or_(user_subscribed_to_quiz.c.next_position.is_(None),
+                              user_subscribed_to_quiz.c.next_position < next_position))
+    session.execute(stmt.values(next_position=next_position))
+
+
+def get_unanswered_question_legacy(user_id, quiz_id):
+    # Scans the asked questions, used for subscriptions from before the progress cursor existed
+    asked_ids = {question_id for question_id, in session.query(user_asked_question.c.question_id).
+                 join(DbQuestion, DbQuestion.id == user_asked_question.c.question_id).
+                 filter(user_asked_question.c.user_id == user_id, DbQuestion.quiz_id == quiz_id)}
+    for question in session.query(DbQuestion).filter_by(quiz_id=quiz_id).order_by(DbQuestion.position):
+        if question.id not in asked_ids:
             return question
     return None
 
 
+def get_unanswered_question(user_id, quiz_id):
+    """
+    Retrieves the next question for a user in a specific quiz. The subscription stores the index of the next
+    question in the question order, so the question is found with one indexed lookup. A shuffled order skips
+    questions that have been asked already.
+
+    :param user_id: The ID of the user.
+    :param quiz_id: The ID of the quiz.
+    :return: The first unanswered question object, or None if all questions are answered.
+    """
+    progress = get_progress(user_id, quiz_id)
+    if progress is None or progress.next_position is None:
+        question = get_unanswered_question_legacy(user_id, quiz_id)
+        if progress is not None:
+            try:
+                set_progress(user_id, quiz_id, question.position if question else count_positions(quiz_id))
+                _commit()
+            except Exception as e:
+                _rollback()
+                logger.error(f"An error occurred in {util.current_function_name()}: {e}")
+        return question
+
+    if progress.shuffle_seed is None:
+        return session.query(DbQuestion).filter(DbQuestion.quiz_id == quiz_id,
+                                                DbQuestion.position >= progress.next_position).\
+            order_by(DbQuestion.position).first()
+    for position in shuffled_positions(progress.shuffle_seed, count_positions(quiz_id))[progress.next_position:]:
+        question = session.query(DbQuestion).filter_by(quiz_id=quiz_id, position=position).first()
+        if question and not session.query(exists().where(user_asked_question.c.user_id == user_id,
+                                                         user_asked_question.c.question_id == question.id)).scalar():
+            return question
+    # The order changes when questions are added to the quiz, a final scan finds questions that moved before the cursor
+    return get_unanswered_question_legacy(user_id, quiz_id)
+
+
 def get_open_question(user_id, quiz_id=None, room_id=None, is_answered=None):
     """
     Retrieves the open question for a user in a specific quiz.
@@ -368,33 +783,35 @@ def get_open_question(user_id, quiz_id=None, room_id=None, is_answered=None):
     :return: The open question object, or None if no open question is found. When is_answered it returns a boolean.
     """
     try:
-        if quiz_id and room_id:
-            open_question = session.query(LastQuestion).filter_by(user_id=user_id,
-                                                                  quiz_id=quiz_id,
-                                                                  room_id=room_id,
-                                                                  answered=False).first()
-        elif quiz_id:
-            open_question = session.query(LastQuestion).filter_by(user_id=user_id,
-                                                                  quiz_id=quiz_id,
-                                                                  answered=False).first()
-        elif room_id:
-            open_question = session.query(LastQuestion).filter_by(user_id=user_id,
-                                                                  room_id=room_id,
-                                                                  answered=False).first()
-        else:
-            open_question = session.query(LastQuestion).filter_by(user_id=user_id,
-                                                                  answered=False).first()
-        if not open_question:
+        open_questions = [question_id for open_quiz_id, (question_id, open_room_id)
+                          in get_user_state(user_id).open_questions.items()
+                          if (not quiz_id or open_quiz_id == quiz_id) and (not room_id or open_room_id == room_id)]
+        if not open_questions:
             return None
         if is_answered:
-            return not open_question.answered
-        question = session.query(DbQuestion).filter_by(id=open_question.question_id).first()
+            return True
+        # Uses the identity map of the session if the question has been loaded before
+        question = session.get(DbQuestion, open_questions[0])
         return question if question else None
     except Exception as e:
         logger.error(f"An error occurred in {util.current_function_name()}: {e}")
         return None
 
 
+def get_open_question_key(user_id, room_id=None):
+    """
+    Retrieves the quiz and the ID of the open question of a user from the cached user state.
+
+    :param user_id: The ID of the user.
+    :param room_id: The ID of the room (optional).
+    :return: A tuple (quiz_id, question_id), or None if the user has no open question.
+    """
+    for quiz_id, (question_id, open_room_id) in get_user_state(user_id).open_questions.items():
+        if not room_id or open_room_id == room_id:
+            return quiz_id, question_id
+    return None
+
+
 def get_model_answer(question_id):
     """
     Retrieves the model answer for a specific question.
@@ -466,7 +883,7 @@ def count_subscribed_quizzes(user_id):
     :param user_id: The ID of the user.
     :return: The number of quizzes the user is subscribed to.
     """
-    return session.query(user_subscribed_to_quiz).filter_by(user_id=user_id).count()
+    return len(get_user_state(user_id).subscriptions)
 
 
 def count_subscribers(quiz_id):
@@ -497,7 +914,6 @@ def update_messages_per_day(user_id, quiz_id, messages_per_day):
     :param messages_per_day: Number of messages to be sent per day
     :return: True if updated, False if not updated
     """
-    session = Session()
     try:
         stmt = (
             update(user_subscribed_to_quiz).
@@ -508,16 +924,18 @@ def update_messages_per_day(user_id, quiz_id, messages_per_day):
 
         # Execute the update statement
         result = session.execute(stmt)
-        session.commit()
+        _commit()
 
         # Check if any row was updated
         if result.rowcount > 0:
+            user_state_cache.update(user_id, lambda state: state.subscriptions.update(
+                {quiz_id: (state.subscriptions.get(quiz_id, (None, None))[0], messages_per_day)}))
             return True
         else:
             return False
 
     except Exception as e:
-        session.rollback()
+        _rollback()
         logger.error(f"An error occurred in {util.current_function_name()}: {e}")
         return False
 
@@ -531,19 +949,19 @@ def update_quiz_attributes(quiz_id, name, messages_per_day):
     :param messages_per_day: The new number of messages per day for the quiz.
     :return: True if the quiz was successfully updated, False otherwise.
     """
-    session = Session()
     try:
         quiz = session.query(DbQuiz).filter_by(id=quiz_id).first()
         if quiz:
             quiz.name = name
             quiz.messages_per_day = messages_per_day
-            session.commit()
+            bump_quiz_revision(quiz_id)
+            _commit()
             return True
         else:
             return False
 
     except Exception as e:
-        session.rollback()
+        _rollback()
         logger.error(f"An error occurred in {util.current_function_name()}: {e}")
         return False
 
@@ -558,7 +976,6 @@ def update_last_question(user_id, quiz_id, question_id, room_id, answered=False)
     :param room_id: The ID of the room.
     :param answered: Boolean indicating whether the question was answered.
     """
-    session = Session()
     try:
         last_question = session.query(LastQuestion).filter_by(user_id=user_id, quiz_id=quiz_id).first()
         if last_question:
@@ -581,24 +998,35 @@ def update_last_question(user_id, quiz_id, question_id, room_id, answered=False)
             )
             session.add(last_question)
 
-        session.commit()
+        _commit()
+        if answered:
+            user_state_cache.update(user_id, lambda state: state.open_questions.pop(quiz_id, None))
+        else:
+            user_state_cache.update(user_id, lambda state: state.open_questions.update(
+                {quiz_id: (question_id, room_id)}))
     except Exception as e:
-        session.rollback()
+        user_state_cache.invalidate(user_id)
+        _rollback()
         logger.error(f"An error occurred in {util.current_function_name()}: {e}")
 
 
-def update_user_asked_question(user_id, question_id):
+def update_user_asked_question(user_id, question_id, quiz_id=None):
     """
     Updates the user answered question information in the database.
 
     :param user_id: The ID of the user.
     :param question_id: The ID of the question.
-    """
-    exists = session.query(user_asked_question).filter_by(user_id=user_id, question_id=question_id).count() > 0
-    if not exists:
-        stmt = user_asked_question.insert().values(user_id=user_id, question_id=question_id, ts=datetime.now())
-        session.execute(stmt)
-        session.commit()
+    :param quiz_id: The ID of the quiz of the question (optional, keeps the cached count of the user up to date).
+    """
+    inserted = upsert(user_asked_question, {'user_id': user_id, 'question_id': question_id, 'ts': datetime.now()},
+                      ['user_id', 'question_id'])
+    if inserted:
+        _commit()
+        if quiz_id:
+            user_state_cache.update(user_id, lambda state: state.asked_today.update(
+                {quiz_id: state.asked_today.get(quiz_id, 0) + 1}))
+        else:
+            user_state_cache.invalidate(user_id)
 
 
 def is_user_subscribed(user_id, quiz_id):
@@ -609,7 +1037,7 @@ def is_user_subscribed(user_id, quiz_id):
     :param quiz_id: The ID of the quiz.
     :return: True if the user is subscribed to the quiz, False otherwise.
     """
-    return session.query(user_subscribed_to_quiz).filter_by(user_id=user_id, quiz_id=quiz_id).count() > 0
+    return quiz_id in get_user_state(user_id).subscriptions
 
 
 def has_open_question(user_id, quiz_id=None, room_id=None):
@@ -637,11 +1065,15 @@ def subscribe_user_to_quiz(user_id, quiz_id, room_id):
         try:
             quiz = get_quiz_by_id(quiz_id)
             messages_per_day = quiz.messages_per_day
+            shuffle_seed = random.randrange(2 ** 31) if QUESTION_SHUFFLE else None
             session.execute(user_subscribed_to_quiz.insert().values(user_id=user_id, quiz_id=quiz_id, room_id=room_id,
-                                                                    messages_per_day=messages_per_day))
-            session.commit()
+                                                                    messages_per_day=messages_per_day,
+                                                                    next_position=0, shuffle_seed=shuffle_seed))
+            _commit()
+            user_state_cache.update(user_id, lambda state: state.subscriptions.update(
+                {quiz_id: (room_id, messages_per_day)}))
         except Exception as e:
-            session.rollback()
+            _rollback()
             logger.error(e)
             return False
     else:
@@ -660,10 +1092,11 @@ def unsubscribe_user_from_quiz(user_id, quiz_id):
     if is_user_subscribed(user_id, quiz_id):
         try:
             session.query(user_subscribed_to_quiz).filter_by(user_id=user_id, quiz_id=quiz_id).delete()
-            session.commit()
+            _commit()
+            user_state_cache.update(user_id, lambda state: state.subscriptions.pop(quiz_id, None))
             reset_quiz_by_id(quiz_id, user_id)
         except Exception as e:
-            session.rollback()
+            _rollback()
             logger.error(e)
             return False
     else:
@@ -707,14 +1140,26 @@ def delete_quiz_by_id(quiz_id):
         # Delete the quiz itself
         session.delete(quiz)
 
-        session.commit()
+        bump_quiz_revision(quiz_id)
+        _commit()
+        user_state_cache.clear()
+        question_cache.invalidate_quiz(quiz_id)
     except Exception as e:
-        session.rollback()
+        _rollback()
         logger.error(e)
         return False
     return True
 
 
+def delete_progress(user_id, quiz_id):
+    # Deletes the last question and the asked questions of a user in a quiz and moves the cursor to the start
+    session.query(LastQuestion).filter_by(quiz_id=quiz_id, user_id=user_id).delete()
+    session.execute(user_asked_question.delete().where(
+        user_asked_question.c.user_id == user_id,
+        user_asked_question.c.question_id.in_(select(DbQuestion.id).where(DbQuestion.quiz_id == quiz_id))))
+    set_progress(user_id, quiz_id, 0)
+
+
 def reset_quiz_by_id(quiz_id, user_id):
     """
     Resets a quiz for a specific user by deleting related entries.
@@ -724,18 +1169,13 @@ def reset_quiz_by_id(quiz_id, user_id):
     :return: True if the reset was successful, False otherwise.
     """
     try:
-        quiz = session.query(DbQuiz).filter_by(id=quiz_id).first()
-        if not quiz:
+        if not session.query(exists().where(DbQuiz.id == quiz_id)).scalar():
             return
-
-        # Delete all entries in last_question
-        session.query(LastQuestion).filter_by(quiz_id=quiz_id, user_id=user_id).delete()
-        # Delete all entries in user_asked_question
-        for question in quiz.questions:
-            session.query(user_asked_question).filter_by(question_id=question.id, user_id=user_id).delete()
-        session.commit()
+        delete_progress(user_id, quiz_id)
+        _commit()
+        user_state_cache.invalidate(user_id)
     except Exception as e:
-        session.rollback()
+        _rollback()
         logger.error(e)
         return False
     return True
@@ -752,13 +1192,236 @@ def ask_question_to_user(user_id, quiz_id, question_id, room_id):
     """
     try:
         update_last_question(user_id, quiz_id, question_id, room_id)
-        update_user_asked_question(user_id, question_id)
+        update_user_asked_question(user_id, question_id, quiz_id)
+        advance_progress(user_id, quiz_id, question_id)
     except Exception as e:
-        session.rollback()
+        _rollback()
         logger.error(e)
         return False
     return True
 
 
+def advance_progress(user_id, quiz_id, question_id):
+    """
+    Moves the progress cursor of a subscription behind the asked question. The cursor never moves back, a
+    question asked out of order does not repeat the questions before it.
+
+    :param user_id: The ID of the user.
+    :param quiz_id: The ID of the quiz.
+    :param question_id: The ID of the asked question.
+    """
+    progress = get_progress(user_id, quiz_id)
+    position = session.query(DbQuestion.position).filter_by(id=question_id).scalar()
+    if progress is None or position is None:
+        return
+    index = position
+    if progress.shuffle_seed is not None:
+        order = shuffled_positions(progress.shuffle_seed, count_positions(quiz_id))
+        index = order.index(position) if position in order else progress.next_position or 0
+    set_progress(user_id, quiz_id, index + 1, only_forward=True)
+    _commit()
+
+
+def dialect_insert(table):
+    # An INSERT with ON CONFLICT clauses, None if the database does not support them
+    insert = UPSERT_DIALECTS.get(engine.dialect.name)
+    return insert(table) if insert else None
+
+
+def upsert(table, values, key, update_columns=None):
+    """
+    Inserts a row in a single statement. If a row with the same key exists, the update columns are set to the
+    new values, without update columns the existing row is kept.
+
+    :param table: The table to insert into.
+    :param values: A dict with the values of the row.
+    :param key: The columns of the unique index identifying the row.
+    :param update_columns: The columns to update on an existing row, or a dict column -> new value (optional).
+    :return: The number of inserted or updated rows.
+    """
+    stmt = dialect_insert(table)
+    if stmt is not None:
+        stmt = stmt.values(**values)
+        if update_columns:
+            set_ = update_columns if isinstance(update_columns, dict) else \
+                {column: stmt.excluded[column] for column in update_columns}
+            stmt = stmt.on_conflict_do_update(index_elements=key, set_=set_)
+        else:
+            stmt = stmt.on_conflict_do_nothing(index_elements=key)
+        return session.execute(stmt).rowcount
+    # Other databases check for the row first
+    match = [table.c[column] == values[column] for column in key]
+    if update_columns:
+        set_ = update_columns if isinstance(update_columns, dict) else \
+            {column: values[column] for column in update_columns}
+        result = session.execute(update(table).where(*match).values(**set_))
+        if result.rowcount:
+            return result.rowcount
+    elif session.query(exists().where(*match)).scalar():
+        return 0
+    return session.execute(table.insert().values(**values)).rowcount
+
+
+def record_answer(user_id, quiz_id, question_id, room_id):
+    """
+    Records the answer to the open question of a user in one transaction: the question is marked as asked, the
+    last question as answered and, if no question is left, the user is unsubscribed and the progress deleted.
+
+    :param user_id: The ID of the user.
+    :param quiz_id: The ID of the quiz.
+    :param question_id: The ID of the answered question.
+    :param room_id: The ID of the room the answer was sent to.
+    :return: True if the user completed the quiz, False if questions are left, None if an error occurred.
+    """
+    now = datetime.now()
+    try:
+        with unit_of_work():
+            inserted = upsert(user_asked_question, {'user_id': user_id, 'question_id': question_id, 'ts': now},
+                              ['user_id', 'question_id'])
+            upsert(LastQuestion.__table__, {'user_id': user_id, 'quiz_id': quiz_id, 'question_id': question_id,
+                                            'room_id': room_id, 'answered': True, 'answered_ts': now},
+                   ['user_id', 'quiz_id'], ['question_id', 'room_id', 'answered', 'answered_ts'])
+            completed = get_unanswered_question(user_id, quiz_id) is None
+            if completed:
+                session.query(user_subscribed_to_quiz).filter_by(user_id=user_id, quiz_id=quiz_id).delete()
+                delete_progress(user_id, quiz_id)
+            _commit()
+    except Exception as e:
+        user_state_cache.invalidate(user_id)
+        if in_unit_of_work():
+            # The enclosing unit is rolled back, its caller has to see the error
+            raise
+        logger.error(f"An error occurred in {util.current_function_name()}: {e}")
+        return None
+    if completed:
+        user_state_cache.invalidate(user_id)
+    else:
+        def answered(state):
+            state.open_questions.pop(quiz_id, None)
+            if inserted:
+                state.asked_today[quiz_id] = state.asked_today.get(quiz_id, 0) + 1
+        user_state_cache.update(user_id, answered)
+    return completed
+
+
+def acquire_shard_lease(shard_index, worker_count, owner, duration):
+    """
+    Acquires or renews the lease of a shard. The lease is granted if it is free, expired or already held by the owner,
+    and no other worker holds a lease for a different number of shards. The rooms of shards of different worker
+    counts overlap, so workers started with a new worker count wait until the leases of the old ones expired.
+    The times are in UTC, the workers may run on hosts in different time zones.
+
+    :param shard_index: The index of the shard.
+    :param worker_count: The number of shards the rooms are partitioned into.
+    :param owner: A unique name of the worker process.
+    :param duration: The number of seconds the lease is valid.
+    :return: The expiry datetime (UTC) of the lease if it was granted, None otherwise.
+    """
+    now = util.utc_now()
+    expires_ts = now + timedelta(seconds=duration)
+    try:
+        stmt = dialect_insert(ShardLease.__table__)
+        if stmt is not None and engine.dialect.insert_returning:
+            # One statement: the row is inserted, or taken over only if it is held by the owner or expired
+            stmt = stmt.values(shard_index=shard_index, worker_count=worker_count, owner=owner, expires_ts=expires_ts)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['shard_index'],
+                set_={'owner': owner, 'worker_count': worker_count, 'expires_ts': expires_ts},
+                where=or_(ShardLease.owner == owner, ShardLease.expires_ts < now)
+            ).returning(ShardLease.expires_ts)
+            granted = session.execute(stmt).scalar()
+        else:
+            # The conditional update makes sure only one worker can take over an expired lease
+            result = session.execute(
+                update(ShardLease).
+                where(ShardLease.shard_index == shard_index).
+                where(or_(ShardLease.owner == owner, ShardLease.expires_ts < now)).
+                values(owner=owner, worker_count=worker_count, expires_ts=expires_ts)
+            )
+            granted = expires_ts
+            if result.rowcount == 0:
+                if session.query(exists().where(ShardLease.shard_index == shard_index)).scalar():
+                    granted = None
+                else:
+                    session.add(ShardLease(shard_index=shard_index, worker_count=worker_count, owner=owner,
+                                           expires_ts=expires_ts))
+        # Checked after the write, so of two workers with different worker counts at least the later one sees
+        # the lease of the other
+        if granted and session.query(exists().where(ShardLease.worker_count != worker_count,
+                                                    ShardLease.owner != owner,
+                                                    ShardLease.expires_ts >= now)).scalar():
+            logger.warning(f"Shard {shard_index}/{worker_count} waits for the leases of another worker count")
+            granted = None
+        if granted is None:
+            _rollback()
+            return None
+        _commit()
+        return granted
+    except Exception as e:
+        _rollback()
+        logger.error(f"An error occurred in {util.current_function_name()}: {e}")
+        return None
+
+
+def release_shard_lease(shard_index, owner):
+    """
+    Releases the lease of a shard so another worker can take it over immediately.
+
+    :param shard_index: The index of the shard.
+    :param owner: The unique name of the worker process holding the lease.
+    """
+    try:
+        session.query(ShardLease).filter_by(shard_index=shard_index, owner=owner).delete()
+        _commit()
+    except Exception as e:
+        _rollback()
+        logger.error(f"An error occurred in {util.current_function_name()}: {e}")
+
+
+def record_processed_event(event_id, room_id, max_events):
+    """
+    Records that an event was processed. Only the newest max_events events are kept.
+
+    :param event_id: The id of the Matrix event.
+    :param room_id: The id of the room the event was sent to.
+    :param max_events: The number of events to keep.
+    :return: True if the event was not processed before, False if it was already recorded.
+    """
+    global processed_events_recorded
+    try:
+        if not upsert(ProcessedEvent.__table__, {'event_id': event_id, 'room_id': room_id, 'ts': datetime.now()},
+                      ['event_id']):
+            return False
+        _commit()
+    except IntegrityError:
+        _rollback()
+        return False
+    except Exception as e:
+        _rollback()
+        logger.error(f"An error occurred in {util.current_function_name()}: {e}")
+        return True
+    processed_events_recorded += 1
+    if processed_events_recorded % PRUNE_INTERVAL == 0:
+        prune_processed_events(max_events)
+    return True
+
+
+def prune_processed_events(max_events):
+    """
+    Deletes all but the newest max_events processed events.
+
+    :param max_events: The number of events to keep.
+    """
+    try:
+        cutoff = session.query(ProcessedEvent.ts).order_by(ProcessedEvent.ts.desc()) \
+            .offset(max_events).limit(1).scalar()
+        if cutoff is not None:
+            session.query(ProcessedEvent).filter(ProcessedEvent.ts <= cutoff).delete(synchronize_session=False)
+            _commit()
+    except Exception as e:
+        _rollback()
+        logger.error(f"An error occurred in {util.current_function_name()}: {e}")
+
+
 if __name__ == '__main__':
     pass
@@ -1,9 +1,8 @@
-from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from store import db_config
+from store.db_engine import get_engine
 from store.models import Quiz, Question, Answer, Feedback
 
-engine = create_engine(db_config.Config.get_db_uri())
+engine = get_engine()
 Session = sessionmaker(bind=engine)
 session = Session()
 
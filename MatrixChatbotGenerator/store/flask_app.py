@@ -1,12 +1,13 @@
 import os
 import uuid
 
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, make_response
 from dotenv import load_dotenv
-from store.models import Quiz, Question, Answer, Feedback
+from store.models import Quiz, Question, Answer, Feedback, ensure_schema
 from store.db_operations import get_all_quizzes, count_subscribers, get_all_questions_for_quiz, get_quiz_by_id, \
     update_quiz_attributes, delete_quiz_by_id, add_quiz_to_db, add_db_question_to_db, add_db_answer_to_db, \
-    add_db_feedback_to_db, count_questions
+    add_db_feedback_to_db, count_questions, begin_unit, end_unit, in_unit_of_work
+from util import utility_functions as util
 
 ssl_enabled = False
 app = Flask(__name__)
@@ -15,6 +16,31 @@ load_dotenv()
 FLASK_PORT = os.getenv('FLASK_PORT')
 FLASK_HOST = os.getenv('FLASK_HOST')
 
+logger = util.create_logger('flask_app')
+
+
+# Every request runs in one unit of work, the changes are committed once before the response is sent
+@app.before_request
+def begin_request_unit():
+    begin_unit()
+
+
+@app.after_request
+def commit_request_unit(response):
+    try:
+        end_unit()
+    except Exception as e:
+        logger.error(f"Committing the request failed: {e}")
+        return make_response(jsonify({'error': 'The changes could not be saved'}), 500)
+    return response
+
+
+@app.teardown_request
+def remove_request_session(exception=None):
+    # Rolls back and closes the session if the request ended with an exception
+    if in_unit_of_work():
+        end_unit(exception or RuntimeError('request ended without a response'))
+
 
 @app.route('/quizzes', methods=['GET'])
 def fetch_all_quizzes():
@@ -125,6 +151,7 @@ def quizbot_info():
 
 
 def main():
+    ensure_schema()
     if ssl_enabled:
         app.run(host=FLASK_HOST, port=FLASK_PORT,  ssl_context=('cert.pem', 'key.pem'))    # Adjust port number
     else:
@@ -1,11 +1,10 @@
-from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
+from store.db_engine import get_engine
 from store.models import Base
-from store import db_config
 
 
 def init_db():
-    engine = create_engine(db_config.Config.get_db_uri())
+    engine = get_engine()
     Base.metadata.create_all(engine)
 
     Session = sessionmaker(bind=engine)
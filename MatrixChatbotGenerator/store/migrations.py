@@ -0,0 +1,123 @@
+from sqlalchemy import inspect, text
+
+from util import utility_functions as util
+
+logger = util.create_logger('migrations')
+
+# Columns added to existing tables after the first release, create_all only creates missing tables
+COLUMNS = [
+    ('question', 'position', 'INTEGER'),
+    ('user_subscribed_to_quiz', 'next_position', 'INTEGER'),
+    ('user_subscribed_to_quiz', 'shuffle_seed', 'INTEGER'),
+]
+
+# Lookup keys that had no unique index at first, duplicates have to be removed before the index is created.
+# The row kept of each duplicate group is the first one in the order column. On SQLite rowid keeps the earliest
+# inserted row, other databases have no insertion order and get the unique indexes with their tables.
+UNIQUE_KEYS = {
+    'user_subscribed_to_quiz': (('user_id', 'quiz_id'), 'rowid'),
+    'user_asked_question': (('user_id', 'question_id'), 'ts'),
+}
+
+
+def add_missing_columns(connection):
+    inspector = inspect(connection)
+    added = []
+    for table, column, column_type in COLUMNS:
+        if column not in {existing['name'] for existing in inspector.get_columns(table)}:
+            connection.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}'))
+            added.append(f'{table}.{column}')
+    return added
+
+
+def number_questions(connection):
+    """
+    Gives every question without a position the next position in its quiz. Existing questions keep the order in
+    which they were returned before positions existed, so running subscriptions continue where they are.
+
+    :param connection: An open connection inside a transaction.
+    :return: The number of questions that got a position.
+    """
+    # Without an ORDER BY SQLite returned the questions in rowid order, other databases fall back to the id
+    order = 'rowid' if connection.dialect.name == 'sqlite' else 'id'
+    rows = connection.execute(text(
+        f'SELECT id, quiz_id FROM question WHERE position IS NULL ORDER BY quiz_id, {order}')).all()
+    if not rows:
+        return 0
+    next_positions = dict(connection.execute(text(
+        'SELECT quiz_id, MAX(position) + 1 FROM question WHERE position IS NOT NULL GROUP BY quiz_id')).all())
+    for question_id, quiz_id in rows:
+        position = next_positions.get(quiz_id) or 0
+        connection.execute(text('UPDATE question SET position = :position WHERE id = :id'),
+                           {'position': position, 'id': question_id})
+        next_positions[quiz_id] = position + 1
+    return len(rows)
+
+
+def remove_duplicates(connection, table, key, order):
+    """
+    Keeps one row of every group of rows with the same key.
+
+    :param connection: An open connection inside a transaction.
+    :param table: The name of the table.
+    :param key: The columns that have to be unique.
+    :param order: The column deciding which row is kept, the row with the smallest value wins.
+    :return: The number of deleted rows.
+    """
+    if order == 'rowid' and connection.dialect.name != 'sqlite':
+        # No insertion order, all columns give a stable choice
+        order = ', '.join(column['name'] for column in inspect(connection).get_columns(table))
+    columns = ', '.join(key)
+    match = ' AND '.join(f'{column} = :{column}' for column in key)
+    groups = connection.execute(text(
+        f'SELECT {columns}, COUNT(*) FROM {table} GROUP BY {columns} HAVING COUNT(*) > 1')).all()
+    if not groups:
+        return 0
+    # Without an index every group would scan the table
+    connection.execute(text(f'CREATE INDEX ix_{table}_dedupe ON {table} ({columns})'))
+    removed = 0
+    for group in groups:
+        values = dict(zip(key, group[:len(key)]))
+        rows = connection.execute(text(f'SELECT * FROM {table} WHERE {match} ORDER BY {order}'), values).\
+            mappings().all()
+        kept = dict(rows[0])
+        connection.execute(text(f'DELETE FROM {table} WHERE {match}'), values)
+        connection.execute(text(f'INSERT INTO {table} ({", ".join(kept)}) '
+                                f'VALUES ({", ".join(":" + column for column in kept)})'), kept)
+        removed += len(rows) - 1
+    connection.execute(text(f'DROP INDEX ix_{table}_dedupe'))
+    return removed
+
+
+def create_missing_indexes(connection, metadata):
+    existing = {table: {index['name'] for index in inspect(connection).get_indexes(table)}
+                for table in metadata.tables}
+    created = []
+    for table in metadata.tables.values():
+        for index in table.indexes:
+            if index.name in existing[table.name]:
+                continue
+            if index.unique and table.name in UNIQUE_KEYS:
+                removed = remove_duplicates(connection, table.name, *UNIQUE_KEYS[table.name])
+                if removed:
+                    logger.warning(f"Removed {removed} duplicate rows from {table.name}")
+            index.create(connection)
+            created.append(index.name)
+    return created
+
+
+def upgrade(engine, metadata):
+    """
+    Brings an existing database up to the current models. Every step checks whether it is needed, so the
+    upgrade can run on every start.
+
+    :param engine: The engine of the database.
+    :param metadata: The metadata of the models, its indexes are created if they are missing.
+    """
+    with engine.begin() as connection:
+        added = add_missing_columns(connection)
+        numbered = number_questions(connection)
+        created = create_missing_indexes(connection, metadata)
+    if added or numbered or created:
+        logger.info(f"Upgraded the database: added columns {added}, numbered {numbered} questions, "
+                    f"created indexes {created}")
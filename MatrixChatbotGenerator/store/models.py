@@ -1,8 +1,9 @@
 import uuid
-from sqlalchemy import create_engine, Column, String, Boolean, ForeignKey, Table, Integer, DateTime
+from sqlalchemy import event, func, Column, String, Boolean, ForeignKey, Table, Integer, DateTime, Index
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import relationship, sessionmaker
-from store import db_config
+from sqlalchemy.orm import relationship, sessionmaker, Session as OrmSession
+from store import migrations
+from store.db_engine import get_engine
 
 Base = declarative_base()
 
@@ -11,13 +12,19 @@ user_subscribed_to_quiz = Table('user_subscribed_to_quiz', Base.metadata,
                                 Column('user_id', String, ForeignKey('user.id')),
                                 Column('quiz_id', String, ForeignKey('quiz.id')),
                                 Column('room_id', String),
-                                Column('messages_per_day', Integer)
+                                Column('messages_per_day', Integer),
+                                Column('next_position', Integer),  # progress cursor, see get_unanswered_question
+                                Column('shuffle_seed', Integer),  # None asks the questions in quiz order
+                                Index('ux_user_subscribed_to_quiz_user_quiz', 'user_id', 'quiz_id', unique=True),
+                                Index('ix_user_subscribed_to_quiz_quiz', 'quiz_id')
                                 )
 
 user_asked_question = Table('user_asked_question', Base.metadata,
                             Column('user_id', String, ForeignKey('user.id')),
                             Column('question_id', String, ForeignKey('question.id')),
-                            Column('ts', DateTime)
+                            Column('ts', DateTime),
+                            Index('ux_user_asked_question_user_question', 'user_id', 'question_id', unique=True),
+                            Index('ix_user_asked_question_ts', 'ts')
                             )
 
 
@@ -48,12 +55,15 @@ class Question(Base):
     is_essay = Column(Boolean)
     is_multiple_choice = Column(Boolean)
     quiz_id = Column(String, ForeignKey('quiz.id'))
+    position = Column(Integer)  # order of the question in its quiz, assigned when the question is added
 
     quiz = relationship("Quiz", back_populates="questions")
     answers = relationship("Answer", back_populates="question")
     feedback = relationship("Feedback", back_populates="question")
     users = relationship("User", secondary=user_asked_question, back_populates="questions")
 
+    __table_args__ = (Index('ix_question_quiz_position', 'quiz_id', 'position'),)
+
 
 class Answer(Base):
     __tablename__ = 'answer'
@@ -61,7 +71,7 @@ class Answer(Base):
     identifier = Column(String)
     text = Column(String)
     is_correct = Column(Boolean)
-    question_id = Column(String, ForeignKey('question.id'))
+    question_id = Column(String, ForeignKey('question.id'), index=True)
 
     question = relationship("Question", back_populates="answers")
 
@@ -75,6 +85,8 @@ class Feedback(Base):
 
     question = relationship("Question", back_populates="feedback")
 
+    __table_args__ = (Index('ix_feedback_question_identifier', 'question_id', 'identifier'),)
+
 
 class LastQuestion(Base):
     __tablename__ = 'last_question'
@@ -90,10 +102,58 @@ class LastQuestion(Base):
     quiz = relationship("Quiz")
     question = relationship("Question")
 
+    __table_args__ = (Index('ix_last_question_user_answered_room', 'user_id', 'answered', 'room_id'),)
+
+
+class QuizRevision(Base):
+    __tablename__ = 'quiz_revision'
+    quiz_id = Column(String, primary_key=True)
+    revision = Column(Integer)
 
-# Create the database
-engine = create_engine(db_config.Config.get_db_uri())
-Base.metadata.create_all(engine)
+
+class ShardLease(Base):
+    __tablename__ = 'shard_lease'
+    shard_index = Column(Integer, primary_key=True)
+    worker_count = Column(Integer)
+    owner = Column(String)
+    expires_ts = Column(DateTime)
+
+
+class ProcessedEvent(Base):
+    __tablename__ = 'processed_event'
+    event_id = Column(String, primary_key=True)
+    room_id = Column(String)
+    ts = Column(DateTime, index=True)
+
+
+@event.listens_for(OrmSession, 'before_flush')
+def number_new_questions(db_session, flush_context, instances):
+    # New questions are appended to their quiz, no matter which code path adds them
+    next_positions = {}
+    for instance in db_session.new:
+        if not isinstance(instance, Question) or instance.position is not None:
+            continue
+        quiz_id = instance.quiz_id or (instance.quiz.id if instance.quiz else None)
+        if quiz_id not in next_positions:
+            with db_session.no_autoflush:
+                last_position = db_session.query(func.max(Question.position)).filter_by(quiz_id=quiz_id).scalar()
+            next_positions[quiz_id] = 0 if last_position is None else last_position + 1
+        instance.position = next_positions[quiz_id]
+        next_positions[quiz_id] += 1
+
+
+# Create the database engine, the tables are created by ensure_schema when a process starts
+engine = get_engine()
+schema_checked = False
+
+
+def ensure_schema():
+    # Creates missing tables and upgrades existing ones, the check runs once per process
+    global schema_checked
+    if not schema_checked:
+        Base.metadata.create_all(engine)
+        migrations.upgrade(engine, Base.metadata)
+        schema_checked = True
 
 # Create a session
 Session = sessionmaker(bind=engine)
@@ -0,0 +1,86 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+from structures.answer_matcher import AnswerMatcher
+
+load_dotenv()
+
+QUESTION_CACHE_SIZE = int(os.getenv('QUESTION_CACHE_SIZE', 5000))
+QUESTION_CACHE_CHECK_INTERVAL = int(os.getenv('QUESTION_CACHE_CHECK_INTERVAL', 30))  # seconds between revision checks
+
+
+class CachedQuestion:
+    def __init__(self, question, db_question):
+        self.id = question.id
+        self.quiz_id = db_question.quiz_id
+        self.is_essay = db_question.is_essay
+        self.is_multiple_choice = db_question.is_multiple_choice
+        self.body = question.get()  # the message sent to ask the question
+        self.answers = question.answers
+        self.matcher = AnswerMatcher(question.answers)
+        self.feedback = {}  # identifier -> text of the first feedback with that identifier
+        for feedback in db_question.feedback:
+            self.feedback.setdefault(feedback.identifier, feedback.text)
+
+    def get_feedback(self, correct=False):
+        identifier = 'Correct' if correct else 'InCorrect'
+        return self.feedback[identifier] if identifier in self.feedback else self.feedback.get('FEEDBACK')
+
+
+class QuestionCache:
+    """
+    Size-bounded LRU cache of rendered questions keyed by question id. Questions are loaded per quiz and dropped
+    per quiz when the revision of the quiz in the database changes.
+    """
+
+    def __init__(self, max_size=QUESTION_CACHE_SIZE, check_interval=QUESTION_CACHE_CHECK_INTERVAL):
+        self.max_size = max_size
+        self.check_interval = check_interval
+        self.entries = OrderedDict()  # question_id -> CachedQuestion
+        self.revisions = {}  # quiz_id -> revision the cached questions were loaded with
+        self.checked = time.monotonic()
+        self.lock = threading.Lock()
+
+    def get(self, question_id):
+        with self.lock:
+            entry = self.entries.get(question_id)
+            if entry is not None:
+                self.entries.move_to_end(question_id)
+            return entry
+
+    def put_quiz(self, quiz_id, revision, questions):
+        with self.lock:
+            self.revisions[quiz_id] = revision
+            for question in questions:
+                self.entries[question.id] = question
+                self.entries.move_to_end(question.id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate_quiz(self, quiz_id):
+        with self.lock:
+            self.revisions.pop(quiz_id, None)
+            for question_id in [key for key, entry in self.entries.items() if entry.quiz_id == quiz_id]:
+                del self.entries[question_id]
+
+    def needs_check(self):
+        return self.revisions and time.monotonic() - self.checked > self.check_interval
+
+    def check_revisions(self, revisions):
+        # Drops every quiz whose revision in the database differs from the cached one
+        self.checked = time.monotonic()
+        for quiz_id, revision in list(self.revisions.items()):
+            if revisions.get(quiz_id, 0) != revision:
+                self.invalidate_quiz(quiz_id)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.revisions.clear()
+
+
+question_cache = QuestionCache()
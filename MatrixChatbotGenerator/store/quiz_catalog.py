@@ -0,0 +1,72 @@
+import threading
+import time
+
+from store.question_cache import QUESTION_CACHE_CHECK_INTERVAL
+
+
+class CatalogQuiz:
+    def __init__(self, db_quiz):
+        self.id = db_quiz.id
+        self.name = db_quiz.name
+        self.messages_per_day = db_quiz.messages_per_day
+        self.short_id = db_quiz.short_id
+
+
+class QuizCatalog:
+    """
+    In-memory snapshot of all quizzes with lookups by id, short id and name. The snapshot is reloaded when the
+    quiz revisions in the database change, which also happens when another process adds or edits a quiz.
+    """
+
+    def __init__(self, check_interval=QUESTION_CACHE_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self.quizzes = []
+        self.by_id = {}
+        self.by_short_id = {}
+        self.by_name = {}  # lower case name -> quiz, the first quiz wins if names are equal
+        self.revisions = None  # quiz revisions the snapshot was loaded with, None if not loaded
+        self.checked = 0.0
+        self.lock = threading.Lock()
+
+    def load(self, db_quizzes, revisions):
+        quizzes = [CatalogQuiz(db_quiz) for db_quiz in db_quizzes]
+        by_name = {}
+        for quiz in quizzes:
+            by_name.setdefault(quiz.name.lower() if quiz.name else '', quiz)
+        with self.lock:
+            self.quizzes = quizzes
+            self.by_id = {quiz.id: quiz for quiz in quizzes}
+            self.by_short_id = {quiz.short_id: quiz for quiz in quizzes}
+            self.by_name = by_name
+            self.revisions = revisions
+            self.checked = time.monotonic()
+
+    def is_loaded(self):
+        return self.revisions is not None
+
+    def needs_check(self):
+        return not self.is_loaded() or time.monotonic() - self.checked > self.check_interval
+
+    def is_current(self, revisions):
+        self.checked = time.monotonic()
+        return revisions == self.revisions
+
+    def get(self, quiz_id):
+        return self.by_id.get(quiz_id)
+
+    def find(self, name_or_number):
+        # Same lookup as the bot commands: the name first, then the short id
+        if not name_or_number:
+            return None
+        key = str(name_or_number).strip()
+        quiz = self.by_name.get(key.lower())
+        if quiz is None and key.isdigit():
+            quiz = self.by_short_id.get(int(key))
+        return quiz
+
+    def invalidate(self):
+        with self.lock:
+            self.revisions = None
+
+
+quiz_catalog = QuizCatalog()
@@ -1,10 +1,9 @@
-from sqlalchemy import create_engine
+from store.db_engine import get_engine
 from store.models import Base
-from store import db_config
 
 
 def recreate_db():
-    engine = create_engine(db_config.Config.get_db_uri())
+    engine = get_engine()
     Base.metadata.drop_all(engine)
     Base.metadata.create_all(engine)
 
@@ -0,0 +1,86 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+USER_STATE_CACHE_SIZE = int(os.getenv('USER_STATE_CACHE_SIZE', 10000))
+USER_STATE_CACHE_TTL = int(os.getenv('USER_STATE_CACHE_TTL', 300))  # bounds staleness against the Flask app
+
+
+class UserState:
+    def __init__(self, day, subscriptions=None, open_questions=None, asked_today=None):
+        self.day = day
+        self.subscriptions = subscriptions if subscriptions else {}  # quiz_id -> (room_id, messages_per_day)
+        self.open_questions = open_questions if open_questions else {}  # quiz_id -> (question_id, room_id)
+        self.asked_today = asked_today if asked_today else {}  # quiz_id -> questions asked on day
+
+    def copy(self):
+        # The values are tuples and numbers, copying the dicts is enough for an independent snapshot
+        return UserState(self.day, dict(self.subscriptions), dict(self.open_questions), dict(self.asked_today))
+
+
+class UserStateCache:
+    """
+    Size-bounded LRU cache of the per-user state used on the command path.
+    Entries are kept up to date by the db_operations functions that change the state. Changes are applied under
+    the lock and get returns a copy, so a DB thread never sees a half-applied change of another one.
+    Only changes of the own process are seen. Sharded workers partition by room, so a user with rooms on two
+    shards is changed by both workers, and the cache is disabled when more than one worker runs.
+    """
+
+    def __init__(self, max_size=USER_STATE_CACHE_SIZE, ttl=USER_STATE_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()  # user_id -> (loaded timestamp, UserState)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id, day):
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is None or entry[1].day != day or time.monotonic() - entry[0] > self.ttl:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(user_id)
+            self.hits += 1
+            # Updates are applied under the lock, callers read a snapshot outside of it
+            return entry[1].copy()
+
+    def put(self, user_id, state):
+        if self.max_size <= 0:
+            return
+        with self.lock:
+            # The caller keeps using its state, the cache holds its own copy
+            self.entries[user_id] = (time.monotonic(), state.copy())
+            self.entries.move_to_end(user_id)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def update(self, user_id, func):
+        # Applies a change to a cached state, users that are not cached are loaded on their next access
+        with self.lock:
+            entry = self.entries.get(user_id)
+            if entry is not None:
+                func(entry[1])
+
+    def invalidate(self, user_id):
+        with self.lock:
+            self.entries.pop(user_id, None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def disable(self):
+        # Every lookup loads the state from the database
+        with self.lock:
+            self.max_size = 0
+            self.entries.clear()
+
+
+user_state_cache = UserStateCache()
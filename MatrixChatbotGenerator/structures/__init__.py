@@ -2,3 +2,4 @@ from . import question
 from . import answer
 from . import feedback
 from . import quiz
+from . import answer_matcher
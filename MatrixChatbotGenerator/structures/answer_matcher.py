@@ -0,0 +1,77 @@
+import re
+
+PUNCTUATION = re.compile(r'[^\w\s]')
+AND = re.compile(r'\band\b')  # only the word "and", not "and" inside other words
+WHITESPACE = re.compile(r'\s+')
+
+CORRECT = 'Correct'
+PARTLY_CORRECT = 'Partly Correct'
+INCORRECT = 'Incorrect'
+
+
+def normalize(text):
+    return WHITESPACE.sub(' ', PUNCTUATION.sub('', text.lower())).strip()
+
+
+def exact(text):
+    return WHITESPACE.sub(' ', text.lower()).strip()
+
+
+class AnswerMatcher:
+    """
+    Matches user input against the answers of a question. Every answer is one bit, the identifiers and answer
+    texts are mapped to their bits once, so evaluating an answer is a few dict lookups and integer operations.
+    """
+
+    def __init__(self, answers):
+        self.texts = {}  # answer text as typed, only lowercased -> bit of the answer
+        self.tokens = {}  # identifier or normalized answer text -> bit of the answer
+        self.correct_mask = 0
+        exact_texts = {}
+        normalized_texts = {}
+        for index, answer in enumerate(answers):
+            bit = 1 << index
+            self.tokens[answer.identifier.lower()] = bit
+            if answer.correct:
+                self.correct_mask |= bit
+            exact_texts.setdefault(exact(answer.text), []).append(bit)
+            normalized_texts.setdefault(normalize(answer.text), []).append(bit)
+        # Answer texts take precedence over identifiers. Texts that only differ in punctuation are ambiguous once
+        # normalized, they only match when typed exactly.
+        for text, bits in exact_texts.items():
+            if text and len(bits) == 1:
+                self.texts[text] = bits[0]
+        for text, bits in normalized_texts.items():
+            if text and len(bits) == 1:
+                self.tokens[text] = bits[0]
+
+    def match_phrase(self, phrase):
+        bit = self.texts.get(exact(phrase))
+        if bit is not None:
+            return bit
+        phrase = normalize(phrase)
+        bit = self.tokens.get(phrase)
+        if bit is not None:
+            return bit
+        mask = 0
+        for token in phrase.split():
+            mask |= self.tokens.get(token, 0)
+        return mask
+
+    def match(self, user_input):
+        # Returns the bitset of the answers given in the user input
+        bit = self.texts.get(exact(user_input))
+        if bit is not None:
+            return bit
+        mask = 0
+        for phrase in AND.split(user_input.lower()):
+            mask |= self.match_phrase(phrase)
+        return mask
+
+    def evaluate(self, user_input):
+        mask = self.match(user_input)
+        if mask == self.correct_mask:
+            return CORRECT
+        if mask & self.correct_mask:
+            return PARTLY_CORRECT
+        return INCORRECT
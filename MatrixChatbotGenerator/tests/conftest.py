@@ -0,0 +1,80 @@
+# The tests run against a throwaway SQLite database, or against PostgreSQL if QUIZBOT_PG_HOST is set and psycopg2 is
+# installed. All tables of the database named by QUIZBOT_PG_TEST_DATABASE (default quizbot_test) are dropped, never
+# point it to the database of a running bot. Run from the MatrixChatbotGenerator directory:
+# python -m pytest tests
+# QUIZBOT_PG_HOST=localhost QUIZBOT_PG_PASSWORD=password python -m pytest tests
+import importlib.util
+import os
+import sqlite3
+import sys
+import tempfile
+
+import pytest
+
+# The modules of the bot are imported relative to the MatrixChatbotGenerator directory
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# The loggers write to ./data, the tests keep their logs and databases out of the checkout
+TEST_DIR = tempfile.mkdtemp(prefix='quizbot-tests-')
+os.chdir(TEST_DIR)
+
+# The engine is created when the store is imported first, the database has to be chosen before
+if os.getenv('QUIZBOT_PG_HOST') and importlib.util.find_spec('psycopg2'):
+    from sqlalchemy.engine import make_url
+
+    from store import db_config
+
+    TEST_URI = make_url(db_config.Config.get_postgres_uri()).\
+        set(database=os.getenv('QUIZBOT_PG_TEST_DATABASE', 'quizbot_test')).render_as_string(hide_password=False)
+    os.environ['QUIZBOT_DB_PROFILE'] = 'postgres'
+else:
+    TEST_URI = f'sqlite:///{os.path.join(TEST_DIR, "quizbot.db")}'
+    os.environ['QUIZBOT_DB_PROFILE'] = 'default'
+os.environ['QUIZBOT_DB_URI'] = TEST_URI
+
+
+@pytest.fixture
+def database():
+    # Empty tables with the current schema and empty caches for every test
+    from store import db_operations as ops, migrations
+    from store.models import Base, engine
+
+    Base.metadata.drop_all(engine)
+    Base.metadata.create_all(engine)
+    migrations.upgrade(engine, Base.metadata)
+    ops.user_state_cache.clear()
+    ops.question_cache.clear()
+    ops.quiz_catalog.invalidate()
+    yield engine
+    ops.Session.remove()
+    engine.dispose()
+
+
+@pytest.fixture
+def legacy_database(tmp_path):
+    # A quizbot.db from before question positions and unique indexes, with rows of a deleted quiz and duplicates
+    path = tmp_path / 'legacy.db'
+    connection = sqlite3.connect(path)
+    connection.executescript("""
+        CREATE TABLE user (id VARCHAR PRIMARY KEY);
+        CREATE TABLE quiz (id VARCHAR PRIMARY KEY, name VARCHAR, messages_per_day INTEGER,
+                           short_id INTEGER NOT NULL UNIQUE);
+        CREATE TABLE question (id VARCHAR PRIMARY KEY, text VARCHAR, is_essay BOOLEAN, is_multiple_choice BOOLEAN,
+                               quiz_id VARCHAR);
+        CREATE TABLE user_subscribed_to_quiz (user_id VARCHAR, quiz_id VARCHAR, room_id VARCHAR,
+                                              messages_per_day INTEGER);
+        CREATE TABLE user_asked_question (user_id VARCHAR, question_id VARCHAR, ts DATETIME);
+        INSERT INTO user VALUES ('@user:localhost');
+        INSERT INTO quiz VALUES ('quiz', 'Quiz', 1, 1);
+        INSERT INTO question VALUES ('second', 'Second', 0, 1, 'quiz'), ('first', 'First', 0, 1, 'quiz'),
+                                    ('orphan', 'Orphan', 0, 1, 'deleted');
+        INSERT INTO user_subscribed_to_quiz VALUES ('@user:localhost', 'quiz', '!first', 1),
+                                                   ('@user:localhost', 'quiz', '!second', 2);
+        INSERT INTO user_asked_question VALUES ('@user:localhost', 'second', '2024-01-01 10:00:00'),
+                                               ('@user:localhost', 'orphan', '2024-01-01 11:00:00'),
+                                               ('@deleted:localhost', 'first', '2024-01-01 12:00:00'),
+                                               ('@user:localhost', 'second', '2024-01-01 09:00:00');
+    """)
+    connection.commit()
+    connection.close()
+    return f'sqlite:///{path}'
@@ -0,0 +1,16 @@
+import pytest
+
+from benchmarks.bench_answer_matching import ANSWERS, CASES
+from structures.answer import Answer
+from structures.answer_matcher import CORRECT, INCORRECT, AnswerMatcher
+
+
+@pytest.mark.parametrize('user_input, expected', CASES)
+def test_evaluate(user_input, expected):
+    assert AnswerMatcher(ANSWERS).evaluate(user_input) == expected
+
+
+def test_answer_texts_take_precedence_over_identifiers():
+    matcher = AnswerMatcher([Answer('A', 'b', False), Answer('B', 'c', True)])
+    assert matcher.evaluate('b') == INCORRECT
+    assert matcher.evaluate('c') == CORRECT
@@ -0,0 +1,32 @@
+import pytest
+
+from store import db_operations as ops
+from store.copy_to_postgres import copy_database
+from store.models import Question, engine, user_asked_question, user_subscribed_to_quiz
+
+pytestmark = [pytest.mark.usefixtures('database'),
+              pytest.mark.skipif(engine.dialect.name != 'postgresql', reason='QUIZBOT_PG_HOST is not set')]
+
+
+def test_copy_database_skips_orphans_and_numbers_questions(legacy_database):
+    report = copy_database(legacy_database, engine.url.render_as_string(hide_password=False), batch_size=2)
+
+    assert report['question'] == (3, 2)
+    assert report['user_asked_question'] == (4, 1)
+    with ops.unit_of_work() as session:
+        positions = dict(session.query(Question.id, Question.position).all())
+        asked = session.query(user_asked_question.c.user_id, user_asked_question.c.question_id,
+                              user_asked_question.c.ts).all()
+        rooms = session.query(user_subscribed_to_quiz.c.room_id).all()
+    # The same rows are kept as by the migrations of a SQLite database
+    assert positions == {'second': 0, 'first': 1}
+    assert [(user_id, question_id, str(ts)) for user_id, question_id, ts in asked] == \
+        [('@user:localhost', 'second', '2024-01-01 09:00:00')]
+    assert rooms == [('!first',)]
+
+
+def test_copy_database_refuses_a_filled_target(legacy_database):
+    with ops.unit_of_work():
+        ops.bump_quiz_revision('quiz')
+    with pytest.raises(ValueError, match='already contains data'):
+        copy_database(legacy_database, engine.url.render_as_string(hide_password=False))
@@ -0,0 +1,135 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from store import db_operations as ops
+from store.models import ProcessedEvent, Question, Quiz, QuizRevision, ShardLease, User, engine
+from util import utility_functions as util
+
+pytestmark = pytest.mark.usefixtures('database')
+
+
+@pytest.fixture(params=['on_conflict', 'fallback'])
+def statements(request, monkeypatch):
+    # Every upsert runs with the ON CONFLICT statement of the database and with the fallback for other databases
+    if request.param == 'fallback':
+        monkeypatch.setattr(ops, 'UPSERT_DIALECTS', {})
+    return request.param
+
+
+def test_statements_use_the_dialect_of_the_database():
+    assert engine.dialect.name in ops.UPSERT_DIALECTS
+    assert ops.dialect_insert(QuizRevision.__table__) is not None
+
+
+def test_upsert_sets_update_expressions(statements):
+    table = QuizRevision.__table__
+    for _ in range(3):
+        with ops.unit_of_work():
+            assert ops.upsert(table, {'quiz_id': 'quiz', 'revision': 1}, ['quiz_id'],
+                              {'revision': table.c.revision + 1}) == 1
+    with ops.unit_of_work() as session:
+        assert session.query(QuizRevision.revision).filter_by(quiz_id='quiz').scalar() == 3
+
+
+def test_upsert_without_update_columns_keeps_the_row(statements):
+    table = ProcessedEvent.__table__
+    with ops.unit_of_work():
+        assert ops.upsert(table, {'event_id': '$1', 'room_id': '!first', 'ts': datetime.now()}, ['event_id']) == 1
+    with ops.unit_of_work():
+        assert ops.upsert(table, {'event_id': '$1', 'room_id': '!second', 'ts': datetime.now()}, ['event_id']) == 0
+    with ops.unit_of_work() as session:
+        assert session.query(ProcessedEvent.room_id).filter_by(event_id='$1').scalar() == '!first'
+
+
+def test_record_processed_event_skips_duplicates(statements):
+    with ops.unit_of_work():
+        assert ops.record_processed_event('$1', '!room', 100)
+    with ops.unit_of_work():
+        assert not ops.record_processed_event('$1', '!room', 100)
+    with ops.unit_of_work():
+        assert ops.record_processed_event('$2', '!room', 100)
+
+
+def test_bump_quiz_revision(statements):
+    for _ in range(2):
+        with ops.unit_of_work():
+            ops.bump_quiz_revision('quiz')
+    with ops.unit_of_work() as session:
+        assert session.query(QuizRevision.revision).filter_by(quiz_id='quiz').scalar() == 2
+
+
+def expire_leases():
+    with ops.unit_of_work() as session:
+        session.query(ShardLease).update({'expires_ts': util.utc_now() - timedelta(seconds=1)})
+
+
+def test_shard_lease_is_only_taken_over_when_expired(statements):
+    with ops.unit_of_work():
+        expires = ops.acquire_shard_lease(0, 2, 'first', 60)
+    assert expires > util.utc_now()
+    with ops.unit_of_work():
+        assert ops.acquire_shard_lease(0, 2, 'second', 60) is None
+    with ops.unit_of_work():
+        assert ops.acquire_shard_lease(0, 2, 'first', 60) >= expires
+
+    expire_leases()
+    with ops.unit_of_work():
+        assert ops.acquire_shard_lease(0, 2, 'second', 60) is not None
+    with ops.unit_of_work():
+        assert ops.acquire_shard_lease(0, 2, 'first', 60) is None
+    with ops.unit_of_work() as session:
+        assert session.query(ShardLease.owner).filter_by(shard_index=0).scalar() == 'second'
+
+
+def test_shard_lease_waits_for_leases_of_another_worker_count(statements):
+    with ops.unit_of_work():
+        assert ops.acquire_shard_lease(1, 2, 'old', 60) is not None
+    with ops.unit_of_work():
+        assert ops.acquire_shard_lease(0, 4, 'new', 60) is None
+    with ops.unit_of_work() as session:
+        assert session.query(ShardLease.owner).filter_by(shard_index=0).scalar() is None
+
+    expire_leases()
+    with ops.unit_of_work():
+        assert ops.acquire_shard_lease(0, 4, 'new', 60) is not None
+    with ops.unit_of_work():
+        assert ops.acquire_shard_lease(1, 2, 'old', 60) is None
+
+
+def add_quiz(question_count):
+    with ops.unit_of_work() as session:
+        quiz = Quiz(id='quiz', name='Quiz', messages_per_day=1, short_id=1)
+        session.add(quiz)
+        session.add_all(Question(id=f'q{index}', text=f'Question {index}', is_essay=True, is_multiple_choice=False,
+                                 quiz=quiz) for index in range(question_count))
+        session.add(User(id='@user:localhost'))
+
+
+def test_progress_cursor_follows_the_question_order():
+    add_quiz(3)
+    with ops.unit_of_work():
+        assert ops.subscribe_user_to_quiz('@user:localhost', 'quiz', '!room')
+    answered = []
+    for _ in range(3):
+        with ops.unit_of_work():
+            question_id = ops.get_unanswered_question('@user:localhost', 'quiz').id
+            assert ops.ask_question_to_user('@user:localhost', 'quiz', question_id, '!room')
+        answered.append(question_id)
+        completed = ops.record_answer('@user:localhost', 'quiz', question_id, '!room')
+        assert completed == (len(answered) == 3)
+    assert answered == ['q0', 'q1', 'q2']
+    with ops.unit_of_work():
+        assert not ops.is_user_subscribed('@user:localhost', 'quiz')
+
+
+def test_progress_cursor_of_old_subscriptions_skips_asked_questions():
+    add_quiz(3)
+    with ops.unit_of_work():
+        assert ops.subscribe_user_to_quiz('@user:localhost', 'quiz', '!room')
+        ops.update_user_asked_question('@user:localhost', 'q0', 'quiz')
+        ops.set_progress('@user:localhost', 'quiz', None)
+    with ops.unit_of_work():
+        assert ops.get_unanswered_question('@user:localhost', 'quiz').id == 'q1'
+    with ops.unit_of_work():
+        assert ops.get_progress('@user:localhost', 'quiz').next_position == 1
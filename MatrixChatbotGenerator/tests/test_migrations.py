@@ -0,0 +1,30 @@
+from sqlalchemy import inspect, text
+
+from store import migrations
+from store.db_engine import create_db_engine
+from store.models import Base
+
+
+def test_upgrade_removes_duplicates_and_numbers_questions(legacy_database):
+    engine = create_db_engine(legacy_database)
+    # As ensure_schema does, create_all only adds the missing tables
+    Base.metadata.create_all(engine)
+    migrations.upgrade(engine, Base.metadata)
+    # A second run has nothing left to do
+    migrations.upgrade(engine, Base.metadata)
+
+    with engine.connect() as connection:
+        positions = dict(connection.execute(text('SELECT id, position FROM question WHERE quiz_id = :quiz'),
+                                            {'quiz': 'quiz'}).all())
+        subscriptions = connection.execute(text('SELECT room_id, messages_per_day FROM user_subscribed_to_quiz')).all()
+        asked = connection.execute(text(
+            "SELECT ts FROM user_asked_question WHERE question_id = 'second'")).scalars().all()
+    indexes = {index['name'] for index in inspect(engine).get_indexes('user_asked_question')}
+    engine.dispose()
+
+    # Questions keep the rowid order, the earliest inserted subscription and the earliest asked row are kept
+    assert positions == {'second': 0, 'first': 1}
+    assert subscriptions == [('!first', 1)]
+    assert [str(ts) for ts in asked] == ['2024-01-01 09:00:00']
+    assert 'ux_user_asked_question_user_question' in indexes
+    assert 'ix_user_asked_question_dedupe' not in indexes
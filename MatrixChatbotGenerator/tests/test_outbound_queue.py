@@ -0,0 +1,51 @@
+import asyncio
+
+from nio import RoomSendError
+
+from classes.OutboundQueue import OutboundQueue
+
+
+class FakeClient:
+    def __init__(self, errors=()):
+        self.errors = list(errors)  # responses returned before the sends succeed
+        self.sent = []
+
+    async def room_send(self, room_id, message_type, content, ignore_unverified_devices=False):
+        if self.errors:
+            return self.errors.pop(0)
+        self.sent.append((room_id, content['body']))
+        return object()
+
+
+def send_all(queue, messages):
+    async def main():
+        futures = [queue.enqueue(room_id, message) for room_id, message in messages]
+        await asyncio.gather(*futures)
+        queue.stop()
+    asyncio.run(main())
+
+
+def test_messages_of_a_room_are_merged_in_order():
+    client = FakeClient()
+    send_all(OutboundQueue(client), [('!a', 'first'), ('!b', 'other'), ('!a', 'second'), ('!a', 'third')])
+    assert sorted(client.sent) == [('!a', 'first\n\nsecond\n\nthird'), ('!b', 'other')]
+
+
+def test_merged_events_stay_below_the_size_limit():
+    client = FakeClient()
+    send_all(OutboundQueue(client, max_body_bytes=12), [('!a', 'abcde'), ('!a', 'fghij'), ('!a', 'klmno')])
+    assert client.sent == [('!a', 'abcde\n\nfghij'), ('!a', 'klmno')]
+
+
+def test_long_messages_are_split_at_line_breaks_and_characters():
+    queue = OutboundQueue(FakeClient(), max_body_bytes=8)
+    assert queue.split('abc\ndefghij\nk') == ['abc', 'defghij', 'k']
+    parts = queue.split('äöüäöüäöü')
+    assert ''.join(parts) == 'äöüäöüäöü'
+    assert all(len(part.encode('utf-8')) <= 8 for part in parts)
+
+
+def test_rate_limited_sends_are_retried():
+    client = FakeClient([RoomSendError('slow down', 'M_LIMIT_EXCEEDED', retry_after_ms=10)])
+    send_all(OutboundQueue(client), [('!a', 'first')])
+    assert client.sent == [('!a', 'first')]
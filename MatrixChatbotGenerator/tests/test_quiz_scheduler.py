@@ -0,0 +1,52 @@
+import asyncio
+from datetime import datetime, timedelta
+
+from classes.QuizScheduler import QuizScheduler
+
+LATER = datetime.now() + timedelta(days=2)  # after every due time
+
+
+def test_due_times_are_spread_over_the_window():
+    scheduler = QuizScheduler(None, jitter=0)
+    morning = datetime.combine(datetime.now().date(), datetime.min.time()) + timedelta(hours=8)
+    subscription = {'messages_per_day': 4, 'asked_today': 0, 'day': morning.date()}
+    # 11 hours in 4 slots, the first question is due in the middle of the first slot
+    assert scheduler.next_due(subscription, morning) == morning.replace(hour=10, minute=22, second=30)
+    subscription['asked_today'] = 4
+    assert scheduler.next_due(subscription, morning).date() == morning.date() + timedelta(days=1)
+    subscription['messages_per_day'] = 0
+    assert scheduler.next_due(subscription, morning) is None
+
+
+def test_removed_and_rescheduled_entries_are_skipped():
+    scheduler = QuizScheduler(None)
+    scheduler._schedule('@a', 'quiz', '!a', 3, 0)
+    scheduler._schedule('@b', 'quiz', '!b', 3, 0)
+    scheduler._update_messages_per_day('@b', 'quiz', 5)
+    scheduler._unschedule('@a', 'quiz')
+    assert len(scheduler.heap) == 3
+    assert scheduler.pop_due(LATER) == [('@b', 'quiz')]
+    assert scheduler.heap == []
+
+
+def test_subscriptions_of_a_room_are_ordered_by_deficit():
+    scheduler = QuizScheduler(None)
+    now = datetime.combine(datetime.now().date(), datetime.min.time()) + timedelta(hours=19)
+    for quiz_id, asked_today in (('ahead', 5), ('behind', 1), ('even', 3)):
+        scheduler._schedule('@user', quiz_id, '!room', 5, asked_today)
+        scheduler.subscriptions[('@user', quiz_id)]['day'] = now.date()
+    assert scheduler.order_due([('@user', 'ahead'), ('@user', 'even'), ('@user', 'behind')], now) == \
+        [('@user', 'behind'), ('@user', 'even'), ('@user', 'ahead')]
+
+
+def test_changes_before_run_are_applied_on_the_event_loop():
+    scheduler = QuizScheduler(None)
+    scheduler.schedule('@user', 'quiz', '!room', 3)
+    assert scheduler.subscriptions == {}
+
+    async def main():
+        task = asyncio.ensure_future(scheduler.run())
+        await asyncio.sleep(0)
+        task.cancel()
+    asyncio.run(main())
+    assert ('@user', 'quiz') in scheduler.subscriptions
@@ -0,0 +1,50 @@
+import pytest
+from sqlalchemy import text
+
+from classes import QuizBot
+from store import db_operations as ops
+from store.models import Question, Quiz, User, engine
+
+pytestmark = pytest.mark.usefixtures('database')
+
+
+@pytest.fixture
+def bot():
+    return QuizBot.Quizbot()
+
+
+def ask_first_question():
+    with ops.unit_of_work() as session:
+        quiz = Quiz(id='quiz', name='Quiz', messages_per_day=1, short_id=1)
+        session.add_all([quiz, User(id='@user:localhost'),
+                         Question(id='q0', text='Question', is_essay=True, is_multiple_choice=False, quiz=quiz)])
+    with ops.unit_of_work():
+        assert ops.subscribe_user_to_quiz('@user:localhost', 'quiz', '!room')
+        assert ops.ask_question_to_user('@user:localhost', 'quiz', 'q0', '!room')
+
+
+def test_answer_is_recorded(bot):
+    ask_first_question()
+    with ops.unit_of_work():
+        response = bot.process_answer('@user:localhost', 'An answer', '!room')
+    assert 'you have completed the quiz "Quiz"' in response
+    with ops.unit_of_work():
+        assert ops.get_open_question_key('@user:localhost') is None
+
+
+def test_answer_to_a_deleted_question(bot, monkeypatch):
+    ask_first_question()
+    with ops.unit_of_work():
+        assert ops.get_open_question_key('@user:localhost', '!room') == ('quiz', 'q0')
+    # The question is deleted by another process, the cached state of the user still has it open
+    with engine.begin() as connection:
+        connection.execute(text("DELETE FROM question WHERE id = 'q0'"))
+    with ops.unit_of_work():
+        ops.bump_quiz_revision('quiz')
+    recorded = []
+    monkeypatch.setattr(QuizBot, 'record_answer', lambda *args: recorded.append(args))
+
+    with ops.unit_of_work():
+        assert bot.process_answer('@user:localhost', 'An answer', '!room') == 'You have no open question.'
+    assert recorded == []
+    assert '@user:localhost' not in ops.user_state_cache.entries
@@ -0,0 +1,39 @@
+from nio import UploadFilterResponse
+
+from util import utility_functions as util
+
+logger = util.create_logger('sync_filter')
+
+# Only the events the bot handles: text and encrypted messages in the timeline and invites, which are not
+# affected by the room filter. Members are lazy loaded, presence, typing, receipts and account data are dropped.
+# To-device events are kept, they carry the room keys for encrypted rooms.
+SYNC_FILTER = {
+    'presence': {'types': []},
+    'account_data': {'types': []},
+    'room': {
+        'timeline': {'types': ['m.room.message', 'm.room.encrypted'], 'limit': 20, 'lazy_load_members': True},
+        'state': {'types': ['m.room.member', 'm.room.encryption'], 'lazy_load_members': True},
+        'ephemeral': {'types': []},
+        'account_data': {'types': []},
+    },
+}
+
+
+async def upload_sync_filter(client, sync_filter=None):
+    """
+    Register the filter on the homeserver.
+    :param client: logged in AsyncClient
+    :param sync_filter: filter definition, SYNC_FILTER if None
+    :return: the filter id, or the filter definition to send with every sync if the upload failed
+    """
+    sync_filter = sync_filter if sync_filter else SYNC_FILTER
+    response = await client.upload_filter(
+        presence=sync_filter.get('presence'),
+        account_data=sync_filter.get('account_data'),
+        room=sync_filter.get('room')
+    )
+    if isinstance(response, UploadFilterResponse):
+        logger.info(f"Uploaded sync filter {response.filter_id}")
+        return response.filter_id
+    logger.error(f"Uploading the sync filter failed: {response}, sending it inline")
+    return sync_filter
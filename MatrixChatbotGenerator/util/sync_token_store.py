@@ -0,0 +1,85 @@
+import asyncio
+import json
+import os
+import threading
+
+from util import utility_functions as util
+
+logger = util.create_logger('sync_token_store')
+
+
+class SyncTokenStore:
+    """
+    Keeps the latest sync token in memory and writes it to a file at most once per flush interval.
+    The file is replaced atomically, so a crash never leaves a truncated token behind.
+    """
+
+    def __init__(self, path, flush_interval=30):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.token = None
+        self.dirty = False
+        self.lock = threading.Lock()
+        self.write_lock = threading.Lock()  # one write at a time, a later write always has the newer token
+        self.task = None
+
+    def load(self):
+        """Load the token from the file, returns None if there is no valid token."""
+        if not os.path.exists(self.path):
+            return None
+        try:
+            with open(self.path, 'r') as file:
+                self.token = json.load(file).get('next_batch', None)
+        except (OSError, ValueError, AttributeError) as e:
+            logger.error(f"Could not read sync token from {self.path}: {e}")
+            self.token = None
+        return self.token
+
+    def update(self, token):
+        with self.lock:
+            if token != self.token:
+                self.token = token
+                self.dirty = True
+
+    def flush(self):
+        """Write the token to the file if it changed since the last write."""
+        with self.write_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                token = self.token
+                self.dirty = False
+            temp_path = f'{self.path}.tmp'
+            try:
+                with open(temp_path, 'w') as file:
+                    json.dump({'next_batch': token}, file)
+                    file.flush()
+                    os.fsync(file.fileno())
+                os.replace(temp_path, self.path)
+            except OSError as e:
+                with self.lock:
+                    self.dirty = True
+                logger.error(f"Could not write sync token to {self.path}: {e}")
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+
+    async def close(self):
+        # Stops the background writes, then writes the last token
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        self.flush()
+
+    async def run(self):
+        # Writes the token in the background, off the event loop
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            if self.dirty:
+                await loop.run_in_executor(None, self.flush)
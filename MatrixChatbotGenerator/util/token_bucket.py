@@ -0,0 +1,39 @@
+import asyncio
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter. Tokens are refilled continuously with the given rate up to the capacity.
+    A rate of 0 or less disables the limit.
+    """
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)  # tokens per second
+        self.capacity = float(capacity) if capacity else max(1.0, self.rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = None
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self, tokens=1):
+        # Takes the tokens if they are available, never waits
+        if self.rate <= 0:
+            return True
+        self.refill()
+        if self.tokens >= tokens:
+            self.tokens -= tokens
+            return True
+        return False
+
+    async def acquire(self, tokens=1):
+        # Waits until the tokens are available, waiters are served in arrival order
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        async with self.lock:
+            while not self.try_acquire(tokens):
+                await asyncio.sleep((tokens - self.tokens) / self.rate)
@@ -1,6 +1,9 @@
 import inspect
 import logging
+import math
 import os
+import zlib
+from datetime import datetime, timezone
 from logging.handlers import RotatingFileHandler
 
 
@@ -34,3 +37,20 @@ def current_function_name():
     return inspect.stack()[1].function
 
 
+def percentile(values, p):
+    # Nearest-rank percentile of a list of numbers, p between 0 and 100
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = max(0, min(len(ordered), math.ceil(p / 100 * len(ordered))) - 1)
+    return ordered[index]
+
+
+def room_shard(room_id, worker_count):
+    # Stable partition of a room id, the same in every process
+    return zlib.crc32(room_id.encode('utf-8')) % worker_count
+
+
+def utc_now():
+    # Naive UTC time for timestamps compared across processes and hosts, the DateTime columns have no time zone
+    return datetime.now(timezone.utc).replace(tzinfo=None)